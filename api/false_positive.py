@@ -6,6 +6,7 @@ from fastapi import APIRouter, Depends, HTTPException
 
 from modules import utils
 from modules.dependencies import database, langs
+from modules.query import counts
 from modules.utils import LangsNegociation
 
 from .false_positive_utils import _get
@@ -49,7 +50,9 @@ async def fp_uuid(
 @router.delete("/0.3/false-positive/{uuid}", tags=["issues"])
 async def fp_delete_uuid(uuid: UUID, db: Connection = Depends(database.db_rw)) -> None:
     m = await db.fetchrow(
-        "SELECT uuid FROM markers_status WHERE status = $1 AND uuid = $2", "false", uuid
+        "SELECT uuid, source_id FROM markers_status WHERE status = $1 AND uuid = $2",
+        "false",
+        uuid,
     )
     if not m:
         raise HTTPException(status_code=410)
@@ -58,3 +61,4 @@ async def fp_delete_uuid(uuid: UUID, db: Connection = Depends(database.db_rw)) -
         await db.execute(
             "DELETE FROM markers_status WHERE status = $1 AND uuid = $2", "false", uuid
         )
+    counts.invalidate(m["source_id"])
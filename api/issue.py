@@ -9,7 +9,7 @@ from fastapi import APIRouter, Depends, HTTPException, Request
 from modules import OsmSax, utils
 from modules.dependencies import database, langs
 from modules.fastapi_utils import XMLResponse
-from modules.query import fixes_default
+from modules.query import counts, fixes_default
 from modules.utils import LangsNegociation
 
 from .issue_utils import _expand_tags, _get, t2l
@@ -32,7 +32,11 @@ async def _remove_bug_err_id(db: Connection, error_id: int, status: Status) -> i
         return -1
 
     async with db.transaction():
-        await db.execute("DELETE FROM markers_status WHERE uuid=$1", uuid)
+        await db.execute(
+            "DELETE FROM markers_status WHERE source_id = $1 AND uuid = $2",
+            source_id,
+            uuid,
+        )
 
         await db.execute(
             """INSERT INTO markers_status
@@ -40,18 +44,22 @@ async def _remove_bug_err_id(db: Connection, error_id: int, status: Status) -> i
                         SELECT source_id,item,class,elems,NOW(),$1,
                                 lat,lon,subtitle,uuid
                         FROM markers
-                        WHERE uuid = $2
+                        WHERE source_id = $2 AND uuid = $3
                         ON CONFLICT DO NOTHING""",
             status,
+            source_id,
             uuid,
         )
 
-        await db.execute("DELETE FROM markers WHERE uuid = $1", uuid)
+        await db.execute(
+            "DELETE FROM markers WHERE source_id = $1 AND uuid = $2", source_id, uuid
+        )
         await db.execute(
             "UPDATE markers_counts SET count = count - 1 WHERE source_id = $1 AND class = $2",
             source_id,
             class_id,
         )
+    counts.invalidate(source_id)
 
     return 0
 
@@ -68,7 +76,11 @@ async def _remove_bug_uuid(db: Connection, uuid: UUID, status: Status) -> int:
         return -1
 
     async with db.transaction():
-        await db.execute("DELETE FROM markers_status WHERE uuid=$1", uuid)
+        await db.execute(
+            "DELETE FROM markers_status WHERE source_id = $1 AND uuid = $2",
+            source_id,
+            uuid,
+        )
 
         await db.execute(
             """INSERT INTO markers_status
@@ -76,18 +88,22 @@ async def _remove_bug_uuid(db: Connection, uuid: UUID, status: Status) -> int:
                         SELECT source_id,item,class,elems,NOW(),$1,
                                 lat,lon,subtitle,uuid
                         FROM markers
-                        WHERE uuid = $2
+                        WHERE source_id = $2 AND uuid = $3
                         ON CONFLICT DO NOTHING""",
             status,
+            source_id,
             uuid,
         )
 
-        await db.execute("DELETE FROM markers WHERE uuid = $1", uuid)
+        await db.execute(
+            "DELETE FROM markers WHERE source_id = $1 AND uuid = $2", source_id, uuid
+        )
         await db.execute(
             "UPDATE markers_counts SET count = count - 1 WHERE source_id = $1 AND class = $2",
             source_id,
             class_id,
         )
+    counts.invalidate(source_id)
 
     return 0
 
@@ -1,30 +1,29 @@
+import csv
+import io
 import json
 from collections import OrderedDict
 from itertools import groupby
-from typing import Any, Dict, List, Literal, Tuple
+from typing import Any, AsyncIterator, Callable, Dict, Optional, Tuple
+from uuid import UUID
 
 from asyncpg import Connection
 from fastapi import APIRouter, Depends, Request, Response
-from fastapi.responses import RedirectResponse
-from lxml import etree
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import RedirectResponse, StreamingResponse
+from pydantic_core import to_jsonable_python
 
 from modules import query, query_meta, utils
 from modules.dependencies import commons_params, database, i18n, langs
-from modules.fastapi_utils import GeoJSONResponse
-from modules.GeoJSONTypes import GeoJSONFeatureCollection
 from modules.utils import LangsNegociation, i10n_select_auto, i10n_select_lang
 
-from .issues_utils import csv, gpx, kml, rss
+from .issues_utils import STREAM_CHUNK_SIZE, gpx, kml, rss
 
 router = APIRouter()
 
 
-class XMLResponse(Response):
+class XMLResponse(StreamingResponse):
     media_type = "text/xml; charset=utf-8"
 
-    def render(self, content: Any) -> bytes:
-        return etree.tostring(content, pretty_print=True)
-
 
 class KMLResponse(XMLResponse):
     media_type = "application/vnd.google-earth.kml+xml"
@@ -38,17 +37,47 @@ class RSSResponse(XMLResponse):
     media_type = "application/rss+xml"
 
 
-class CSVResponse(Response):
+class CSVResponse(StreamingResponse):
     media_type = "text/csv; charset=utf-8"
 
 
-class NLJSONResponse(Response):
+class GeoJSONResponse(StreamingResponse):
+    media_type = "application/vnd.geo+json"
+
+
+class NLJSONResponse(StreamingResponse):
     media_type = "application/x-ndjson; charset=utf-8"
 
-    def render(self, content: Any) -> bytes:
-        return ("\x1E" + "\n\x1E".join([json.dumps(line) for line in content])).encode(
-            "utf-8"
-        )
+
+async def _json_join(
+    head: str,
+    separator: str,
+    tail: str,
+    contents: AsyncIterator[Any],
+    dumps: Callable[[Any], str],
+) -> AsyncIterator[str]:
+    """Contents encoded in JSON, joined by separator, yielded by chunks."""
+    chunk = [head]
+    size = len(head)
+    sep = ""
+    async for content in contents:
+        line = sep + dumps(content)
+        chunk.append(line)
+        size += len(line)
+        sep = separator
+        if size >= STREAM_CHUNK_SIZE:
+            yield "".join(chunk)
+            chunk = []
+            size = 0
+    chunk.append(tail)
+    yield "".join(chunk)
+
+
+def _link_next(request: Request, cursor: Optional[str]) -> Dict[str, str]:
+    """Link header to the next page, when paging by cursor."""
+    if not cursor:
+        return {}
+    return {"Link": f'<{request.url.include_query_params(cursor=cursor)}>; rel="next"'}
 
 
 @router.get("/0.2/errors", tags=["0.2"])
@@ -141,10 +170,11 @@ async def errors(
 @router.get("/0.3/issues.json", tags=["issues"])
 async def issues(
     request: Request,
+    response: Response,
     db: Connection = Depends(database.db),
     langs: LangsNegociation = Depends(langs.langs),
     params=Depends(commons_params.params),
-) -> Dict[Literal["issues"], List[Dict[str, Any]]]:
+) -> Dict[str, Any]:
     params.limit = min(params.limit, 100000)
     results = await query._gets(db, params)
 
@@ -191,6 +221,9 @@ async def issues(
             )
         out.append(i)
 
+    response.headers.update(_link_next(request, query.next_cursor(params, results)))
+    if params.cursor is not None:
+        return {"issues": out, "next_cursor": query.next_cursor(params, results)}
     return {"issues": out}
 
 
@@ -227,7 +260,13 @@ async def _issues(
     langs: LangsNegociation,
     params: commons_params.Params,
     _: i18n.Translator,
-) -> Tuple[str, List[Any]]:
+) -> Tuple[str, AsyncIterator[Dict[str, Any]], Optional[str]]:
+    """Title, issues and cursor of the next page of the exports.
+
+    The issues are streamed from a cursor on a connection of their own, held
+    while the response is sent. A page is fetched at once on db instead, for
+    the cursor to follow its last issue.
+    """
     if params.status == "false":
         title = _("False positives")
     elif params.status == "done":
@@ -244,14 +283,29 @@ async def _issues(
 
     params.full = True
     params.limit = min(params.limit, 100000)
-    issues = await query._gets(db, params)
 
-    for issue in issues:
-        issue["subtitle"] = i10n_select_auto(issue["subtitle"], langs)
-        issue["title"] = i10n_select_auto(issue["title"], langs)
-        issue["menu"] = i10n_select_auto(issue["menu"], langs)
+    cursor = None
+    if params.cursor is not None:
+        results = await query._gets(db, params)
+        cursor = query.next_cursor(params, results)
 
-    return (title, issues)
+    async def fetch() -> AsyncIterator[Dict[str, Any]]:
+        if params.cursor is not None:
+            for issue in results:
+                yield issue
+        else:
+            async with database.readonly() as db:
+                async for issue in query._gets_cursor(db, params):
+                    yield issue
+
+    async def issues() -> AsyncIterator[Dict[str, Any]]:
+        async for issue in fetch():
+            issue["subtitle"] = i10n_select_auto(issue["subtitle"], langs)
+            issue["title"] = i10n_select_auto(issue["title"], langs)
+            issue["menu"] = i10n_select_auto(issue["menu"], langs)
+            yield issue
+
+    return (title, issues(), cursor)
 
 
 @router.get("/0.3/issues.rss", response_class=RSSResponse, tags=["issues"])
@@ -262,7 +316,7 @@ async def issues_rss(
     params=Depends(commons_params.params),
     i18n: i18n.Translator = Depends(i18n.i18n),
 ) -> RSSResponse:
-    title, issues = await _issues(db, langs, params, i18n)
+    title, issues, cursor = await _issues(db, langs, params, i18n)
     return RSSResponse(
         rss(
             title=title,
@@ -274,7 +328,8 @@ async def issues_rss(
             remote_url_read=utils.remote_url_read,
             issues=issues,
             i18n=i18n,
-        )
+        ),
+        headers=_link_next(request, cursor),
     )
 
 
@@ -286,7 +341,7 @@ async def issues_gpx(
     params=Depends(commons_params.params),
     i18n: i18n.Translator = Depends(i18n.i18n),
 ) -> GPXResponse:
-    title, issues = await _issues(db, langs, params, i18n)
+    title, issues, cursor = await _issues(db, langs, params, i18n)
     return GPXResponse(
         gpx(
             title=title,
@@ -298,7 +353,8 @@ async def issues_gpx(
             remote_url_read=utils.remote_url_read,
             issues=issues,
             i18n=i18n,
-        )
+        ),
+        headers=_link_next(request, cursor),
     )
 
 
@@ -310,7 +366,7 @@ async def issues_kml(
     params=Depends(commons_params.params),
     i18n: i18n.Translator = Depends(i18n.i18n),
 ) -> KMLResponse:
-    title, issues = await _issues(db, langs, params, i18n)
+    title, issues, cursor = await _issues(db, langs, params, i18n)
     return KMLResponse(
         kml(
             title=title,
@@ -322,7 +378,8 @@ async def issues_kml(
             remote_url_read=utils.remote_url_read,
             issues=issues,
             i18n=i18n,
-        )
+        ),
+        headers=_link_next(request, cursor),
     )
 
 
@@ -332,19 +389,24 @@ async def issues_csv(
     db: Connection = Depends(database.db),
     langs: LangsNegociation = Depends(langs.langs),
     params=Depends(commons_params.params),
-    i18n: i18n.Translator = Depends(i18n.i18n),
-) -> str:
-    title, issues = await _issues(db, langs, params, i18n)
-    return csv(
-        title=title,
-        website=utils.website,
-        lang=i10n_select_lang(langs),
-        params=params,
-        query=str(request.query_params),
-        main_website=utils.main_website,
-        remote_url_read=utils.remote_url_read,
-        issues=issues,
-    )
+) -> CSVResponse:
+    params.limit = min(params.limit, 100000)
+
+    if params.cursor is not None:
+        # A page at once, for the cursor to follow its last issue
+        data = b"".join(
+            [chunk async for chunk in query._gets_csv(db, params, langs or [])]
+        )
+        rows = list(csv.reader(io.StringIO(data.decode("utf-8"))))[1:]
+        cursor = query.next_cursor(params, [{"uuid": UUID(row[0])} for row in rows])
+        return CSVResponse(iter([data]), headers=_link_next(request, cursor))
+
+    async def content() -> AsyncIterator[bytes]:
+        async with database.readonly() as db:
+            async for data in query._gets_csv(db, params, langs or []):
+                yield data
+
+    return CSVResponse(content())
 
 
 @router.get("/0.3/issues.geojson", response_class=GeoJSONResponse, tags=["issues"])
@@ -354,27 +416,36 @@ async def issues_geojson(
     langs: LangsNegociation = Depends(langs.langs),
     params=Depends(commons_params.params),
     i18n: i18n.Translator = Depends(i18n.i18n),
-) -> GeoJSONFeatureCollection:
-    title, issues = await _issues(db, langs, params, i18n)
-    return {
-        "type": "FeatureCollection",
-        "features": [
-            {
-                "type": "Feature",
-                "geometry": {
-                    "type": "Point",
-                    "coordinates": [
-                        properties["lon"],
-                        properties["lat"],
-                    ],
-                },
-                "properties": {
-                    k: v for k, v in properties.items() if k not in ("id", "lon", "lat")
-                },
-            }
-            for properties in issues
-        ],
-    }
+) -> GeoJSONResponse:
+    title, issues, cursor = await _issues(db, langs, params, i18n)
+    features = (
+        {
+            "type": "Feature",
+            "geometry": {
+                "type": "Point",
+                "coordinates": [
+                    properties["lon"],
+                    properties["lat"],
+                ],
+            },
+            "properties": {
+                k: v for k, v in properties.items() if k not in ("id", "lon", "lat")
+            },
+        }
+        async for properties in issues
+    )
+    return GeoJSONResponse(
+        _json_join(
+            '{"type":"FeatureCollection","features":[',
+            ",",
+            "]}",
+            features,
+            lambda content: json.dumps(
+                jsonable_encoder(content), ensure_ascii=False, separators=(",", ":")
+            ),
+        ),
+        headers=_link_next(request, cursor),
+    )
 
 
 @router.get(
@@ -386,11 +457,11 @@ async def issues_maproulette_jsonl(
     langs: LangsNegociation = Depends(langs.langs),
     params=Depends(commons_params.params),
     i18n: i18n.Translator = Depends(i18n.i18n),
-) -> List[Any]:
+) -> NLJSONResponse:
     params.limit = 100000
-    title, issues = await _issues(db, langs, params, i18n)
+    title, issues, cursor = await _issues(db, langs, params, i18n)
     type_map = {"N": "node", "W": "way", "R": "relation"}
-    return [
+    tasks = (
         {
             k: v
             for k, v in {
@@ -459,5 +530,15 @@ async def issues_maproulette_jsonl(
             }.items()
             if v is not None
         }
-        for properties in issues
-    ]
+        async for properties in issues
+    )
+    return NLJSONResponse(
+        _json_join(
+            "\x1E",
+            "\n\x1E",
+            "",
+            tasks,
+            lambda content: json.dumps(to_jsonable_python(content)),
+        ),
+        headers=_link_next(request, cursor),
+    )
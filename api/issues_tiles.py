@@ -134,7 +134,8 @@ async def heat(
     lon1, lat2 = tiles.tile2lonlat(x, y, z)
     lon2, lat1 = tiles.tile2lonlat(x + 1, y + 1, z)
 
-    items = query._build_where_item(params.item, "items")
+    items_params: List[Any] = []
+    items = query._build_where_item("items", params.item, items_params)
     params.tilex = x
     params.tiley = y
     params.zoom = z
@@ -150,7 +151,8 @@ FROM
     items
 WHERE
 """
-        + items
+        + items,
+        *items_params,
     )
     if limit and limit[0]:
         limit = float(limit[0])
@@ -1,6 +1,4 @@
-import csv as csv_lib
-import io
-from typing import Tuple
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional, Tuple
 
 from lxml import etree
 from lxml.builder import E, ElementMaker  # type: ignore
@@ -9,6 +7,63 @@ from lxml.html import builder as H
 from modules.dependencies import i18n
 from modules.dependencies.commons_params import Params
 
+# Bytes of the exports buffered before being sent
+STREAM_CHUNK_SIZE = 64 * 1024
+
+E_atom = ElementMaker(
+    namespace="http://www.w3.org/2005/Atom",
+    nsmap={"atom": "http://www.w3.org/2005/Atom"},
+)
+
+
+class _Output:
+    """Output file of lxml xmlfile, keeping the content until sent."""
+
+    def __init__(self) -> None:
+        self.chunks: List[bytes] = []
+        self.size = 0
+
+    def write(self, data: bytes) -> None:
+        self.chunks.append(data)
+        self.size += len(data)
+
+    def pop(self) -> bytes:
+        data = b"".join(self.chunks)
+        self.chunks = []
+        self.size = 0
+        return data
+
+
+async def _peek(
+    issues: AsyncIterator[Dict[str, Any]]
+) -> Tuple[Optional[Dict[str, Any]], AsyncIterator[Dict[str, Any]]]:
+    """First issue, and all the issues again."""
+    try:
+        first: Optional[Dict[str, Any]] = await issues.__anext__()
+    except StopAsyncIteration:
+        first = None
+
+    async def chain() -> AsyncIterator[Dict[str, Any]]:
+        if first is not None:
+            yield first
+            async for issue in issues:
+                yield issue
+
+    return first, chain()
+
+
+async def _xml_issues(
+    xf: etree.xmlfile,
+    output: _Output,
+    issues: AsyncIterator[Dict[str, Any]],
+    element: Callable[[Dict[str, Any]], Any],
+) -> AsyncIterator[bytes]:
+    """Write the element of each issue, yielding the output by chunks."""
+    async for issue in issues:
+        xf.write(element(issue), pretty_print=True)
+        if output.size >= STREAM_CHUNK_SIZE:
+            yield output.pop()
+
 
 def xml_header(
     params: Params, title: str, website: str, lang: str, query, _
@@ -144,40 +199,49 @@ def gpx_issue(
     )
 
 
-def gpx(
+async def gpx(
     website: str,
     lang: str,
     params: Params,
     query: str,
     main_website: str,
     remote_url_read: str,
-    issues,
+    issues: AsyncIterator[Dict[str, Any]],
     title: str,
     i18n: i18n.Translator,
-):
-    content = []
-    if len(issues) > 0:
-        content.append(E.time(issues[0]["timestamp"].strftime("%Y-%m-%dT%H:%M:%SZ")))
-    content += list(
-        map(
-            lambda issue: gpx_issue(
-                issue, website, lang, query, main_website, remote_url_read, i18n
-            ),
-            issues,
-        )
-    )
-
+) -> AsyncIterator[bytes]:
+    first, issues = await _peek(issues)
     title, _, url = xml_header(params, title, website, lang, query, i18n)
-    return E.gpx(
-        E.name(title),
-        E.url(url),
-        *content,
-        version="1.0",
-        creator="http://osmose.openstreetmap.fr",
-        xmlns="http://www.topografix.com/GPX/1/0",
-        # xmlns:xsi = 'http://www.w3.org/2001/XMLSchema-instance',
-        # xsi:schemaLocation = 'http://www.topografix.com/GPX/1/0 http://www.topografix.com/GPX/1/0/gpx.xsd',
-    )
+
+    output = _Output()
+    with etree.xmlfile(output, encoding="utf-8", buffered=False) as xf:
+        xf.write_declaration()
+        with xf.element(
+            "gpx",
+            {
+                "version": "1.0",
+                "creator": "http://osmose.openstreetmap.fr",
+                "xmlns": "http://www.topografix.com/GPX/1/0",
+                # xmlns:xsi = 'http://www.w3.org/2001/XMLSchema-instance',
+                # xsi:schemaLocation = 'http://www.topografix.com/GPX/1/0 http://www.topografix.com/GPX/1/0/gpx.xsd',
+            },
+        ):
+            xf.write("\n", E.name(title), E.url(url), pretty_print=True)
+            if first:
+                xf.write(
+                    E.time(first["timestamp"].strftime("%Y-%m-%dT%H:%M:%SZ")),
+                    pretty_print=True,
+                )
+            async for chunk in _xml_issues(
+                xf,
+                output,
+                issues,
+                lambda issue: gpx_issue(
+                    issue, website, lang, query, main_website, remote_url_read, i18n
+                ),
+            ):
+                yield chunk
+    yield output.pop()
 
 
 def kml_issue(
@@ -194,7 +258,7 @@ def kml_issue(
     )
     return E.Placemark(
         E.name(name),
-        ElementMaker(namespace="http://www.w3.org/2005/Atom").link(href=map_url),
+        E_atom.link(href=map_url),
         E.description(desc),
         E.styleUrl("#placemark-purple"),
         E.Point(
@@ -203,49 +267,59 @@ def kml_issue(
     )
 
 
-def kml(
+async def kml(
     website: str,
     lang: str,
     params: Params,
     query: str,
     main_website: str,
     remote_url_read: str,
-    issues,
+    issues: AsyncIterator[Dict[str, Any]],
     title: str,
     i18n: i18n.Translator,
-):
-    content = map(
-        lambda issue: kml_issue(
-            issue, website, lang, query, main_website, remote_url_read, i18n
-        ),
-        issues,
-    )
-
+) -> AsyncIterator[bytes]:
+    first, issues = await _peek(issues)
     title, _, url = xml_header(params, title, website, lang, query, i18n)
-    if len(issues) > 0:
-        title += " (" + issues[0]["timestamp"].strftime("%Y-%m-%dT%H:%M:%SZ") + ")"
-    return ElementMaker(
-        nsmap={
-            "atom": "http://www.w3.org/2005/Atom",
-        }
-    ).kml(
-        E.Document(
-            E.name(title),
-            E.Style(
-                E.IconStyle(
-                    E.Icon(
-                        E.href(
-                            "https://osmose.openstreetmap.fr/images/markers/marker-b-1070.png"
-                        )
+    if first:
+        title += " (" + first["timestamp"].strftime("%Y-%m-%dT%H:%M:%SZ") + ")"
+
+    output = _Output()
+    with etree.xmlfile(output, encoding="utf-8", buffered=False) as xf:
+        xf.write_declaration()
+        with xf.element(
+            "kml",
+            {"xmlns": "http://www.opengis.net/kml/2.2"},
+            nsmap={"atom": "http://www.w3.org/2005/Atom"},
+        ):
+            xf.write("\n")
+            with xf.element("Document"):
+                xf.write(
+                    "\n",
+                    E.name(title),
+                    E.Style(
+                        E.IconStyle(
+                            E.Icon(
+                                E.href(
+                                    "https://osmose.openstreetmap.fr/images/markers/marker-b-1070.png"
+                                )
+                            ),
+                        ),
+                        id="placemark-purple",
                     ),
-                ),
-                id="placemark-purple",
-            ),
-            ElementMaker(namespace="http://www.w3.org/2005/Atom").link(href=url),
-            *content,
-        ),
-        xmlns="http://www.opengis.net/kml/2.2",
-    )
+                    E_atom.link(href=url),
+                    pretty_print=True,
+                )
+                async for chunk in _xml_issues(
+                    xf,
+                    output,
+                    issues,
+                    lambda issue: kml_issue(
+                        issue, website, lang, query, main_website, remote_url_read, i18n
+                    ),
+                ):
+                    yield chunk
+            xf.write("\n")
+    yield output.pop()
 
 
 def rss_issue(
@@ -269,27 +343,22 @@ def rss_issue(
     )
 
 
-def rss(
+async def rss(
     website: str,
     lang: str,
     params: Params,
     query: str,
     main_website: str,
     remote_url_read: str,
-    issues,
+    issues: AsyncIterator[Dict[str, Any]],
     title: str,
     i18n: i18n.Translator,
-):
-    content = map(
-        lambda issue: rss_issue(
-            issue, website, lang, query, main_website, remote_url_read, i18n
-        ),
-        issues,
-    )
+) -> AsyncIterator[bytes]:
+    first, issues = await _peek(issues)
 
     lastBuildDate = []
-    if len(issues) > 0:
-        time = issues[0]["timestamp"]
+    if first:
+        time = first["timestamp"]
         ctime = time.ctime()
         rfc822 = "{0}, {1:02d} {2}".format(
             ctime[0:3], time.day, ctime[4:7]
@@ -297,76 +366,34 @@ def rss(
         lastBuildDate = [E.lastBuildDate(rfc822)]
 
     title, description, url = xml_header(params, title, website, lang, query, i18n)
-    E_atom = ElementMaker(
-        namespace="http://www.w3.org/2005/Atom",
-        nsmap={"atom": "http://www.w3.org/2005/Atom"},
-    )
-    return E.rss(
-        E.channel(
-            E_atom.link(
-                href=f"{website}/api/0.3/issues.rss?{query}",
-                rel="self",
-                type="application/rss+xml",
-            ),
-            E.title(title),
-            E.description(description or query),
-            *lastBuildDate,
-            E.link(url),
-            *content,
-        ),
-        version="2.0",
-    )
-
 
-def csv(
-    website: str,
-    lang: str,
-    params: Params,
-    query: str,
-    main_website: str,
-    remote_url_read: str,
-    issues,
-    title: str,
-) -> str:
-    output = io.StringIO()
-    writer = csv_lib.writer(output)
-    h = [
-        "uuid",
-        "source",
-        "item",
-        "class",
-        "level",
-        "title",
-        "subtitle",
-        "country",
-        "analyser",
-        "timestamp",
-        "username",
-        "lat",
-        "lon",
-        "elems",
-    ]
-    hh = {"source": "source_id"}
-    writer.writerow(h)
-    for res in issues:
-        usernames = list(map(lambda elem: elem.get("username", ""), res["elems"] or []))
-        elems = "_".join(
-            map(
-                lambda elem: {"N": "node", "W": "way", "R": "relation"}[elem["type"]]
-                + str(elem["id"]),
-                res["elems"] or [],
-            )
-        )
-        writer.writerow(
-            list(
-                map(
-                    lambda a: usernames
-                    if a == "username"
-                    else elems
-                    if a == "elems"
-                    else res[a],
-                    map(lambda y: hh.get(y, y), h),
+    output = _Output()
+    with etree.xmlfile(output, encoding="utf-8", buffered=False) as xf:
+        xf.write_declaration()
+        with xf.element("rss", {"version": "2.0"}):
+            xf.write("\n")
+            with xf.element("channel"):
+                xf.write(
+                    "\n",
+                    E_atom.link(
+                        href=f"{website}/api/0.3/issues.rss?{query}",
+                        rel="self",
+                        type="application/rss+xml",
+                    ),
+                    E.title(title),
+                    E.description(description or query),
+                    *lastBuildDate,
+                    E.link(url),
+                    pretty_print=True,
                 )
-            )
-        )
-    return output.getvalue()
+                async for chunk in _xml_issues(
+                    xf,
+                    output,
+                    issues,
+                    lambda issue: rss_issue(
+                        issue, website, lang, query, main_website, remote_url_read, i18n
+                    ),
+                ):
+                    yield chunk
+            xf.write("\n")
+    yield output.pop()
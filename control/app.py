@@ -2,7 +2,7 @@ from fastapi import FastAPI
 
 from modules.dependencies import database
 
-from . import insight, update
+from . import insight, update, update_jobs
 
 app = FastAPI()
 
@@ -10,6 +10,12 @@ app = FastAPI()
 @app.on_event("startup")
 async def startup() -> None:
     await database.startup()
+    await update_jobs.startup()
+
+
+@app.on_event("shutdown")
+async def shutdown() -> None:
+    await update_jobs.shutdown()
 
 
 # Add routes
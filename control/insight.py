@@ -4,6 +4,7 @@ from typing import Any, Dict, List, Literal, Optional, Tuple
 from asyncpg import Connection
 from fastapi import APIRouter, Depends
 
+from modules import query
 from modules.dependencies import database
 
 router = APIRouter()
@@ -269,3 +270,61 @@ ORDER BY
     timestamp DESC
 """
     return dict(list=await db.fetch(sql, source))
+
+
+@router.get("/update/{source}/timings.json", tags=["insight"])
+async def update_timings(
+    source: int,
+    db: Connection = Depends(database.db),
+) -> Dict[Literal["list"], List[Dict[str, Any]]]:
+    sql = """
+SELECT
+    timestamp,
+    remote_ip,
+    version,
+    stats->'timings' AS timings,
+    stats->'rows' AS rows
+FROM
+    updates
+WHERE
+    source_id = $1 AND
+    stats IS NOT NULL
+ORDER BY
+    timestamp DESC
+"""
+    return dict(list=list(map(dict, await db.fetch(sql, source))))
+
+
+@router.get("/update_timings.json", tags=["insight"])
+async def updates_timings(
+    db: Connection = Depends(database.db),
+) -> Dict[Literal["list"], List[Dict[str, Any]]]:
+    sql = """
+SELECT
+    sources.id,
+    sources.country,
+    sources.analyser,
+    updates.timestamp,
+    updates.stats->'timings' AS timings,
+    updates.stats->'rows' AS rows
+FROM
+    sources
+    JOIN updates_last ON
+        sources.id = updates_last.source_id
+    JOIN updates ON
+        updates.source_id = updates_last.source_id AND
+        updates.timestamp = updates_last.timestamp
+WHERE
+    updates.stats IS NOT NULL
+ORDER BY
+    (updates.stats->'timings'->>'total')::float DESC
+"""
+    return dict(list=list(map(dict, await db.fetch(sql))))
+
+
+@router.get("/cache.json", tags=["insight"])
+async def cache() -> Dict[str, Dict[str, Any]]:
+    return dict(
+        counts=query.counts.stats(),
+        statements=database.statements.stats(),
+    )
@@ -1,64 +1,101 @@
+import json
 import os
+import shutil
 import sys
+import tarfile
 import tempfile
-from typing import Any, Dict, List, Literal, Optional
+from typing import Any, Dict, List, Literal, Optional, Tuple, Union, cast
 
 from asyncpg import Connection
 from fastapi import APIRouter, Depends, Form, HTTPException, Request, UploadFile
-from fastapi.responses import PlainTextResponse
+from fastapi.concurrency import run_in_threadpool
+from fastapi.responses import JSONResponse, PlainTextResponse
 
+from modules import compression, utils
 from modules.dependencies import database
 
-from . import update_utils
+from . import update_jobs, update_utils
 
 router = APIRouter()
 
 
-@router.post("/send-update", response_class=PlainTextResponse, tags=["upload"])
+async def _sources_auth(
+    db: Connection, sources: List[Tuple[str, str, str]]
+) -> List[Optional[int]]:
+    """Ids of the (analyser, country, code) sources, None when the code is
+    wrong, all checked at once.
+
+    With OSMOSE_UNLOCKED_UPDATE, the unknown sources are created.
+    """
+    r = await db.fetch(
+        """
+SELECT DISTINCT ON (t.i)
+    t.i,
+    sources.id
+FROM
+    unnest($1::text[], $2::text[], $3::text[]) WITH ORDINALITY AS t(analyser, country, code, i)
+    JOIN sources ON
+        sources.analyser = t.analyser AND
+        sources.country = t.country
+    JOIN sources_password ON
+        sources.id = sources_password.source_id AND
+        sources_password.password = t.code
+ORDER BY
+    t.i,
+    sources.id
+""",
+        [analyser for analyser, country, code in sources],
+        [country for analyser, country, code in sources],
+        [code for analyser, country, code in sources],
+    )
+    ids: Dict[int, int] = dict(map(tuple, r))
+    source_ids = [ids.get(i + 1) for i in range(len(sources))]
+
+    if os.environ.get("OSMOSE_UNLOCKED_UPDATE"):
+        created: Dict[Tuple[str, str, str], int] = {}
+        for i, (analyser, country, code) in enumerate(sources):
+            if source_ids[i]:
+                continue
+            if (analyser, country, code) not in created:
+                source_id = await db.fetchval(
+                    "SELECT COALESCE(MAX(id), 0) + 1 AS id FROM sources"
+                )
+                await db.execute(
+                    "INSERT INTO sources(id, country, analyser) VALUES ($1, $2, $3)",
+                    source_id,
+                    country,
+                    analyser,
+                )
+                await db.execute(
+                    "INSERT INTO sources_password(source_id, password) VALUES($1, $2)",
+                    source_id,
+                    code,
+                )
+                created[(analyser, country, code)] = source_id
+            source_ids[i] = created[(analyser, country, code)]
+
+    return source_ids
+
+
+@router.post(
+    "/send-update",
+    response_class=PlainTextResponse,
+    response_model=None,
+    tags=["upload"],
+)
 async def user(
     content: UploadFile,
     request: Request,
     analyser: str = Form(),
     country: str = Form(),
     code: str = Form(),
+    background: bool = Form(False),
+    dry_run: bool = Form(False),
     db: Connection = Depends(database.db_rw),
-) -> Literal["OK"]:
-    source_id = await db.fetchval(
-        """
-SELECT
-    id
-FROM
-    sources
-    JOIN sources_password ON
-        sources.id = source_id
-WHERE
-    analyser = $1 AND
-    country = $2 AND
-    password = $3
-LIMIT 1
-""",
-        analyser,
-        country,
-        code,
-    )
-
-    if not source_id and not os.environ.get("OSMOSE_UNLOCKED_UPDATE"):
+) -> Union[Literal["OK"], JSONResponse]:
+    source_id = (await _sources_auth(db, [(analyser, country, code)]))[0]
+    if not source_id:
         raise HTTPException(status_code=403, detail="AUTH FAIL")
-    elif not source_id and os.environ.get("OSMOSE_UNLOCKED_UPDATE"):
-        source_id = await db.fetchval(
-            "SELECT COALESCE(MAX(id), 0) + 1 AS id FROM sources"
-        )
-        await db.execute(
-            "INSERT INTO sources(id, country, analyser) VALUES ($1, $2, $3)",
-            source_id,
-            country,
-            analyser,
-        )
-        await db.execute(
-            "INSERT INTO sources_password(source_id, password) VALUES($1, $2)",
-            source_id,
-            code,
-        )
 
     remote_ip = request.client.host if request.client else None
 
@@ -66,15 +103,39 @@ LIMIT 1
         raise HTTPException(status_code=406, detail="FAIL: Filename required.")
     try:
         (name, ext) = os.path.splitext(content.filename)
-        if ext not in (".bz2", ".gz", ".xml"):
+        if ext not in (".xml",) + compression.EXTENSIONS:
             raise HTTPException(
                 status_code=406, detail="FAIL: File extension not allowed."
             )
 
-        with tempfile.NamedTemporaryFile(mode="wb", suffix=ext) as f:
-            f.write(await content.read())
-            f.flush()
-            await update_utils.update(db, source_id, f.name, remote_ip=remote_ip)
+        if dry_run:
+            # Only the changes by class, nothing is written
+            await content.seek(0)
+            stats = await update_utils.update(
+                db,
+                source_id,
+                content.filename,
+                remote_ip=remote_ip,
+                fileobj=content.file,
+                dry_run=True,
+            )
+            return JSONResponse(content=stats.as_dict())
+
+        if background:
+            # Load it later, out of this request and of its connection
+            job = await update_jobs.jobs.submit(source_id, content, remote_ip)
+            return JSONResponse(
+                status_code=202,
+                content={"job": job.id, "status": job.status},
+                headers={"Location": request.url_for("job_status", job=job.id).path},
+            )
+
+        # The upload is already spooled to a temporary file by Starlette, it is
+        # only decompressed and parsed by chunks from there
+        await content.seek(0)
+        await update_utils.update(
+            db, source_id, content.filename, remote_ip=remote_ip, fileobj=content.file
+        )
 
     except update_utils.OsmoseUpdateAlreadyDone:
         raise HTTPException(status_code=400, detail="FAIL: Already up to date")
@@ -94,6 +155,116 @@ LIMIT 1
     return "OK"
 
 
+@router.post("/send-update-batch", tags=["upload"])
+async def batch(
+    content: UploadFile,
+    request: Request,
+    manifest: str = Form(),
+    dry_run: bool = Form(False),
+) -> Dict[str, Any]:
+    """Load many analyser results at once, from a tar archive.
+
+    manifest is a JSON list of {"file", "analyser", "country", "code"}, file
+    being the name of a member of the archive. The sources are all
+    authenticated at once, then the files are loaded concurrently, like the
+    background jobs. A dry run applies each file in a rolled back transaction.
+    Return the totals, and the result of each file in the manifest order.
+    """
+    try:
+        entries = json.loads(manifest)
+    except ValueError:
+        raise HTTPException(status_code=406, detail="FAIL: Invalid manifest.")
+    if not isinstance(entries, list) or not all(
+        isinstance(e, dict)
+        and all(
+            isinstance(e.get(k), str) for k in ("file", "analyser", "country", "code")
+        )
+        for e in entries
+    ):
+        raise HTTPException(
+            status_code=406,
+            detail="FAIL: Invalid manifest, expecting a list of "
+            '{"file", "analyser", "country", "code"} strings.',
+        )
+    sources = [(e["analyser"], e["country"], e["code"]) for e in entries]
+    members = [e["file"] for e in entries]
+
+    async with database.database.pool.acquire() as db:
+        async with db.transaction():
+            source_ids = await _sources_auth(cast(Connection, db), sources)
+
+    errors: Dict[int, str] = {}
+    for i, (source_id, member) in enumerate(zip(source_ids, members)):
+        if not source_id:
+            errors[i] = "AUTH FAIL"
+        elif not member.endswith((".xml",) + compression.EXTENSIONS):
+            errors[i] = "FAIL: File extension not allowed."
+
+    remote_ip = request.client.host if request.client else None
+    with tempfile.TemporaryDirectory(dir=update_jobs.jobs.path) as path:
+
+        def extract() -> Dict[str, str]:
+            # Spool the wanted members, under numbered names
+            wanted = {member for i, member in enumerate(members) if i not in errors}
+            extracted: Dict[str, str] = {}
+            content.file.seek(0)
+            with tarfile.open(fileobj=content.file, mode="r|*") as tar:
+                for info in tar:
+                    if info.name in wanted and info.isfile():
+                        fname = os.path.join(path, str(len(extracted)))
+                        f = tar.extractfile(info)
+                        assert f
+                        with open(fname, "wb") as out:
+                            shutil.copyfileobj(f, out)
+                        extracted[info.name] = fname
+            return extracted
+
+        try:
+            extracted = await run_in_threadpool(extract)
+        except tarfile.TarError:
+            raise HTTPException(status_code=406, detail="FAIL: Invalid archive.")
+
+        files = []
+        names = []
+        for i, (source_id, member) in enumerate(zip(source_ids, members)):
+            if i in errors:
+                continue
+            elif member not in extracted:
+                errors[i] = "FAIL: Missing from the archive."
+                continue
+            files.append((cast(int, source_id), extracted[member]))
+            names.append(member)
+
+        assert update_jobs.jobs.pool
+        summary = await update_utils.update_many(
+            update_jobs.jobs.pool,
+            files,
+            update_jobs.jobs.workers,
+            staging=utils.update_staging,
+            dry_run=dry_run,
+            names=names,
+            remote_ip=remote_ip,
+        )
+
+    loaded = iter(summary["results"])
+    summary["failed"] += len(errors)
+    summary["results"] = [
+        dict(source_id=source_id, file=member, status="failed", error=errors[i])
+        if i in errors
+        else next(loaded)
+        for i, (source_id, member) in enumerate(zip(source_ids, members))
+    ]
+    return summary
+
+
+@router.get("/send-update/{job}", tags=["upload"])
+async def job_status(job: str) -> Dict[str, Any]:
+    status = update_jobs.jobs.status(job)
+    if not status:
+        raise HTTPException(status_code=404)
+    return status
+
+
 async def _status_object(db: Connection, type: str, source: int) -> Optional[List[int]]:
     s = await db.fetchval(
         """
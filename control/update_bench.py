@@ -0,0 +1,441 @@
+import argparse
+import asyncio
+import json
+import os
+import resource
+import tempfile
+import time
+import tracemalloc
+import unittest
+from collections import deque
+from typing import IO, Any, Dict, List, Tuple
+
+from asyncpg import Connection
+
+from modules import compression
+from modules.dependencies import database
+
+from . import update_utils
+
+ELEM_TYPES = ("node", "way", "relation")
+LANGS = ("en", "fr", "de", "es", "it", "nl", "pt", "ru", "ja", "zh")
+
+# Source used by default, far from the real ones
+BENCH_SOURCE_ID = 999999
+
+
+class xml_generator:
+    """Write synthetic analyser results of a configurable size.
+
+    Errors are numbered, the content of the error i only depends on i and on
+    its generation, so that two files differ exactly by the changed errors.
+    """
+
+    def __init__(
+        self,
+        classes: int = 10,
+        errors: int = 10000,
+        elems: int = 2,
+        fixes: int = 1,
+        langs: int = 2,
+        tags: int = 2,
+    ):
+        self.classes = classes
+        self.errors = errors
+        self.elems = elems
+        self.fixes = fixes
+        self.tags = tags
+        self.langs = LANGS[: max(1, min(langs, len(LANGS)))]
+
+    def write_class(self, f: IO[str], class_id: int) -> None:
+        f.write(
+            f'<class id="{class_id}" item="{8000 + class_id}" level="{class_id % 3 + 1}" tag="bench,fix:chair">\n'
+        )
+        for lang in self.langs:
+            f.write(
+                f'<classtext lang="{lang}" title="Bench class {class_id} {lang}"/>\n'
+            )
+            f.write(f'<detail lang="{lang}" title="Detail of class {class_id}"/>\n')
+        f.write("</class>\n")
+
+    def elem_id(self, i: int, k: int) -> int:
+        return i * self.elems + k + 1
+
+    def write_error(self, f: IO[str], i: int, generation: int = 0) -> None:
+        class_id = i % self.classes + 1
+        lat = 40 + (i % 1000) / 100
+        lon = (i // 1000 % 3600) / 10 - 180
+        f.write(f'<error class="{class_id}" subclass="{i % 7}">\n')
+        f.write(f'<location lat="{lat:.7f}" lon="{lon:.7f}"/>\n')
+        for k in range(self.elems):
+            t = ELEM_TYPES[k % len(ELEM_TYPES)]
+            f.write(f'<{t} id="{self.elem_id(i, k)}" user="user{i % 97}">')
+            f.write(f'<tag k="name" v="Name {i}/{generation}"/>')
+            f.write('<tag k="highway" v="residential"/>')
+            for n in range(2, self.tags):
+                f.write(f'<tag k="key{n}" v="value {n} of {i}"/>')
+            f.write(f"</{t}>\n")
+        for lang in self.langs:
+            f.write(f'<text lang="{lang}" value="Issue {i} {lang}"/>\n')
+        if self.fixes and self.elems:
+            f.write("<fixes>\n")
+            for n in range(self.fixes):
+                t = ELEM_TYPES[0]
+                f.write(f'<fix><{t} id="{self.elem_id(i, 0)}">')
+                f.write(f'<tag action="modify" k="name" v="Fix {n} {generation}"/>')
+                f.write(f"</{t}></fix>\n")
+            f.write("</fixes>\n")
+        f.write("</error>\n")
+
+    def write(
+        self,
+        f: IO[str],
+        timestamp: str,
+        change: float = 0.0,
+        generation: int = 0,
+        mode: str = "analyser",
+    ) -> int:
+        """Write a full analyser, or an analyserChange, return the errors count.
+
+        With a change ratio, that part of the errors get a new content, and
+        as many errors are replaced by new ones. On analyserChange only the
+        changed and new errors are written, with deletes of the removed ones.
+        """
+        step = int(1 / change) if change else 0
+        f.write('<?xml version="1.0" encoding="UTF-8"?>\n')
+        f.write(f'<analysers timestamp="{timestamp}">\n')
+        f.write(f'<{mode} timestamp="{timestamp}">\n')
+        for class_id in range(1, self.classes + 1):
+            self.write_class(f, class_id)
+
+        count = 0
+        for i in range(self.errors):
+            if step and i % step == 0:
+                self.write_error(f, i, generation)
+            elif step and i % step == 1:
+                if mode == "analyserChange":
+                    for k in range(self.elems):
+                        t = ELEM_TYPES[k % len(ELEM_TYPES)]
+                        f.write(f'<delete type="{t}" id="{self.elem_id(i, k)}"/>\n')
+                self.write_error(f, self.errors + i, generation)
+            elif mode == "analyser":
+                self.write_error(f, i)
+            else:
+                continue
+            count += 1
+
+        f.write(f"</{mode}>\n")
+        f.write("</analysers>\n")
+        return count
+
+    def write_file(self, path: str, **kwargs: Any) -> Tuple[str, int]:
+        with compression.open_file(path, "wt", encoding="utf-8") as f:
+            return path, self.write(f, **kwargs)
+
+
+class quietlogger(update_utils.printlogger):
+    def log(self, text: str) -> None:
+        pass
+
+
+def peak_rss() -> float:
+    """Peak resident memory of the process, in MB."""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+async def reset_source(db: Connection, source_id: int) -> None:
+    await db.execute("DELETE FROM markers WHERE source_id = $1", source_id)
+    await db.execute("DELETE FROM markers_counts WHERE source_id = $1", source_id)
+    await db.execute("DELETE FROM updates_last WHERE source_id = $1", source_id)
+    await db.execute("DELETE FROM updates WHERE source_id = $1", source_id)
+    await db.execute(
+        """
+INSERT INTO sources (id, country, analyser)
+VALUES ($1, 'bench', 'bench')
+ON CONFLICT DO NOTHING
+""",
+        source_id,
+    )
+
+
+async def run_scenario(
+    db: Connection,
+    source_id: int,
+    name: str,
+    fname: str,
+    errors: int,
+    staging: bool = False,
+) -> Dict[str, Any]:
+    t = time.perf_counter()
+    stats = await update_utils.update(
+        db, source_id, fname, logger=quietlogger(), staging=staging
+    )
+    elapsed = time.perf_counter() - t
+    return dict(
+        scenario=name,
+        errors=errors,
+        seconds=round(elapsed, 3),
+        errors_per_second=round(errors / elapsed),
+        peak_rss_mb=round(peak_rss(), 1),
+        **stats.as_dict(),
+    )
+
+
+async def bench(
+    db: Connection,
+    generator: xml_generator,
+    path: str,
+    source_id: int = BENCH_SOURCE_ID,
+    change: float = 0.01,
+    compression: str = "bz2",
+    staging: bool = False,
+) -> List[Dict[str, Any]]:
+    """Run the first load, re-upload and analyserChange scenarios.
+
+    The re-upload and the analyserChange both apply on top of the first load,
+    each in a savepoint. Everything is rolled back at the end, so the commit
+    cost is not measured.
+
+    The staging mode cannot run in a transaction, the first load is then
+    committed and loaded again before each scenario, and the source is
+    cleaned at the end.
+    """
+    ext = ".xml" + ("." + compression if compression != "none" else "")
+    files = [
+        (
+            "first_load",
+            *generator.write_file(
+                os.path.join(path, "first" + ext), timestamp="2020-01-01T00:00:00Z"
+            ),
+        ),
+        (
+            "reupload",
+            *generator.write_file(
+                os.path.join(path, "reupload" + ext),
+                timestamp="2020-01-02T00:00:00Z",
+                change=change,
+                generation=1,
+            ),
+        ),
+        (
+            "change",
+            *generator.write_file(
+                os.path.join(path, "change" + ext),
+                timestamp="2020-01-02T00:00:00Z",
+                change=change,
+                generation=1,
+                mode="analyserChange",
+            ),
+        ),
+    ]
+
+    results = []
+    if staging:
+        try:
+            for i, scenario in enumerate(files):
+                await reset_source(db, source_id)
+                if i > 0:
+                    await update_utils.update(
+                        db, source_id, files[0][1], logger=quietlogger()
+                    )
+                results.append(
+                    await run_scenario(db, source_id, *scenario, staging=True)
+                )
+        finally:
+            await reset_source(db, source_id)
+        return results
+
+    tr = db.transaction()
+    await tr.start()
+    try:
+        await reset_source(db, source_id)
+        results.append(await run_scenario(db, source_id, *files[0]))
+        for scenario in files[1:]:
+            sp = db.transaction()
+            await sp.start()
+            try:
+                results.append(await run_scenario(db, source_id, *scenario))
+            finally:
+                await sp.rollback()
+    finally:
+        await tr.rollback()
+
+    return results
+
+
+def bench_memory(generator: xml_generator, path: str) -> Dict[str, Any]:
+    """Measure the memory used to parse a file, without database.
+
+    The parsed records are kept as long as they would wait in a full queue
+    of the writer. Return the peak of the Python allocations, in MB.
+    """
+    fname, errors = generator.write_file(
+        os.path.join(path, "memory.xml"), timestamp="2020-01-01T00:00:00Z"
+    )
+    queue: deque = deque(maxlen=update_utils.RECORDS_QUEUE_SIZE)
+
+    tracemalloc.start()
+    t = time.perf_counter()
+    try:
+        parser = update_utils.sync_update_parser(BENCH_SOURCE_ID, queue.append)
+        with open(fname, "rb") as f:
+            for data in update_utils.read_chunks(f, fname):
+                parser.parse(data, False)
+        parser.parse(b"", True)
+        elapsed = time.perf_counter() - t
+        current, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+
+    return dict(
+        scenario="memory",
+        errors=errors,
+        seconds=round(elapsed, 3),
+        errors_per_second=round(errors / elapsed),
+        peak_traced_mb=round(peak / 1024 / 1024, 1),
+    )
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Benchmark the ingest of synthetic analyser results"
+    )
+    parser.add_argument("--classes", type=int, default=10)
+    parser.add_argument("--errors", type=int, default=100000)
+    parser.add_argument("--elems", type=int, default=2, help="elements per error")
+    parser.add_argument("--fixes", type=int, default=1, help="fixes per error")
+    parser.add_argument("--langs", type=int, default=2, help="translations")
+    parser.add_argument("--tags", type=int, default=2, help="tags per element")
+    parser.add_argument(
+        "--change",
+        type=float,
+        default=0.01,
+        help="ratio of changed, and of replaced, errors on re-upload",
+    )
+    parser.add_argument(
+        "--compression",
+        choices=tuple(compression.FORMATS) + ("none",),
+        default="bz2",
+    )
+    parser.add_argument("--source", type=int, default=BENCH_SOURCE_ID)
+    parser.add_argument(
+        "--staging",
+        action="store_true",
+        help="use the staging mode, the source data is committed",
+    )
+    parser.add_argument(
+        "--memory",
+        action="store_true",
+        help="only measure the memory used by the parser, without database",
+    )
+    parser.add_argument("--json", action="store_true", help="output JSON")
+    args = parser.parse_args()
+
+    generator = xml_generator(
+        args.classes, args.errors, args.elems, args.fixes, args.langs, args.tags
+    )
+    if args.memory:
+        with tempfile.TemporaryDirectory() as path:
+            r = bench_memory(generator, path)
+        if args.json:
+            print(json.dumps(r, indent=2))
+        else:
+            print(
+                f"{r['scenario']:<12} {r['errors']} errors in {r['seconds']}s, "
+                f"{r['errors_per_second']} errors/s, "
+                f"peak traced {r['peak_traced_mb']} MB"
+            )
+        return
+
+    db = await database.get_dbconn()
+    try:
+        with tempfile.TemporaryDirectory() as path:
+            results = await bench(
+                db,
+                generator,
+                path,
+                args.source,
+                args.change,
+                args.compression,
+                args.staging,
+            )
+    finally:
+        await db.close()
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    for r in results:
+        print(
+            f"{r['scenario']:<12} {r['errors']} errors in {r['seconds']}s, "
+            f"{r['errors_per_second']} errors/s, peak RSS {r['peak_rss_mb']} MB"
+        )
+        print("    rows: " + ", ".join(f"{k}={v}" for k, v in r["rows"].items()))
+        print("    timings: " + ", ".join(f"{k}={v}s" for k, v in r["timings"].items()))
+
+
+class Test(unittest.IsolatedAsyncioTestCase):
+    asyncSetUp = update_utils.Test.asyncSetUp
+    asyncTearDown = update_utils.Test.asyncTearDown
+
+    async def test_bench(self):
+        generator = xml_generator(classes=3, errors=200, elems=2, fixes=1, langs=2)
+        with tempfile.TemporaryDirectory() as path:
+            results = await bench(self.db, generator, path, source_id=1, change=0.1)
+
+        first, reupload, change = results
+        self.assertEqual(200, first["rows"]["inserted"])
+        self.assertEqual(
+            dict(inserted=20, updated=20, unchanged=160, deleted=20), reupload["rows"]
+        )
+        self.assertEqual(
+            dict(inserted=20, updated=20, unchanged=0, deleted=20), change["rows"]
+        )
+        # Rolled back
+        self.assertEqual(0, await self.db.fetchval("SELECT count(*) FROM markers"))
+
+    async def test_bench_staging(self):
+        generator = xml_generator(classes=3, errors=200, elems=2, fixes=1, langs=2)
+        with tempfile.TemporaryDirectory() as path:
+            results = await bench(
+                self.db, generator, path, source_id=1, change=0.1, staging=True
+            )
+
+        first, reupload, change = results
+        self.assertEqual(200, first["rows"]["inserted"])
+        self.assertEqual(
+            dict(inserted=20, updated=20, unchanged=160, deleted=20), reupload["rows"]
+        )
+        self.assertEqual(
+            dict(inserted=20, updated=20, unchanged=0, deleted=20), change["rows"]
+        )
+        # Cleaned
+        self.assertEqual(0, await self.db.fetchval("SELECT count(*) FROM markers"))
+
+    async def test_bench_memory(self):
+        generator = xml_generator(classes=3, errors=20, elems=50, fixes=1, tags=5)
+        with tempfile.TemporaryDirectory() as path:
+            r = bench_memory(generator, path)
+        self.assertEqual(20, r["errors"])
+        self.assertGreater(r["peak_traced_mb"], 0)
+
+    async def test_large_errors_chunks(self):
+        # Handed over by size, far before RECORDS_CHUNK_SIZE errors
+        generator = xml_generator(classes=1, errors=60, elems=1000, fixes=0, tags=10)
+        chunks: List[int] = []
+        with tempfile.TemporaryDirectory() as path:
+            fname, errors = generator.write_file(
+                os.path.join(path, "large.xml"), timestamp="2020-01-01T00:00:00Z"
+            )
+            parser = update_utils.sync_update_parser(
+                1, lambda records: chunks.append(len(records))
+            )
+            with open(fname, "rb") as f:
+                parser.parse(f.read(), True)
+        self.assertGreater(len(chunks), 1)
+        self.assertEqual(1 + 1 + errors + 1 + 1, sum(chunks))
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
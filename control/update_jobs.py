@@ -0,0 +1,337 @@
+import asyncio
+import fcntl
+import json
+import os
+import shutil
+import time
+import traceback
+from contextlib import contextmanager
+from dataclasses import asdict, dataclass, field
+from typing import (
+    Any,
+    Collection,
+    Dict,
+    Iterator,
+    List,
+    Literal,
+    Optional,
+    Set,
+    Tuple,
+    cast,
+)
+from uuid import uuid4
+
+from asyncpg import Connection, Pool, create_pool
+from fastapi import UploadFile
+from fastapi.concurrency import run_in_threadpool
+
+from modules import utils
+from modules.dependencies import database
+
+from . import update_utils
+
+JobStatus = Literal["queued", "running", "done", "failed"]
+
+# Seconds the status of the finished jobs is kept
+JOBS_RETENTION = 7 * 24 * 60 * 60
+
+# Seconds between the checks for the earlier jobs of a source
+JOBS_POLL = 1
+
+
+@dataclass
+class Job:
+    id: str
+    source_id: int
+    filename: str
+    remote_ip: Optional[str]
+    size: int
+    status: JobStatus = "queued"
+    error: Optional[str] = None
+    created: float = field(default_factory=time.time)
+    started: Optional[float] = None
+    ended: Optional[float] = None
+    # Process running the job
+    pid: int = field(default_factory=os.getpid)
+    # Submission order, shared by all the processes
+    seq: int = 0
+
+
+def _alive(pid: int) -> bool:
+    """Whether pid is a running process."""
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class UpdateJobs:
+    """Process the uploaded analyser results in background.
+
+    Uploads are spooled to disk, then loaded by at most `workers` concurrent
+    jobs, each on its own connection from a dedicated pool. The jobs of a same
+    source are run in submission order, also across the processes sharing the
+    directory. The jobs left unfinished by a stopped process are run again by
+    the next one to start or to wait for them.
+    """
+
+    pool: Optional[Pool] = None
+    semaphore: asyncio.Semaphore
+
+    def __init__(self, path: str, workers: int):
+        self.path = path
+        self.workers = workers
+        self.running: Dict[str, Tuple[Job, Any]] = {}
+        self.tasks: Dict[str, asyncio.Task] = {}
+
+    async def startup(self) -> None:
+        os.makedirs(self.path, exist_ok=True)
+        self.semaphore = asyncio.Semaphore(self.workers)
+        self.pool = await create_pool(
+            dsn=utils.db_dsn,
+            init=database.add_json_support,
+            min_size=0,
+            max_size=self.workers,
+        )
+        for job in self._recover(startup=True):
+            self.tasks[job.id] = asyncio.create_task(self._run(job))
+
+    async def shutdown(self) -> None:
+        tasks = list(self.tasks.values())
+        for task in tasks:
+            task.cancel()
+        # Let the jobs be rolled back before closing the pool
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if self.pool:
+            await self.pool.close()
+
+    def _upload_path(self, job_id: str) -> str:
+        return os.path.join(self.path, job_id + ".upload")
+
+    def _status_path(self, job_id: str) -> str:
+        return os.path.join(self.path, job_id + ".json")
+
+    @contextmanager
+    def _locked(self) -> Iterator[None]:
+        """Exclusive access to the directory among the processes."""
+        with open(os.path.join(self.path, "lock"), "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+
+    def _jobs(self, skip: Collection[str] = ()) -> Iterator[Job]:
+        """The jobs of all the processes, but the ids in skip."""
+        for name in os.listdir(self.path):
+            if name.endswith(".json") and name[: -len(".json")] not in skip:
+                try:
+                    with open(os.path.join(self.path, name)) as f:
+                        yield Job(**json.load(f))
+                except (OSError, ValueError, TypeError):
+                    continue
+
+    def _next_seq(self) -> int:
+        """Next submission number, to be called locked."""
+        path = os.path.join(self.path, "seq")
+        try:
+            with open(path) as f:
+                seq = int(f.read())
+        except (FileNotFoundError, ValueError):
+            seq = max((job.seq for job in self._jobs()), default=0)
+        seq += 1
+        with open(path + ".tmp", "w") as f:
+            f.write(str(seq))
+        os.replace(path + ".tmp", path)
+        return seq
+
+    def _recover(self, startup: bool = False) -> List[Job]:
+        """Forget about old jobs, take over the ones left unfinished by a
+        stopped process, and remove the uploads no longer to be loaded.
+
+        The directory can be shared by the jobs of other running processes.
+        The jobs of this process are only taken over on startup, from a
+        previous process of the same pid. Return the jobs to run again.
+        """
+        recovered = []
+        unfinished = set()
+        with self._locked():
+            for name in os.listdir(self.path):
+                path = os.path.join(self.path, name)
+                if (
+                    name.endswith(".json")
+                    and os.path.getmtime(path) < time.time() - JOBS_RETENTION
+                ):
+                    os.remove(path)
+
+            for job in self._jobs():
+                if job.status not in ("queued", "running"):
+                    continue
+                if (job.pid == os.getpid() and not startup) or (
+                    job.pid != os.getpid() and _alive(job.pid)
+                ):
+                    unfinished.add(job.id)
+                elif not os.path.exists(self._upload_path(job.id)):
+                    job.status = "failed"
+                    job.error = "Interrupted, upload lost"
+                    job.ended = time.time()
+                    self._save(job)
+                else:
+                    # Nothing was applied, it runs again from the start
+                    job.status = "queued"
+                    job.pid = os.getpid()
+                    job.started = None
+                    self._save(job)
+                    unfinished.add(job.id)
+                    recovered.append(job)
+
+            for name in os.listdir(self.path):
+                if (
+                    name.endswith(".upload")
+                    and name[: -len(".upload")] not in unfinished
+                ):
+                    os.remove(os.path.join(self.path, name))
+
+        return recovered
+
+    def _save(self, job: Job) -> None:
+        tmp = self._status_path(job.id) + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(asdict(job), f)
+        os.replace(tmp, self._status_path(job.id))
+
+    async def submit(
+        self, source_id: int, content: UploadFile, remote_ip: Optional[str]
+    ) -> Job:
+        job = Job(
+            id=uuid4().hex,
+            source_id=source_id,
+            filename=content.filename or "",
+            remote_ip=remote_ip,
+            size=0,
+        )
+
+        def spool() -> int:
+            content.file.seek(0)
+            with open(self._upload_path(job.id), "wb") as f:
+                shutil.copyfileobj(content.file, f)
+                return f.tell()
+
+        # Saved first, for the upload to be kept by the other processes
+        with self._locked():
+            job.seq = self._next_seq()
+            self._save(job)
+        try:
+            job.size = await run_in_threadpool(spool)
+        except BaseException:
+            os.remove(self._status_path(job.id))
+            if os.path.exists(self._upload_path(job.id)):
+                os.remove(self._upload_path(job.id))
+            raise
+        self._save(job)
+        self.tasks[job.id] = asyncio.create_task(self._run(job))
+        return job
+
+    def status(self, job_id: str) -> Optional[Dict[str, Any]]:
+        if job_id in self.running:
+            job, f = self.running[job_id]
+            status = asdict(job)
+            if not f.closed:
+                status["read"] = f.tell()
+            return status
+
+        try:
+            with open(self._status_path(job_id)) as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+
+    async def _turn(self, job: Job) -> None:
+        """Wait for the earlier jobs of the source, of any process."""
+        finished: Set[str] = set()
+        while True:
+            earlier = []
+            for other in self._jobs(finished):
+                if other.status not in ("queued", "running"):
+                    finished.add(other.id)
+                elif other.source_id == job.source_id and other.seq < job.seq:
+                    earlier.append(other)
+            if not earlier:
+                return
+
+            if any(
+                other.pid != os.getpid() and not _alive(other.pid) for other in earlier
+            ):
+                for recovered in self._recover():
+                    self.tasks[recovered.id] = asyncio.create_task(self._run(recovered))
+            else:
+                await asyncio.sleep(JOBS_POLL)
+
+    async def _run(self, job: Job) -> None:
+        try:
+            await self._turn(job)
+            async with self.semaphore:
+                await self._process(job)
+        finally:
+            del self.tasks[job.id]
+
+    async def _process(self, job: Job) -> None:
+        assert self.pool
+        job.status = "running"
+        job.started = time.time()
+        self._save(job)
+        try:
+            with open(self._upload_path(job.id), "rb") as f:
+                self.running[job.id] = (job, f)
+                async with self.pool.acquire() as db:
+                    if utils.update_staging:
+                        await update_utils.update(
+                            cast(Connection, db),
+                            job.source_id,
+                            job.filename,
+                            remote_ip=job.remote_ip,
+                            fileobj=f,
+                            staging=True,
+                        )
+                    else:
+                        async with db.transaction():
+                            await update_utils.update(
+                                cast(Connection, db),
+                                job.source_id,
+                                job.filename,
+                                remote_ip=job.remote_ip,
+                                fileobj=f,
+                            )
+            job.status = "done"
+        except asyncio.CancelledError:
+            # Rolled back, left to be run again with its upload
+            job.status = "queued"
+            job.started = None
+            raise
+        except update_utils.OsmoseUpdateAlreadyDone:
+            job.status = "failed"
+            job.error = "Already up to date"
+        except Exception:
+            job.status = "failed"
+            job.error = traceback.format_exc().rstrip()
+            print(job.error)
+        finally:
+            self.running.pop(job.id, None)
+            if job.status != "queued":
+                job.ended = time.time()
+                os.remove(self._upload_path(job.id))
+            self._save(job)
+
+
+jobs = UpdateJobs(utils.update_jobs_dir, utils.update_jobs_workers)
+
+
+async def startup() -> None:
+    await jobs.startup()
+
+
+async def shutdown() -> None:
+    await jobs.shutdown()
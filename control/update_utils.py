@@ -1,112 +1,349 @@
+import argparse
 import asyncio
 import bz2
+import contextlib
 import gzip
+import hashlib
+import json
+import os
 import sys
+import tempfile
+import threading
 import time
 import unittest
 import xml.parsers.expat
-from typing import Any, Dict, List, Optional
+from collections import Counter, defaultdict
+from typing import (
+    IO,
+    Any,
+    Awaitable,
+    Callable,
+    Dict,
+    Iterator,
+    List,
+    Optional,
+    Tuple,
+    cast,
+)
+from uuid import UUID
 
 import dateutil.parser
-from asyncpg import Connection
+from asyncpg import Connection, Pool, Record, create_pool
+from asyncpg.exceptions import LockNotAvailableError
 
-from modules import query_meta, utils
+from modules import compression, query_meta, utils
 from modules.dependencies import database
 
-Elem = Dict[str, Any]
-Fix = Elem
+# An issue element, or fix, already encoded as its jsonb value
+Elem = bytes
+Fix = bytes
 
 show = utils.show
 
+# Size of the compressed chunks read from the uploaded files
+READ_CHUNK_SIZE = 256 * 1024
+# Number of markers_tmp rows sent by each COPY
+COPY_BATCH_SIZE = 10000
+# Number of parsed records handed to the writer at once
+RECORDS_CHUNK_SIZE = 1000
+# Size of the encoded elements and fixes from which records are handed over
+RECORDS_CHUNK_BYTES = 4 * 1024 * 1024
+# Number of record chunks waiting for the writer before the parser blocks
+RECORDS_QUEUE_SIZE = 16
+# First key of the advisory locks serializing the updates of each source
+UPDATE_LOCK_ID = 0x4F534D
+# Number of markers from which a source gets its own markers partitions
+PARTITION_MIN_MARKERS = 10000
+# Longest wait on the markers locks when moving a source to its partitions
+PARTITION_LOCK_TIMEOUT = "5s"
+
 
 class printlogger:
     def log(self, text: str) -> None:
         print(text)
 
 
+class update_stats:
+    """Time spent by phase, in seconds, and markers touched by an update."""
+
+    def __init__(self) -> None:
+        self.timings: Dict[str, float] = defaultdict(float)
+        # inserted, updated, unchanged and deleted markers
+        self.rows: Counter = Counter()
+        # Same by class, only on dry runs
+        self.classes: Dict[int, Counter] = defaultdict(Counter)
+
+    @contextlib.contextmanager
+    def timing(self, phase: str) -> Iterator[None]:
+        t = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[phase] += time.perf_counter() - t
+
+    def as_dict(self) -> Dict[str, Any]:
+        d = dict(
+            timings={k: round(v, 3) for k, v in self.timings.items()},
+            rows=dict(self.rows),
+        )
+        if self.classes:
+            d["classes"] = {k: dict(v) for k, v in sorted(self.classes.items())}
+        return d
+
+
 class OsmoseUpdateAlreadyDone(Exception):
     pass
 
 
+class OsmoseUpdateCancelled(Exception):
+    pass
+
+
+class stream_decompressor:
+    """Incremental decompressor, also supporting concatenated streams."""
+
+    def __init__(self, factory: Callable[[], Any]):
+        self.factory = factory
+        self.decompressor = factory()
+        self.pending = False
+
+    def decompress(self, data: bytes) -> bytes:
+        out = []
+        while data:
+            out.append(self.decompressor.decompress(data))
+            if self.decompressor.eof:
+                data = self.decompressor.unused_data
+                self.decompressor = self.factory()
+                self.pending = False
+            else:
+                data = b""
+                self.pending = True
+        return b"".join(out)
+
+    def end(self) -> None:
+        if self.pending:
+            raise EOFError(
+                "Compressed file ended before the end-of-stream marker was reached"
+            )
+
+
+def get_decompressor(fname: str, head: bytes = b"") -> Optional[stream_decompressor]:
+    format = compression.guess_format(fname, head)
+    if format is None:
+        return None
+    return stream_decompressor(lambda: compression.decompressobj(format))
+
+
+def read_chunks(f: IO[bytes], fname: str) -> Iterator[bytes]:
+    """Read f by chunks and decompress it according to the fname extension, or
+    else to its first bytes."""
+    data = f.read(READ_CHUNK_SIZE)
+    decompressor = get_decompressor(fname, data)
+    while data:
+        if decompressor:
+            data = decompressor.decompress(data)
+        if data:
+            yield data
+        data = f.read(READ_CHUNK_SIZE)
+    if decompressor:
+        decompressor.end()
+
+
 async def update(
     db: Connection,
     source_id: int,
     fname: str,
     logger: printlogger = printlogger(),
     remote_ip: Optional[str] = None,
-) -> None:
-    q: asyncio.Queue = asyncio.Queue()
-
-    async def sync_parser_task():
-        #  xml parser
-        u = sync_update_parser(q)
+    copy_batch_size: int = COPY_BATCH_SIZE,
+    fileobj: Optional[IO[bytes]] = None,
+    staging: bool = False,
+    dry_run: bool = False,
+) -> update_stats:
+    """Load an analyser result into the database.
+
+    The content is read from fileobj when given, otherwise from the file
+    fname. In both cases the compression is guessed from the fname extension.
+    The returned timings and row counts are also stored on the updates row.
+
+    By default everything runs in the caller transaction. In staging mode, db
+    must not be in a transaction: the upload is prepared in temp tables, then
+    applied to the shared tables in a single short transaction.
+
+    A dry run applies the update like in staging mode, in a transaction or a
+    savepoint rolled back at the end, and counts the changes by class. It can
+    run in a transaction or not. The update itself is not recorded.
+    """
+    if dry_run:
+        # Rolled back, to drop the temp tables
+        tr = db.transaction()
+        await tr.start()
+        try:
+            return await _update(
+                db,
+                source_id,
+                fname,
+                logger,
+                remote_ip,
+                copy_batch_size,
+                fileobj,
+                True,
+                True,
+            )
+        finally:
+            await tr.rollback()
 
-        #  open the file
-        if fname.endswith(".bz2"):
-            f = bz2.BZ2File(fname)
-        elif fname.endswith(".gz"):
-            f = gzip.open(fname)
-        else:
-            f = open(fname)
+    if not staging:
+        if db.is_in_transaction():
+            await db.execute(
+                "SELECT pg_advisory_xact_lock($1, $2)", UPDATE_LOCK_ID, source_id
+            )
+        return await _update(
+            db, source_id, fname, logger, remote_ip, copy_batch_size, fileobj
+        )
 
-        #  parse the file
-        while True:
-            if q.qsize() > 10000:
-                await asyncio.sleep(1.0)  # Let async_parser_task get from the queue
-            else:
-                data = f.read(1024 * 1024)
-                if data:
-                    u.parse(data, False)
-                    await asyncio.sleep(
-                        0.0
-                    )  # Let async_parser_task a chance to get from the queue
-                else:
-                    u.parse("", True)
-                    break
+    assert not db.is_in_transaction()
+    await db.execute("SELECT pg_advisory_lock($1, $2)", UPDATE_LOCK_ID, source_id)
+    try:
+        return await _update(
+            db, source_id, fname, logger, remote_ip, copy_batch_size, fileobj, True
+        )
+    finally:
+        await db.execute("DISCARD TEMP")
+        await db.execute("SELECT pg_advisory_unlock($1, $2)", UPDATE_LOCK_ID, source_id)
 
-        #  close and delete
-        f.close()
-        del f
 
-    async def async_parser_task():
-        await async_update_parser(source_id, fname, remote_ip, db).parse(q)
+async def _update(
+    db: Connection,
+    source_id: int,
+    fname: str,
+    logger: printlogger,
+    remote_ip: Optional[str],
+    copy_batch_size: int,
+    fileobj: Optional[IO[bytes]],
+    staging: bool = False,
+    dry_run: bool = False,
+) -> update_stats:
+    stats = update_stats()
+    start = time.perf_counter()
+    loop = asyncio.get_running_loop()
+    q: asyncio.Queue = asyncio.Queue(maxsize=RECORDS_QUEUE_SIZE)
+    stop = threading.Event()
+
+    def put(records: List[Tuple[Any, ...]]) -> None:
+        # Block the parser thread until the writer makes room in the queue
+        if stop.is_set():
+            raise OsmoseUpdateCancelled()
+        t = time.perf_counter()
+        asyncio.run_coroutine_threadsafe(q.put(records), loop).result()
+        # Called while parsing, only account the wait once
+        wait = time.perf_counter() - t
+        stats.timings["parse_wait"] += wait
+        stats.timings["parse"] -= wait
+
+    def sync_parser_task() -> None:
+        #  xml parser
+        u = sync_update_parser(source_id, put)
+
+        def parse(f: IO[bytes]) -> None:
+            chunks = read_chunks(f, fname)
+            while True:
+                with stats.timing("decompress"):
+                    data = next(chunks, None)
+                if data is None:
+                    break
+                with stats.timing("parse"):
+                    u.parse(data, False)
+            with stats.timing("parse"):
+                u.parse(b"", True)
 
-    tasks = [
-        asyncio.create_task(sync_parser_task()),
-        asyncio.create_task(async_parser_task()),
-    ]
-    done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+        #  parse the file, decompressed on the fly
+        if fileobj:
+            parse(fileobj)
+        else:
+            with open(fname, "rb") as f:
+                parse(f)
 
-    for task in pending:
-        task.cancel()
+    u = async_update_parser(
+        source_id,
+        fname,
+        remote_ip,
+        db,
+        copy_batch_size,
+        logger,
+        stats,
+        staging,
+        dry_run,
+    )
 
-    if not tasks[0].cancelled():
-        try:
-            tasks[0].result()
-        except asyncio.InvalidStateError:
-            pass
-    if not tasks[1].cancelled():
-        try:
-            tasks[1].result()
-        except asyncio.InvalidStateError:
-            pass
+    async def async_parser_task() -> None:
+        await u.parse(q)
+
+    parser = asyncio.ensure_future(loop.run_in_executor(None, sync_parser_task))
+    writer = asyncio.create_task(async_parser_task())
+    try:
+        await asyncio.wait([parser, writer], return_when=asyncio.FIRST_EXCEPTION)
+    finally:
+        if not writer.done():
+            writer.cancel()
+            await asyncio.wait([writer])
+        if not parser.done():
+            # Unblock the parser thread and wait for it to stop
+            stop.set()
+            while not q.empty():
+                q.get_nowait()
+            await asyncio.wait([parser])
+
+    if not writer.cancelled():
+        writer.result()
+    parser.result()
+
+    if staging:
+        with stats.timing("apply"):
+            async with db.transaction():
+                if dry_run:
+                    # Not concurrently with an actual update of the source
+                    await db.execute(
+                        "SELECT pg_advisory_xact_lock($1, $2)",
+                        UPDATE_LOCK_ID,
+                        source_id,
+                    )
+                await apply_update(db, source_id, u)
+    else:
+        await apply_update(db, source_id, u)
 
-    #  update subtitle from new errors
-    await db.execute(
-        """
+    stats.timings["total"] = time.perf_counter() - start
+    if u.update_ts is not None:
+        await db.execute(
+            """
 UPDATE
-  markers_status
+    updates
 SET
-  subtitle = markers.subtitle
-FROM
-  markers
+    stats = $3
 WHERE
-  markers.source_id = $1 AND
-  markers_status.item = markers.item AND
-  markers_status.uuid = markers.uuid
+    source_id = $1 AND
+    timestamp = to_timestamp($2)
 """,
-        source_id,
-    )
+            source_id,
+            u.update_ts,
+            stats.as_dict(),
+        )
+        logger.log(f"source={source_id} {stats.as_dict()}")
+    elif dry_run:
+        logger.log(f"source={source_id} dry run {stats.as_dict()}")
+
+    return stats
+
+
+async def apply_update(
+    db: Connection,
+    source_id: int,
+    u: "async_update_parser",
+) -> None:
+    """Apply the pending changes, then the post-update maintenance."""
+    stats = u.stats
+    for change in u.pending:
+        await change()
 
     #     #  remove false positive no longer present
     #     await db.execute(
@@ -131,43 +368,195 @@ WHERE
     #         source_id,
     #     )
 
-    await db.execute(
+    with stats.timing("counts"):
+        await table_update_markers_counts(db, source_id, u.counts)
+
+
+async def table_create_partition(
+    _db: Connection,
+    _source_id: int,
+    min_markers: int = PARTITION_MIN_MARKERS,
+) -> bool:
+    """Move a source having at least min_markers to its own partitions.
+
+    The smaller sources stay in the default partitions, to keep the number of
+    partitions to plan on the queries not filtered by source reasonable.
+    Attaching a partition locks markers, so it should not be done in a long
+    transaction. Return whether the partitions have been created.
+    """
+    if await _db.fetchval(
+        "SELECT to_regclass($1) IS NOT NULL", f"markers_source_{_source_id}"
+    ):
+        return False
+
+    count = await _db.fetchval(
+        "SELECT sum(count) FROM markers_counts WHERE source_id = $1", _source_id
+    )
+    if (count or 0) < min_markers:
+        return False
+
+    await _db.execute("SELECT source_partition_create($1)", _source_id)
+    return True
+
+
+async def table_create_partitions(
+    _db: Connection,
+    min_markers: int = PARTITION_MIN_MARKERS,
+    lock_timeout: str = PARTITION_LOCK_TIMEOUT,
+) -> List[int]:
+    """Move the sources having at least min_markers to their own partitions.
+
+    A maintenance step, to run off-peak and out of a transaction. Each source
+    is moved in a transaction of its own. The sources being updated, or whose
+    partitions cannot be locked within lock_timeout, are left for the next run.
+    Return the moved sources.
+    """
+    source_ids = await _db.fetch(
         """
-DELETE FROM
-  markers
-USING
-  markers_status
-WHERE
-  markers.source_id = $1 AND
-  markers_status.uuid = markers.uuid
+SELECT
+    source_id
+FROM
+    markers_counts
+GROUP BY
+    source_id
+HAVING
+    sum(count) >= $1
+ORDER BY
+    source_id
 """,
-        source_id,
+        min_markers,
     )
 
-    await db.execute(
+    moved = []
+    for (source_id,) in source_ids:
+        try:
+            async with _db.transaction():
+                await _db.execute(
+                    "SELECT set_config('lock_timeout', $1, true)", lock_timeout
+                )
+                if not await _db.fetchval(
+                    "SELECT pg_try_advisory_xact_lock($1, $2)",
+                    UPDATE_LOCK_ID,
+                    source_id,
+                ):
+                    continue
+                if await table_create_partition(_db, source_id, min_markers):
+                    moved.append(source_id)
+        except LockNotAvailableError:
+            continue
+    return moved
+
+
+async def table_update_markers_counts(
+    _db: Connection,
+    _source_id: int,
+    counts: Counter,
+) -> None:
+    """Apply the per class variation of the number of markers."""
+    counts = Counter({k: v for k, v in counts.items() if v != 0})
+    if not counts:
+        return
+
+    await _db.execute(
         """
 UPDATE
     markers_counts
 SET
-    count = (
-        SELECT
-            count(*)
-        FROM
-            markers
-        WHERE
-            markers.source_id = markers_counts.source_id AND
-            markers.class = markers_counts.class
+    count = coalesce(markers_counts.count, 0) + delta.count
+FROM
+    unnest($2::integer[], $3::integer[]) AS delta(class, count)
+WHERE
+    markers_counts.source_id = $1 AND
+    markers_counts.class = delta.class
+""",
+        _source_id,
+        list(counts.keys()),
+        list(counts.values()),
     )
+
+
+async def markers_counts_drift(
+    _db: Connection,
+    source_id: Optional[int] = None,
+    fix: bool = False,
+) -> List[Record]:
+    """Compare markers_counts with the actual number of markers.
+
+    Return the drifting classes, and reset their count when fix is set. The
+    drift is added to the counts, rather than the counts replaced, to keep
+    the changes committed meanwhile.
+    """
+    drift = await _db.fetch(
+        """
+SELECT
+    markers_counts.source_id,
+    markers_counts.class,
+    markers_counts.count,
+    count(markers.uuid) AS actual
+FROM
+    markers_counts
+    LEFT JOIN markers ON
+        markers.source_id = markers_counts.source_id AND
+        markers.class = markers_counts.class
 WHERE
-    markers_counts.source_id = $1
+    $1::integer IS NULL OR markers_counts.source_id = $1
+GROUP BY
+    markers_counts.source_id,
+    markers_counts.class,
+    markers_counts.count
+HAVING
+    markers_counts.count IS DISTINCT FROM count(markers.uuid)
+ORDER BY
+    markers_counts.source_id,
+    markers_counts.class
 """,
         source_id,
     )
 
+    if fix and drift:
+        await _db.execute(
+            """
+UPDATE
+    markers_counts
+SET
+    count = coalesce(markers_counts.count, 0) + delta.count
+FROM
+    unnest($1::integer[], $2::integer[], $3::integer[]) AS delta(source_id, class, count)
+WHERE
+    markers_counts.source_id = delta.source_id AND
+    markers_counts.class = delta.class
+""",
+            [d["source_id"] for d in drift],
+            [d["class"] for d in drift],
+            [d["actual"] - (d["count"] or 0) for d in drift],
+        )
+
+    return drift
+
+
+def class_fingerprint(
+    title: Dict[str, str],
+    level: int,
+    tags: List[str],
+    detail: Optional[Dict[str, str]],
+    fix: Optional[Dict[str, str]],
+    trap: Optional[Dict[str, str]],
+    example: Optional[Dict[str, str]],
+    source: Optional[str],
+    resource: Optional[str],
+) -> bytes:
+    """Digest of the class metadata, to skip the unchanged classes."""
+    return hashlib.sha256(
+        json.dumps(
+            [title, level, tags, detail, fix, trap, example, source, resource],
+            sort_keys=True,
+            separators=(",", ":"),
+        ).encode("utf-8")
+    ).digest()[0:16]
+
 
 async def update_class(
     _db: Connection,
-    _source_id: int,
     _class_id: int,
     _class_item: int,
     _class_title: Dict[str, str],
@@ -179,10 +568,15 @@ async def update_class(
     _class_example: Optional[Dict[str, str]],
     _class_source: Optional[str],
     _class_resource: Optional[str],
+    _fingerprint: bytes,
     ts: float,
+    suffix: str = "",
 ) -> None:
     await _db.execute(
-        "INSERT INTO class_tmp VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11, to_timestamp($12))",
+        f"""
+INSERT INTO class_tmp{suffix}
+VALUES ($1, $2, $3, $4, $5, $6, $7, $8, $9, $10, $11, to_timestamp($12), $13)
+""",
         _class_id,  # $1 class
         _class_item,  # $2 item
         _class_title,  # $3 title
@@ -195,10 +589,19 @@ async def update_class(
         _class_source or None,  # $10 source
         _class_resource or None,  # $11 resource
         ts,  # $12 timestamp
+        _fingerprint,  # $13 fingerprint
     )
 
+
+async def update_class_count(
+    _db: Connection,
+    _source_id: int,
+    _class_id: int,
+    _class_item: int,
+    suffix: str = "",
+) -> None:
     await _db.execute(
-        "INSERT INTO markers_counts_tmp VALUES ($1, $2, $3)",
+        f"INSERT INTO markers_counts_tmp{suffix} VALUES ($1, $2, $3)",
         _source_id,  # $1 source
         _class_id,  # $2 class
         _class_item,  # $3 item
@@ -207,14 +610,18 @@ async def update_class(
 
 async def table_merge_class_tmp(
     _db: Connection,
+    suffix: str = "",
 ) -> None:
     await _db.execute(
-        """
-INSERT INTO class (class, item, title, level, tags, detail, fix, trap, example, source, resource, timestamp)
+        f"""
+INSERT INTO class (
+    class, item, title, level, tags, detail, fix, trap, example, source, resource,
+    timestamp, fingerprint
+)
 SELECT
     *
 FROM
-    class_tmp
+    class_tmp{suffix}
 ON CONFLICT (item, class) DO
 UPDATE SET
         title = excluded.title,
@@ -226,33 +633,24 @@ UPDATE SET
         example = excluded.example,
         source = excluded.source,
         resource = excluded.resource,
-        timestamp = excluded.timestamp
+        timestamp = excluded.timestamp,
+        fingerprint = excluded.fingerprint
 WHERE
     class.class = excluded.class AND
     class.item = excluded.item AND
     class.timestamp < excluded.timestamp AND
-    (
-        class.title IS DISTINCT FROM excluded.title OR
-        class.level IS DISTINCT FROM excluded.level OR
-        class.tags IS DISTINCT FROM excluded.tags OR
-        class.detail IS DISTINCT FROM excluded.detail OR
-        class.fix IS DISTINCT FROM excluded.fix OR
-        class.trap IS DISTINCT FROM excluded.trap OR
-        class.example IS DISTINCT FROM excluded.example OR
-        class.source IS DISTINCT FROM excluded.source OR
-        class.resource IS DISTINCT FROM excluded.resource
-    )
+    class.fingerprint IS DISTINCT FROM excluded.fingerprint
 """
     )
-    await _db.execute("DROP TABLE class_tmp")
+    await _db.execute(f"DROP TABLE class_tmp{suffix}")
 
     await _db.execute(
-        """
+        f"""
 INSERT INTO markers_counts (source_id, class, item)
 SELECT
     *
 FROM
-    markers_counts_tmp
+    markers_counts_tmp{suffix}
 ON CONFLICT (source_id, class) DO
 UPDATE SET
     item = excluded.item
@@ -261,15 +659,16 @@ WHERE
     markers_counts.class = excluded.class
 """
     )
-    await _db.execute("DROP TABLE markers_counts_tmp")
+    await _db.execute(f"DROP TABLE markers_counts_tmp{suffix}")
 
 
 async def table_create_tmp(
     _db: Connection,
+    suffix: str = "",
 ) -> None:
     await _db.execute(
-        """
-CREATE TEMP TABLE class_tmp (
+        f"""
+CREATE TEMP TABLE class_tmp{suffix} (
     class integer NOT NULL,
     item integer NOT NULL,
     title jsonb,
@@ -281,14 +680,15 @@ CREATE TEMP TABLE class_tmp (
     example jsonb,
     source text,
     resource text,
-    timestamp timestamp without time zone
+    timestamp timestamp without time zone,
+    fingerprint bytea
 )
 """
     )
 
     await _db.execute(
-        """
-CREATE TEMP TABLE markers_counts_tmp (
+        f"""
+CREATE TEMP TABLE markers_counts_tmp{suffix} (
     source_id integer,
     class integer NOT NULL,
     item integer
@@ -297,170 +697,452 @@ CREATE TEMP TABLE markers_counts_tmp (
     )
 
     await _db.execute(
-        """
-CREATE TEMP TABLE markers_tmp (
+        f"""
+CREATE TEMP TABLE markers_tmp{suffix} (
+    uuid uuid NOT NULL,
     source_id integer NOT NULL,
     class integer NOT NULL,
-    class_sub bigint NOT NULL,
-    elems_sig text NOT NULL,
     item integer NOT NULL,
     lat numeric(9,7) NOT NULL,
     lon numeric(10,7) NOT NULL,
     elems jsonb[],
     fixes jsonb[],
-    subtitle jsonb
+    subtitle jsonb,
+    digest bytea NOT NULL
 )
 """
     )
 
 
+class markers_tmp_copy:
+    """Buffer markers_tmp rows and write them by batch with a binary COPY."""
+
+    columns = (
+        "uuid",
+        "source_id",
+        "class",
+        "item",
+        "lat",
+        "lon",
+        "elems",
+        "fixes",
+        "subtitle",
+        "digest",
+    )
+
+    def __init__(
+        self,
+        db: Connection,
+        batch_size: int = COPY_BATCH_SIZE,
+        stats: Optional[update_stats] = None,
+        table: str = "markers_tmp",
+    ):
+        self._db = db
+        self.table = table
+        self.batch_size = batch_size
+        self.stats = stats or update_stats()
+        self.records: List[Tuple[Any, ...]] = []
+
+    async def append(self, record: Tuple[Any, ...]) -> None:
+        self.records.append(record)
+        if len(self.records) >= self.batch_size:
+            await self.flush()
+
+    async def flush(self) -> None:
+        if self.records:
+            with self.stats.timing("tmp_insert"):
+                await self._db.copy_records_to_table(
+                    self.table, records=self.records, columns=self.columns
+                )
+            self.records = []
+
+
+def marker_uuid(source_id: int, class_id: int, class_sub: int, elems_sig: str) -> UUID:
+    """Stable identifier of an issue, the same across the updates."""
+    return UUID(
+        bytes=hashlib.sha256(
+            f"{source_id}/{class_id}/{class_sub}/{elems_sig}".encode("utf-8")
+        ).digest()[0:16]
+    )
+
+
+def json_encode(value: Any) -> bytes:
+    """Canonical JSON encoding, the one the marker digests are made of."""
+    return json.dumps(value, sort_keys=True, separators=(",", ":")).encode("utf-8")
+
+
+def elem_json(
+    type: str, id: Optional[str], user: Optional[str], tags: Dict[str, str]
+) -> Optional[Elem]:
+    """Encode an issue element, only with its non-empty properties."""
+    if type in ("node", "way", "relation"):
+        elem: Dict[str, Any] = {"type": type[0].upper(), "id": int(id or 0)}
+    elif type == "infos":
+        elem = {}
+    else:
+        return None
+    if tags:
+        elem["tags"] = tags
+    if user:
+        elem["username"] = user
+    return json_encode({k: v for k, v in elem.items() if v}) if elem else None
+
+
+def fix_elem_json(
+    type: str,
+    id: Optional[str],
+    create: Dict[str, str],
+    modify: Dict[str, str],
+    delete: List[str],
+) -> Optional[bytes]:
+    """Encode an element of a fix, only with its non-empty properties."""
+    if type not in ("node", "way", "relation"):
+        return None
+    fix = {
+        "type": type[0].upper(),
+        "id": int(id or 0),
+        "create": create,
+        "modify": modify,
+        "delete": delete,
+    }
+    return json_encode({k: v for k, v in fix.items() if v})
+
+
+def json_list(parts: List[bytes]) -> bytes:
+    """Encode the list of the encoded values parts."""
+    return b"[" + b",".join(parts) + b"]"
+
+
+def marker_locations(
+    item: int,
+    locations: List[Dict[str, str]],
+    elems: List[Elem],
+    fixes: List[Fix],
+    texts: bytes,
+) -> List[Tuple[float, float, bytes]]:
+    """Coordinates of each location of an issue, with the digest of the
+    marker content at that location.
+
+    The digest is the one of the canonical JSON of [item, elems, fixes,
+    texts], built from the parts already encoded.
+    """
+    content = hashlib.sha256(b"[%d," % item)
+    for parts in (elems, fixes):
+        if parts:
+            content.update(b"[")
+            for i, part in enumerate(parts):
+                if i:
+                    content.update(b",")
+                content.update(part)
+            content.update(b"],")
+        else:
+            content.update(b"null,")
+    content.update(texts)
+    content.update(b"]")
+
+    r = []
+    for location in locations:
+        lat = float(location["lat"])
+        lon = float(location["lon"])
+        digest = content.copy()
+        digest.update(f"/{lat:.7f}/{lon:.7f}".encode("utf-8"))
+        r.append((lat, lon, digest.digest()[0:16]))
+    return r
+
+
 async def update_issue(
-    _db: Connection,
-    _error_locations: List[Dict[str, str]],
+    _markers_tmp: markers_tmp_copy,
+    _error_locations: List[Tuple[float, float, bytes]],
+    _uuid: UUID,
     _source_id: int,
     _class_id: int,
-    _class_sub: int,
     _class_item: int,
-    _error_elements: List[Elem],
-    elems: List[Optional[Elem]],
-    fixes: List[List[Fix]],
-    _error_texts: Optional[Dict[str, str]],
+    elems: List[Elem],
+    fixes: List[Fix],
+    _error_texts: bytes,
 ) -> None:
-    #  sql template
-    sql_marker = """
-INSERT INTO markers_tmp VALUES (
-    $1, $2, $3, $4, $5, $6, $7,
-    (SELECT array_agg(j) FROM jsonb_array_elements($8::jsonb) AS t(j)),
-    (SELECT array_agg(j) FROM jsonb_array_elements($9::jsonb) AS t(j)),
-    $10
-)"""
-
-    for location in _error_locations:
-        lat = float(location["lat"])
-        lon = float(location["lon"])
-        params = [
-            _source_id,  # $1 source
-            _class_id,  # $2 class
-            _class_sub,  # $3 subclass
-            "_".join(
-                map(
-                    lambda elem: elem["type"] + str(elem["id"]),
-                    _error_elements,
-                )
-            ),  # $4 elems_sig
-            _class_item,  # $5 item
-            lat,  # $6 lat
-            lon,  # $7 lon
-            elems if elems else None,  # $8 elems
-            fixes if fixes else None,  # $9 fixes
-            _error_texts,  # $10 subtitle
-        ]
-        await _db.execute(sql_marker, *params)
+    # The encoded elems, fixes and texts are sent as is as jsonb, each fix
+    # as a jsonb value of the jsonb[] array.
+    for lat, lon, digest in _error_locations:
+        await _markers_tmp.append(
+            (
+                _uuid,  # uuid
+                _source_id,  # source
+                _class_id,  # class
+                _class_item,  # item
+                lat,  # lat
+                lon,  # lon
+                elems or None,  # elems
+                fixes or None,  # fixes
+                _error_texts,  # subtitle
+                digest,  # digest
+            )
+        )
 
 
 async def table_merge_markers_tmp(
     _db: Connection,
-    all_uuid: Optional[Dict[int, List[str]]],
-) -> None:
-    uuid = """('{' ||
-        encode(substring(digest(
-            source_id::int ||
-            '/' ||
-            class::int ||
-            '/' ||
-            class_sub::bigint ||
-            '/' ||
-            elems_sig, 'sha256'
-        ) from 1 for 16), 'hex') ||
-    '}')::uuid"""
-
+    suffix: str = "",
+) -> Tuple[Counter, Counter, Counter]:
+    """Upsert markers_tmp into markers.
+
+    The issues with a status stay out of markers, only their subtitle is
+    updated in markers_status.
+
+    Return by class the inserted, updated and unchanged markers. The issues
+    with a status are counted as unchanged.
+    """
+    # An error on many locations is only kept once, as all share the same uuid,
+    # always on the same location for its digest to be stable
     sql_marker = f"""
-INSERT INTO markers (uuid, source_id, class, item, lat, lon, elems, fixes, subtitle)
+WITH tmp AS (
+SELECT DISTINCT ON (uuid)
+    uuid, source_id, class, item, lat, lon, elems, fixes, subtitle, digest
+FROM
+    markers_tmp{suffix}
+ORDER BY
+    uuid,
+    lat,
+    lon
+), status AS (
+UPDATE
+    markers_status
+SET
+    subtitle = tmp.subtitle
+FROM
+    tmp
+WHERE
+    markers_status.source_id = tmp.source_id AND
+    markers_status.uuid = tmp.uuid AND
+    markers_status.item = tmp.item AND
+    markers_status.subtitle IS DISTINCT FROM tmp.subtitle
+), merged AS (
+INSERT INTO markers (uuid, source_id, class, item, lat, lon, elems, fixes, subtitle, digest)
 SELECT
-    {uuid} AS uuid,
-    source_id, class, item, lat, lon, elems, fixes, subtitle
+    *
 FROM
-    markers_tmp
-ON CONFLICT (uuid) DO
+    tmp
+WHERE
+    NOT EXISTS (
+        SELECT 1
+        FROM markers_status
+        WHERE markers_status.source_id = tmp.source_id AND markers_status.uuid = tmp.uuid
+    )
+ON CONFLICT (source_id, uuid) DO
 UPDATE SET
     item = excluded.item,
     lat = excluded.lat,
     lon = excluded.lon,
     elems = excluded.elems,
     fixes = excluded.fixes,
-    subtitle = excluded.subtitle
+    subtitle = excluded.subtitle,
+    digest = excluded.digest
 WHERE
     markers.uuid = excluded.uuid AND
     markers.source_id = excluded.source_id AND
     markers.class = excluded.class AND
-    (
-        markers.item IS DISTINCT FROM excluded.item OR
-        markers.lat IS DISTINCT FROM excluded.lat OR
-        markers.lon IS DISTINCT FROM excluded.lon OR
-        markers.elems IS DISTINCT FROM excluded.elems OR
-        markers.fixes IS DISTINCT FROM excluded.fixes OR
-        markers.subtitle IS DISTINCT FROM excluded.subtitle
-    )
+    -- Only compare the content digests, NULL on markers never updated since
+    markers.digest IS DISTINCT FROM excluded.digest
+RETURNING
+    source_id,
+    uuid,
+    class
+)
+-- Still sees the markers as before the upsert
+SELECT
+    merged.class,
+    markers.uuid IS NULL AS inserted,
+    count(*)
+FROM
+    merged
+    LEFT JOIN markers ON
+        markers.source_id = merged.source_id AND
+        markers.uuid = merged.uuid
+GROUP BY
+    merged.class,
+    markers.uuid IS NULL
+UNION ALL
+SELECT class, NULL, count(*) FROM tmp GROUP BY class
 """
-    await _db.execute(sql_marker)
+    inserted: Counter = Counter()
+    updated: Counter = Counter()
+    unchanged: Counter = Counter()
+    for class_id, is_inserted, count in await _db.fetch(sql_marker):
+        if is_inserted is None:
+            unchanged[class_id] += count
+        elif is_inserted:
+            inserted[class_id] = count
+        else:
+            updated[class_id] = count
+    unchanged.subtract(inserted)
+    unchanged.subtract(updated)
+    return inserted, updated, unchanged
 
-    r = await _db.fetch(f"SELECT class, {uuid} AS uuid FROM markers_tmp")
-    if r and all_uuid is not None:
-        for rr in r:
-            all_uuid[rr["class"]].append(rr["uuid"])
 
-    await _db.execute("DROP TABLE markers_tmp")
+async def table_stale_markers(
+    _db: Connection,
+    _source_id: int,
+    classes: List[int],
+    suffix: str = "",
+) -> None:
+    """List in markers_stale the issues of the uploaded classes no longer in
+    markers_tmp."""
+    await _db.execute(f"CREATE INDEX ON markers_tmp{suffix} (uuid)")
+    await _db.execute(f"ANALYZE markers_tmp{suffix}")
 
+    await _db.execute(
+        f"""
+CREATE TEMP TABLE markers_stale{suffix} AS
+SELECT
+    uuid,
+    class
+FROM
+    markers
+WHERE
+    source_id = $1 AND
+    class = ANY ($2::integer[]) AND
+    NOT EXISTS (SELECT 1 FROM markers_tmp{suffix} WHERE markers_tmp{suffix}.uuid = markers.uuid)
+""",
+        _source_id,
+        classes,
+    )
 
-class sync_update_parser:
-    def __init__(self, q: asyncio.Queue):
-        self.q = q
 
-        self.parser = xml.parsers.expat.ParserCreate()
-        self.parser.StartElementHandler = self.startElement
-        self.parser.EndElementHandler = self.endElement
-        self.parser.CharacterDataHandler = self.charData
+async def table_purge_markers(
+    _db: Connection,
+    _source_id: int,
+    suffix: str = "",
+) -> Counter:
+    """Remove the issues listed in markers_stale.
+
+    Return the removed markers by class.
+    """
+    r = await _db.fetch(
+        f"""
+WITH deleted AS (
+    DELETE FROM
+        markers
+    USING
+        markers_stale{suffix}
+    WHERE
+        markers.source_id = $1 AND
+        markers.uuid = markers_stale{suffix}.uuid
+    RETURNING
+        markers.class
+)
+SELECT class, count(*) FROM deleted GROUP BY class
+""",
+        _source_id,
+    )
+    await _db.execute(f"DROP TABLE markers_stale{suffix}")
+    return Counter(dict(map(tuple, r)))
 
-    def put(self, args: List[Any]):
-        self.q.put_nowait(args)
 
-    def startElement(self, *args) -> None:
-        self.put(["startElement", *args])
+async def table_prune_markers_tmp(
+    _db: Connection,
+    _source_id: int,
+    suffix: str = "",
+) -> Counter:
+    """Remove from markers_tmp the issues already up to date in markers.
+
+    Return the pruned issues by class.
+    """
+    r = await _db.fetch(
+        f"""
+WITH pruned AS (
+    DELETE FROM
+        markers_tmp{suffix} AS tmp
+    USING
+        markers
+    WHERE
+        markers.source_id = $1 AND
+        markers.uuid = tmp.uuid AND
+        markers.class = tmp.class AND
+        -- Any location of the issue, to not move the marker
+        EXISTS (
+            SELECT 1
+            FROM markers_tmp{suffix} AS same
+            WHERE same.uuid = tmp.uuid AND same.digest = markers.digest
+        )
+    RETURNING
+        tmp.uuid,
+        tmp.class
+)
+SELECT class, count(DISTINCT uuid) FROM pruned GROUP BY class
+""",
+        _source_id,
+    )
+    return Counter(dict(map(tuple, r)))
 
-    def endElement(self, *args) -> None:
-        self.put(["endElement", *args])
 
-    def charData(self, data: str) -> None:
-        pass
+# Markers of the source $1 on any of the elements of types $2 and ids $3
+SQL_ON_ELEMENTS = """\
+    source_id = $1 AND
+    marker_elem_ids(elems) && $3::bigint[] AND
+    EXISTS (
+        SELECT
+            1
+        FROM
+            unnest(elems) AS t(elem)
+        WHERE
+            (t.elem->>'type', (t.elem->>'id')::bigint) IN (
+                SELECT * FROM unnest($2::text[], $3::bigint[])
+            )
+    )"""
 
-    def parse(self, content: bytes, terminal: bool) -> None:
-        self.parser.Parse(content, terminal)
-        if terminal:
-            self.put(["endDocument"])
 
+async def table_delete_elements(
+    _db: Connection,
+    _source_id: int,
+    elements: List[Tuple[str, int]],
+) -> Counter:
+    """Remove the issues on any of the deleted OSM elements.
+
+    Return the removed markers by class.
+    """
+    r = await _db.fetch(
+        f"""
+WITH deleted AS (
+    DELETE FROM
+        markers
+    WHERE
+{SQL_ON_ELEMENTS}
+    RETURNING
+        class
+)
+SELECT class, count(*) FROM deleted GROUP BY class
+""",
+        _source_id,
+        [type[0].upper() for type, id in elements],
+        [id for type, id in elements],
+    )
+    return Counter(dict(map(tuple, r)))
+
+
+class sync_update_parser:
+    """Parse the XML and build complete records from the SAX events.
+
+    Meant to run in a worker thread, records are handed to the async writer
+    by chunks of RECORDS_CHUNK_SIZE through the put callback.
+    """
 
-class async_update_parser:
-    _source_id: int
-    _source_url: str
-    _remote_ip: Optional[str]
     _class_item: Dict[int, int]
-    _tstamp_updated: bool
-    all_uuid: Optional[Dict[int, List[str]]]
-    mode: str
 
     element_stack: List[str]
 
     _class_id: int
     _class_sub: int
     _error_elements: List[Elem]
+    _error_sig: List[str]
     _error_locations: List[Dict[str, str]]
     _error_texts: Dict[str, str]
-    _users: List[str]
-    _fixes: List[List[Fix]]
-    _fix: List[Fix]
+    _fixes: List[Fix]
+    _fix: List[bytes]
     elem_mode: str
 
-    _elem: Elem
+    # Type, id and user of the current element
+    _elem: Tuple[str, Optional[str], Optional[str]]
+    _elem_tags: Dict[str, str]
 
     _fix_create: Dict[str, str]
     _fix_modify: Dict[str, str]
@@ -468,56 +1150,46 @@ class async_update_parser:
 
     _class_title: Dict[str, str]
 
-    def __init__(
-        self,
-        source_id: int,
-        source_url: str,
-        remote_ip: Optional[str],
-        db: Connection,
-    ):
-        self._source_id = source_id
-        self._source_url = source_url
-        self._remote_ip = remote_ip
-        self._db = db
-        self._class_item = {}
-        self._tstamp_updated = False
+    def __init__(self, source_id: int, put: Callable[[List[Tuple[Any, ...]]], None]):
+        self.source_id = source_id
+        self.put = put
+        self.records: List[Tuple[Any, ...]] = []
+        self.records_bytes = 0
 
+        self._class_item = {}
         self.element_stack = []
 
-    async def parse(self, q: asyncio.Queue) -> None:
-        while True:
-            a = await q.get()
-            f = a[0]
-            args = a[1:]
-            if f == "startElement":
-                await self.startElement(*args)
-            elif f == "endElement":
-                await self.endElement(*args)
-            q.task_done()
-
-            if f == "endDocument":
-                break
-
-    async def startElement(self, name: str, attrs: Dict[str, str]) -> None:
-        if name == "analyser":
-            self.all_uuid = {}
-            self.mode = "analyser"
-            await self.update_timestamp(attrs)
-            await table_create_tmp(self._db)
+        self.parser = xml.parsers.expat.ParserCreate()
+        self.parser.StartElementHandler = self.startElement
+        self.parser.EndElementHandler = self.endElement
+        self.parser.CharacterDataHandler = self.charData
 
-        elif name == "analyserChange":
-            self.all_uuid = None
-            self.mode = "analyserChange"
-            await self.update_timestamp(attrs)
-            await table_create_tmp(self._db)
+    def record(self, *args: Any, size: int = 0) -> None:
+        self.records.append(args)
+        self.records_bytes += size
+        if (
+            len(self.records) >= RECORDS_CHUNK_SIZE
+            or self.records_bytes >= RECORDS_CHUNK_BYTES
+        ):
+            self.flush()
+
+    def flush(self) -> None:
+        if self.records:
+            self.put(self.records)
+            self.records = []
+            self.records_bytes = 0
+
+    def startElement(self, name: str, attrs: Dict[str, str]) -> None:
+        if name in ("analyser", "analyserChange"):
+            self.record(name, attrs)
 
         elif name == "error":
             self._class_id = int(attrs["class"])
             self._class_sub = int(attrs.get("subclass", "0"))
             self._error_elements = []
+            self._error_sig = []
             self._error_locations = []
             self._error_texts = {}
-            self._users = []
             self._fixes = []
             self.elem_mode = "info"
         elif name == "location":
@@ -526,15 +1198,12 @@ class async_update_parser:
             self._error_texts[attrs["lang"]] = attrs["value"].replace("\n", "%%")
 
         elif name in ["node", "way", "relation", "infos"]:
-            self._elem = dict(attrs)
-            if "user" in self._elem:
-                self._users.append(self._elem["user"])
-            else:
-                self._elem["user"] = None
-            self._elem["type"] = name
+            self._elem = (name, attrs.get("id"), attrs.get("user"))
             self._elem_tags = {}
 
-            if self.elem_mode == "fix":
+            if self.elem_mode == "info":
+                self._error_sig.append(name + attrs["id"])
+            elif self.elem_mode == "fix":
                 self._fix_create = {}
                 self._fix_modify = {}
                 self._fix_delete = []
@@ -583,20 +1252,7 @@ class async_update_parser:
             self._class_example[attrs["lang"]] = attrs["title"]
         elif name == "delete":
             # used by files generated with an .osc file
-            await self._db.execute(
-                """
-DELETE FROM
-    markers
-WHERE
-    source_id = $1 AND
-    ARRAY [$2::bigint] <@ marker_elem_ids(elems) AND
-    (SELECT bool_or(elem->>\'type\' = $3 AND elem->>\'id\' = $4) FROM (SELECT unnest(elems)) AS t(elem))
-""",
-                self._source_id,
-                int(attrs["id"]),
-                attrs["type"][0].upper(),
-                str(attrs["id"]),
-            )
+            self.record("delete", attrs["type"], int(attrs["id"]))
 
         elif name == "fixes":
             self.elem_mode = "fix"
@@ -608,23 +1264,11 @@ WHERE
 
         self.element_stack.append(name)
 
-    async def endElement(self, name: str) -> None:
+    def endElement(self, name: str) -> None:
         self.element_stack.pop()
 
-        if name == "analyser" and self.all_uuid:
-            await table_merge_class_tmp(self._db)
-            await table_merge_markers_tmp(self._db, self.all_uuid)
-            for class_id, uuid in self.all_uuid.items():
-                await self._db.execute(
-                    "DELETE FROM markers WHERE source_id = $1 AND class = $2 AND uuid != ALL ($3::uuid[])",
-                    self._source_id,
-                    class_id,
-                    uuid,
-                )
-
-        elif name == "analyserChange":
-            await table_merge_class_tmp(self._db)
-            await table_merge_markers_tmp(self._db, self.all_uuid)
+        if name in ("analyser", "analyserChange"):
+            self.record("end", name)
 
         elif name == "error":
             #  add data at all location
@@ -632,97 +1276,45 @@ WHERE
                 print("No location on error found")
                 return
 
-            elems = list(
-                filter(
-                    lambda e: e,
-                    map(
-                        lambda elem: dict(
-                            filter(
-                                lambda k_v: k_v[1],
-                                {
-                                    "type": elem["type"][0].upper(),
-                                    "id": int(elem["id"]),
-                                    "tags": elem["tag"],
-                                    "username": elem["user"],
-                                }.items(),
-                            )
-                        )
-                        if elem["type"] in ("node", "way", "relation")
-                        else dict(
-                            filter(
-                                lambda k_v: k_v[1],
-                                {
-                                    "tags": elem["tag"],
-                                    "username": elem["user"],
-                                }.items(),
-                            )
-                        )
-                        if elem["type"] in ("infos")
-                        else None,
-                        self._error_elements,
-                    ),
-                )
-            )
-
-            fixes = list(
-                map(
-                    lambda fix: list(
-                        map(
-                            lambda elem: dict(
-                                filter(
-                                    lambda k_v: k_v[1],
-                                    {
-                                        "type": elem["type"][0].upper(),
-                                        "id": int(elem["id"]),
-                                        "create": elem["create"],
-                                        "modify": elem["modify"],
-                                        "delete": elem["delete"],
-                                    }.items(),
-                                )
-                            ),
-                            filter(
-                                lambda elem: elem["type"]
-                                in ("node", "way", "relation"),
-                                fix,
-                            ),
-                        )
-                    ),
-                    self._fixes,
-                )
-            )
-
-            await update_issue(
-                self._db,
-                self._error_locations,
-                self._source_id,
+            elems = self._error_elements
+            fixes = self._fixes
+            texts = json_encode(self._error_texts)
+            class_item = self._class_item[self._class_id]
+            self.record(
+                "error",
+                marker_locations(
+                    class_item, self._error_locations, elems, fixes, texts
+                ),
+                marker_uuid(
+                    self.source_id,
+                    self._class_id,
+                    self._class_sub,
+                    "_".join(self._error_sig),
+                ),
                 self._class_id,
-                self._class_sub,
-                self._class_item[self._class_id],
-                self._error_elements,
+                class_item,
                 elems,
                 fixes,
-                self._error_texts,
+                texts,
+                size=sum(map(len, elems)) + sum(map(len, fixes)),
             )
 
         elif name in ["node", "way", "relation", "infos"]:
+            # Only keep the encoded element
+            type, id, user = self._elem
             if self.elem_mode == "info":
-                self._elem["tag"] = self._elem_tags
-                self._error_elements.append(self._elem)
+                elem = elem_json(type, id, user, self._elem_tags)
+                if elem:
+                    self._error_elements.append(elem)
             else:
-                self._elem["create"] = self._fix_create
-                self._elem["modify"] = self._fix_modify
-                self._elem["delete"] = self._fix_delete
-                self._fix.append(self._elem)
+                fix = fix_elem_json(
+                    type, id, self._fix_create, self._fix_modify, self._fix_delete
+                )
+                if fix:
+                    self._fix.append(fix)
 
         elif name == "class":
-            if self.all_uuid is not None:
-                self.all_uuid[self._class_id] = []
-
-            await update_class(
-                self._db,
-                self._source_id,
-                self._class_id,
-                self._class_item[self._class_id],
+            metadata = (
                 self._class_title,
                 self._class_level,
                 self._class_tags,
@@ -732,13 +1324,286 @@ WHERE
                 self._class_example or None,
                 self._class_source or None,
                 self._class_resource or None,
-                self.ts,
+            )
+            self.record(
+                "class",
+                self._class_id,
+                self._class_item[self._class_id],
+                *metadata,
+                class_fingerprint(*metadata),
             )
 
         elif name == "fixes":
             self.elem_mode = "info"
         elif name == "fix" and self.element_stack[-1] == "fixes":
-            self._fixes.append(self._fix)
+            self._fixes.append(json_list(self._fix))
+
+    def charData(self, data: str) -> None:
+        pass
+
+    def parse(self, content: bytes, terminal: bool) -> None:
+        self.parser.Parse(content, terminal)
+        if terminal:
+            self.record("endDocument")
+            self.flush()
+
+
+class async_update_parser:
+    """Write the records built by sync_update_parser into the database.
+
+    In staging mode the changes to the shared tables are only prepared in
+    temp tables, and queued in pending to be applied at once at the end.
+    On a dry run they are applied the same way, then rolled back by update,
+    and also counted by class in the stats.
+    """
+
+    _source_id: int
+    _source_url: str
+    _remote_ip: Optional[str]
+    _tstamp_updated: bool
+    classes: Optional[List[int]]
+    counts: Counter
+    update_ts: Optional[float] = None
+    mode: str
+    _markers_tmp: markers_tmp_copy
+
+    def __init__(
+        self,
+        source_id: int,
+        source_url: str,
+        remote_ip: Optional[str],
+        db: Connection,
+        copy_batch_size: int = COPY_BATCH_SIZE,
+        logger: printlogger = printlogger(),
+        stats: Optional[update_stats] = None,
+        staging: bool = False,
+        dry_run: bool = False,
+    ):
+        self._source_id = source_id
+        self._logger = logger
+        self._source_url = source_url
+        self._remote_ip = remote_ip
+        self._db = db
+        self._copy_batch_size = copy_batch_size
+        self._tstamp_updated = False
+        self.counts = Counter()
+        self.stats = stats or update_stats()
+        self.staging = staging or dry_run
+        self.dry_run = dry_run
+        self.pending: List[Callable[[], Awaitable[None]]] = []
+        self._analysers = 0
+        self._suffix = ""
+        self._deletes: List[Tuple[str, int]] = []
+        self._has_deletes = False
+        self._class_fingerprints: Optional[Dict[Tuple[int, int], bytes]] = None
+        self._class_items: Dict[int, int] = {}
+
+    async def apply(self, change: Callable[[], Awaitable[None]]) -> None:
+        if self.staging:
+            self.pending.append(change)
+        else:
+            await change()
+
+    def count(self, change: str, counts: Counter) -> None:
+        self.stats.rows[change] += sum(counts.values())
+        if self.dry_run:
+            for class_id, count in counts.items():
+                if count:
+                    self.stats.classes[class_id][change] += count
+
+    async def parse(self, q: asyncio.Queue) -> None:
+        while True:
+            records = await q.get()
+            for record in records:
+                kind = record[0]
+                args = record[1:]
+                if kind in ("analyser", "analyserChange"):
+                    await self.startAnalyser(kind, *args)
+                elif kind == "end":
+                    await self.endAnalyser(*args)
+                elif kind == "class":
+                    await self.addClass(*args)
+                elif kind == "error":
+                    await self.addError(*args)
+                elif kind == "delete":
+                    await self.deleteElement(*args)
+                elif kind == "endDocument":
+                    await self.flushDeletes()
+                    q.task_done()
+                    return
+            q.task_done()
+
+    async def startAnalyser(self, name: str, attrs: Dict[str, str]) -> None:
+        if name == "analyser":
+            self.classes = []
+        else:
+            self.classes = None
+        self.mode = name
+        await self.update_timestamp(attrs)
+
+        # Temp tables are kept until the end in staging mode
+        self._analysers += 1
+        self._suffix = f"_{self._analysers}" if self.staging else ""
+        self._has_deletes = False
+        await table_create_tmp(self._db, self._suffix)
+
+        if self._class_fingerprints is None:
+            self._class_fingerprints = {
+                (r["item"], r["class"]): r["fingerprint"]
+                for r in await self._db.fetch(
+                    "SELECT item, class, fingerprint FROM class"
+                )
+            }
+            self._class_items = dict(
+                map(
+                    tuple,
+                    await self._db.fetch(
+                        "SELECT class, item FROM markers_counts WHERE source_id = $1",
+                        self._source_id,
+                    ),
+                )
+            )
+        self._markers_tmp = markers_tmp_copy(
+            self._db, self._copy_batch_size, self.stats, "markers_tmp" + self._suffix
+        )
+
+    async def endAnalyser(self, name: str) -> None:
+        # Deletes apply to the markers from before this upload, like the
+        # element was deleted as soon as it was parsed
+        await self.flushDeletes()
+        await self._markers_tmp.flush()
+
+        suffix = self._suffix
+        classes = self.classes if name == "analyser" else None
+        if name == "analyser" and not classes:
+            return
+
+        if classes:
+            with self.stats.timing("purge"):
+                await table_stale_markers(self._db, self._source_id, classes, suffix)
+
+        if self.staging and not self._has_deletes:
+            # Leave only the new or changed issues for the final transaction
+            with self.stats.timing("prune"):
+                self.count(
+                    "unchanged",
+                    await table_prune_markers_tmp(self._db, self._source_id, suffix),
+                )
+
+        async def merge() -> None:
+            with self.stats.timing("class_merge"):
+                await table_merge_class_tmp(self._db, suffix)
+            with self.stats.timing("markers_merge"):
+                inserted, updated, unchanged = await table_merge_markers_tmp(
+                    self._db, suffix
+                )
+            self.counts.update(inserted)
+            self.count("inserted", inserted)
+            self.count("updated", updated)
+            self.count("unchanged", unchanged)
+
+            if classes:
+                with self.stats.timing("purge"):
+                    purged = await table_purge_markers(
+                        self._db, self._source_id, suffix
+                    )
+                self.counts.subtract(purged)
+                self.count("deleted", purged)
+
+            await self._db.execute(f"DROP TABLE markers_tmp{suffix}")
+
+        await self.apply(merge)
+
+    async def addClass(
+        self,
+        class_id: int,
+        class_item: int,
+        class_title: Dict[str, str],
+        class_level: int,
+        class_tags: List[str],
+        class_detail: Optional[Dict[str, str]],
+        class_fix: Optional[Dict[str, str]],
+        class_trap: Optional[Dict[str, str]],
+        class_example: Optional[Dict[str, str]],
+        class_source: Optional[str],
+        class_resource: Optional[str],
+        fingerprint: bytes,
+    ) -> None:
+        if self.classes is not None:
+            self.classes.append(class_id)
+
+        # Only the new or changed classes go through the temp tables
+        assert self._class_fingerprints is not None
+        with self.stats.timing("tmp_insert"):
+            if self._class_fingerprints.get((class_item, class_id)) != fingerprint:
+                self._class_fingerprints[(class_item, class_id)] = fingerprint
+                await update_class(
+                    self._db,
+                    class_id,
+                    class_item,
+                    class_title,
+                    class_level,
+                    class_tags,
+                    class_detail,
+                    class_fix,
+                    class_trap,
+                    class_example,
+                    class_source,
+                    class_resource,
+                    fingerprint,
+                    self.ts,
+                    self._suffix,
+                )
+
+            if self._class_items.get(class_id) != class_item:
+                self._class_items[class_id] = class_item
+                await update_class_count(
+                    self._db, self._source_id, class_id, class_item, self._suffix
+                )
+
+    async def addError(
+        self,
+        error_locations: List[Tuple[float, float, bytes]],
+        uuid: UUID,
+        class_id: int,
+        class_item: int,
+        elems: List[Elem],
+        fixes: List[Fix],
+        error_texts: bytes,
+    ) -> None:
+        await update_issue(
+            self._markers_tmp,
+            error_locations,
+            uuid,
+            self._source_id,
+            class_id,
+            class_item,
+            elems,
+            fixes,
+            error_texts,
+        )
+
+    async def deleteElement(self, type: str, id: int) -> None:
+        self._deletes.append((type, id))
+        self._has_deletes = True
+        if len(self._deletes) >= self._copy_batch_size:
+            await self.flushDeletes()
+
+    async def flushDeletes(self) -> None:
+        if not self._deletes:
+            return
+        elements = self._deletes
+        self._deletes = []
+
+        async def delete() -> None:
+            with self.stats.timing("delete"):
+                deleted = await table_delete_elements(
+                    self._db, self._source_id, elements
+                )
+            self.counts.subtract(deleted)
+            self.count("deleted", deleted)
+
+        await self.apply(delete)
 
     async def update_timestamp(self, attrs: Dict[str, str]) -> None:
         timestamp = attrs.get("timestamp")
@@ -750,7 +1615,26 @@ WHERE
         self.version = attrs.get("version", None)
         self.analyser_version = attrs.get("analyser_version", None)
 
-        if not self._tstamp_updated:
+        if self._tstamp_updated:
+            return
+        self._tstamp_updated = True
+        ts, version, analyser_version = self.ts, self.version, self.analyser_version
+
+        if self.dry_run:
+            # Not recorded, an upload already loaded can still be compared
+            return
+
+        if self.staging and await self._db.fetchval(
+            "SELECT 1 FROM updates WHERE source_id = $1 AND timestamp = to_timestamp($2)",
+            self._source_id,
+            ts,
+        ):
+            # Fail early, before loading the whole file
+            raise OsmoseUpdateAlreadyDone(
+                f"source={self._source_id} and timestamp={ts} are already present"
+            )
+
+        async def insert() -> None:
             r = await self._db.fetchval(
                 """
 INSERT INTO updates
@@ -761,17 +1645,18 @@ ON CONFLICT DO NOTHING
 RETURNING 1
 """,
                 self._source_id,
-                self.ts,
+                ts,
                 self._source_url,
                 self._remote_ip,
-                self.version,
-                self.analyser_version,
+                version,
+                analyser_version,
             )
 
             if not r:
                 raise OsmoseUpdateAlreadyDone(
-                    f"source={self._source_id} and timestamp={self.ts} are already present"
+                    f"source={self._source_id} and timestamp={ts} are already present"
                 )
+            self.update_ts = ts
 
             await self._db.execute(
                 """
@@ -789,13 +1674,141 @@ WHERE
     updates_last.source_id=$1
 """,
                 self._source_id,
-                self.ts,
-                self.version,
-                self.analyser_version,
+                ts,
+                version,
+                analyser_version,
                 self._remote_ip,
             )
 
-            self._tstamp_updated = True
+        await self.apply(insert)
+
+
+def read_manifest(path: str) -> List[Tuple[int, str]]:
+    """Read the "<source> <file>" lines of a manifest.
+
+    Relative file names are relative to the manifest directory.
+    """
+    files = []
+    with open(path) as f:
+        for line in f:
+            line = line.split("#", 1)[0].strip()
+            if not line:
+                continue
+            source_id, fname = line.split(None, 1)
+            files.append(
+                (int(source_id), os.path.join(os.path.dirname(path), fname.strip()))
+            )
+    return files
+
+
+def read_directory(path: str) -> List[Tuple[int, str]]:
+    """List the "<source>-<anything>" analyser results of a directory.
+
+    Sorted by name, so the files of a source are loaded in name order.
+    """
+    files = []
+    for name in sorted(os.listdir(path)):
+        source_id = name.split("-", 1)[0].split(".", 1)[0]
+        if source_id.isdigit() and name.endswith((".xml",) + compression.EXTENSIONS):
+            files.append((int(source_id), os.path.join(path, name)))
+    return files
+
+
+async def update_many(
+    pool: Pool,
+    files: List[Tuple[int, str]],
+    jobs: int,
+    logger: printlogger = printlogger(),
+    staging: bool = True,
+    dry_run: bool = False,
+    names: Optional[List[str]] = None,
+    remote_ip: Optional[str] = None,
+) -> Dict[str, Any]:
+    """Load many analyser results on up to jobs concurrent connections.
+
+    The files of a same source are loaded one after the other, in the given
+    order. The other processes updating a source are waited for, thanks to
+    the advisory lock taken by update(). A failure only skips its file.
+    The updates are recorded with the names of the files, by default their
+    path.
+    Return the totals of the run, with the result of each file.
+    """
+    sources: Dict[int, List[int]] = defaultdict(list)
+    for i, (source_id, fname) in enumerate(files):
+        sources[source_id].append(i)
+    todo = list(sources.items())
+    todo.reverse()
+
+    summary: Dict[str, Any] = dict(
+        files=0, already_done=0, failed=0, issues=0, bytes=0, rows=Counter()
+    )
+    results: List[Dict[str, Any]] = [
+        dict(source_id=source_id, file=names[i] if names else fname)
+        for i, (source_id, fname) in enumerate(files)
+    ]
+    start = time.perf_counter()
+
+    async def worker() -> None:
+        while todo:
+            source_id, indexes = todo.pop()
+            async with pool.acquire() as db:
+                for i in indexes:
+                    fname = files[i][1]
+                    result = results[i]
+                    try:
+                        with open(fname, "rb") as f:
+                            if dry_run or staging:
+                                stats = await update(
+                                    cast(Connection, db),
+                                    source_id,
+                                    result["file"],
+                                    logger,
+                                    remote_ip,
+                                    fileobj=f,
+                                    staging=staging,
+                                    dry_run=dry_run,
+                                )
+                            else:
+                                async with db.transaction():
+                                    stats = await update(
+                                        cast(Connection, db),
+                                        source_id,
+                                        result["file"],
+                                        logger,
+                                        remote_ip,
+                                        fileobj=f,
+                                    )
+                    except OsmoseUpdateAlreadyDone:
+                        summary["already_done"] += 1
+                        result["status"] = "already_done"
+                        logger.log(f"source={source_id} {fname}: already up to date")
+                        continue
+                    except Exception as e:
+                        summary["failed"] += 1
+                        result["status"] = "failed"
+                        result["error"] = repr(e)
+                        logger.log(f"source={source_id} {fname}: failed, {e!r}")
+                        continue
+                    result["status"] = "done"
+                    result["stats"] = stats.as_dict()
+                    summary["files"] += 1
+                    summary["rows"].update(stats.rows)
+                    summary["bytes"] += os.path.getsize(fname)
+                    summary["issues"] += (
+                        stats.rows["inserted"]
+                        + stats.rows["updated"]
+                        + stats.rows["unchanged"]
+                    )
+
+    await asyncio.gather(*[worker() for _ in range(max(1, jobs))])
+
+    elapsed = time.perf_counter() - start
+    summary["rows"] = dict(summary["rows"])
+    summary["seconds"] = round(elapsed, 3)
+    summary["issues_per_second"] = round(summary["issues"] / elapsed)
+    summary["mb_per_second"] = round(summary["bytes"] / elapsed / 1024 / 1024, 3)
+    summary["results"] = results
+    return summary
 
 
 def print_source(source: Dict[str, str]) -> None:
@@ -854,6 +1867,30 @@ class Test(unittest.IsolatedAsyncioTestCase):
         cur_num = await self.db.fetchval("SELECT count(*) FROM markers")
         self.assertEqual(num, cur_num)
 
+    async def set_status(self, source_id, uuid, status="false"):
+        # Like api.issue
+        await self.db.execute(
+            """
+INSERT INTO markers_status (source_id, item, class, elems, date, status, lat, lon, subtitle, uuid)
+SELECT source_id, item, class, elems, now(), $3, lat, lon, subtitle, uuid
+FROM markers
+WHERE source_id = $1 AND uuid = $2
+""",
+            source_id,
+            uuid,
+            status,
+        )
+        class_id = await self.db.fetchval(
+            "DELETE FROM markers WHERE source_id = $1 AND uuid = $2 RETURNING class",
+            source_id,
+            uuid,
+        )
+        await self.db.execute(
+            "UPDATE markers_counts SET count = count - 1 WHERE source_id = $1 AND class = $2",
+            source_id,
+            class_id,
+        )
+
     async def test(self):
         await self.check_num_marker(0)
         await update(
@@ -872,13 +1909,251 @@ class Test(unittest.IsolatedAsyncioTestCase):
         )
         await self.check_num_marker(48)
 
+        stats = await update(
+            self.db,
+            1,
+            "tests/Analyser_Osmosis_Soundex-france_alsace-2014-06-17.xml.bz2",
+        )
+        await self.check_num_marker(50)
+        self.assertEqual([], await markers_counts_drift(self.db))
+
+        await self.db.execute("UPDATE markers_counts SET count = count + 3")
+        drift = await markers_counts_drift(self.db, 1, fix=True)
+        self.assertEqual([3], [d["count"] - d["actual"] for d in drift])
+        self.assertEqual([], await markers_counts_drift(self.db))
+
+        self.assertEqual(
+            dict(inserted=4, updated=0, unchanged=46, deleted=2), stats.rows
+        )
+        stored = await self.db.fetchval(
+            "SELECT stats FROM updates WHERE source_id = 1 ORDER BY timestamp DESC LIMIT 1"
+        )
+        self.assertEqual(stats.as_dict(), stored)
+        for phase in ("decompress", "parse", "markers_merge", "purge", "total"):
+            self.assertIn(phase, stored["timings"])
+
+        self.assertEqual(
+            0,
+            await self.db.fetchval(
+                "SELECT count(*) FROM class WHERE fingerprint IS NULL"
+            ),
+        )
+
+    async def test_analyser_change(self):
+        await update(
+            self.db,
+            1,
+            "tests/Analyser_Osmosis_Soundex-france_alsace-2014-06-17.xml.bz2",
+        )
+        await self.check_num_marker(50)
+
+        with tempfile.NamedTemporaryFile(suffix=".xml") as f:
+            f.write(
+                b"""<?xml version="1.0" encoding="UTF-8"?>
+<analysers timestamp="2014-06-18T00:00:00Z">
+<analyserChange timestamp="2014-06-18T00:00:00Z">
+<class item="5050" tag="name,fix:survey" id="1" level="2">
+<classtext lang="en" title="Soundex test" />
+</class>
+<delete type="way" id="13855482" />
+<delete type="node" id="13855482" />
+<error class="1">
+<location lat="48.1" lon="7.1" />
+<node id="1" user="u"><tag k="name" v="n" /></node>
+</error>
+</analyserChange>
+</analysers>
+"""
+            )
+            f.flush()
+            await update(self.db, 1, f.name)
+
+        await self.check_num_marker(50)
+        self.assertEqual(
+            0,
+            await self.db.fetchval(
+                "SELECT count(*) FROM markers WHERE ARRAY[13855482::bigint] <@ marker_elem_ids(elems)"
+            ),
+        )
+        # The class changed, its translations are replaced
+        self.assertEqual(
+            {"en": "Soundex test"},
+            await self.db.fetchval("SELECT title FROM class WHERE class = 1"),
+        )
+        self.assertEqual([], await markers_counts_drift(self.db))
+
+    async def test_dry_run(self):
+        await update(
+            self.db,
+            1,
+            "tests/Analyser_Osmosis_Soundex-france_alsace-2014-05-20.xml.bz2",
+        )
+        await self.set_status(
+            1,
+            await self.db.fetchval(
+                "SELECT uuid FROM markers WHERE source_id = 1 ORDER BY uuid LIMIT 1"
+            ),
+        )
+        markers = await self.db.fetch("SELECT * FROM markers ORDER BY uuid")
+
+        fname = "tests/Analyser_Osmosis_Soundex-france_alsace-2014-06-17.xml.bz2"
+        async with self.db.transaction():
+            dry = await update(self.db, 1, fname, dry_run=True)
+        self.assertEqual(
+            markers, await self.db.fetch("SELECT * FROM markers ORDER BY uuid")
+        )
+        self.assertEqual(1, await self.db.fetchval("SELECT count(*) FROM updates"))
+        self.assertIsNone(await self.db.fetchval("SELECT to_regclass('markers_tmp_1')"))
+        self.assertIn("markers_merge", dry.timings)
+        self.assertEqual(+dry.rows, sum(dry.classes.values(), Counter()))
+        # Out of a transaction
+        self.assertEqual(dry.rows, (await update(self.db, 1, fname, dry_run=True)).rows)
+
+        stats = await update(self.db, 1, fname, staging=True)
+        self.assertEqual(stats.rows, dry.rows)
+
+        with tempfile.NamedTemporaryFile(suffix=".xml") as f:
+            f.write(
+                b"""<?xml version="1.0" encoding="UTF-8"?>
+<analysers timestamp="2014-06-18T00:00:00Z">
+<analyserChange timestamp="2014-06-18T00:00:00Z">
+<class item="5050" tag="name,fix:survey" id="1" level="2">
+<classtext lang="en" title="Soundex test" />
+</class>
+<delete type="way" id="13855482" />
+<delete type="node" id="13855482" />
+<error class="1">
+<location lat="48.1" lon="7.1" />
+<node id="1" user="u"><tag k="name" v="n" /></node>
+</error>
+</analyserChange>
+</analysers>
+"""
+            )
+            f.flush()
+            dry = await update(self.db, 1, f.name, dry_run=True)
+            self.assertEqual(
+                dict(inserted=1, deleted=1), {k: v for k, v in dry.rows.items() if v}
+            )
+            stats = await update(self.db, 1, f.name, staging=True)
+            self.assertEqual(stats.rows, dry.rows)
+
+    async def test_status(self):
+        fname = "tests/Analyser_Osmosis_Soundex-france_alsace-2014-06-17.xml.bz2"
+        await update(self.db, 1, fname)
+        uuid = await self.db.fetchval(
+            "SELECT uuid FROM markers WHERE source_id = 1 ORDER BY uuid LIMIT 1"
+        )
+        await self.set_status(1, uuid)
+        await self.db.execute(
+            "UPDATE markers_status SET subtitle = NULL WHERE uuid = $1", uuid
+        )
+        await self.db.execute("DELETE FROM updates")
+
+        stats = await update(self.db, 1, fname)
+        self.assertEqual(
+            dict(inserted=0, updated=0, unchanged=50, deleted=0), stats.rows
+        )
+        await self.check_num_marker(49)
+        self.assertIsNotNone(
+            await self.db.fetchval(
+                "SELECT subtitle FROM markers_status WHERE uuid = $1", uuid
+            )
+        )
+        self.assertEqual([], await markers_counts_drift(self.db))
+
+    async def test_many_locations(self):
+        locations = [f'<location lat="48.{i}" lon="7.{i}" />' for i in range(1, 7)]
+        for day, order in ((18, 1), (19, -1)):
+            with tempfile.NamedTemporaryFile(suffix=".xml") as f:
+                f.write(
+                    f"""<?xml version="1.0" encoding="UTF-8"?>
+<analysers timestamp="2014-06-{day}T00:00:00Z">
+<analyser timestamp="2014-06-{day}T00:00:00Z">
+<class item="5050" tag="name,fix:survey" id="1" level="2">
+<classtext lang="en" title="Soundex test" />
+</class>
+<error class="1">
+{"".join(locations[::order])}
+<node id="1" user="u"><tag k="name" v="n" /></node>
+</error>
+</analyser>
+</analysers>
+""".encode()
+                )
+                f.flush()
+                dry = await update(self.db, 1, f.name, dry_run=True)
+                stats = await update(self.db, 1, f.name)
+                self.assertEqual(stats.rows, dry.rows)
+
+        # The same location is kept, whatever the order
+        self.assertEqual(
+            dict(inserted=0, updated=0, unchanged=1, deleted=0), stats.rows
+        )
+        self.assertEqual(
+            (48.1, 7.1),
+            tuple(map(float, await self.db.fetchrow("SELECT lat, lon FROM markers"))),
+        )
+
+    async def test_copy_batch_size(self):
+        await self.check_num_marker(0)
         await update(
             self.db,
             1,
             "tests/Analyser_Osmosis_Soundex-france_alsace-2014-06-17.xml.bz2",
+            copy_batch_size=7,
         )
         await self.check_num_marker(50)
 
+        fix_type = await self.db.fetchval(
+            "SELECT DISTINCT jsonb_typeof(fixes[1]) FROM markers WHERE fixes IS NOT NULL"
+        )
+        self.assertEqual("array", fix_type)
+
+    async def test_marker_uuid(self):
+        # Same as the uuid previously computed by the database
+        sql_uuid = await self.db.fetchval(
+            """
+SELECT ('{' ||
+    encode(substring(digest(
+        $1::int || '/' || $2::int || '/' || $3::bigint || '/' || $4, 'sha256'
+    ) from 1 for 16), 'hex') ||
+'}')::uuid
+""",
+            1,
+            2,
+            3,
+            "N1_W2",
+        )
+        self.assertEqual(sql_uuid, marker_uuid(1, 2, 3, "N1_W2"))
+
+    def test_marker_locations(self):
+        elems = [json_encode({"type": "N", "id": 1, "tags": {"a": "1", "b": "2"}})]
+        texts = json_encode({"en": "t"})
+        [(lat, lon, digest)] = marker_locations(
+            1, [{"lat": "48.1", "lon": "7.25"}], elems, [], texts
+        )
+        self.assertEqual((48.1, 7.25), (lat, lon))
+        self.assertEqual(16, len(digest))
+
+        same = [json_encode({"id": 1, "tags": {"b": "2", "a": "1"}, "type": "N"})]
+        [(_, _, same_digest)] = marker_locations(
+            1, [{"lat": "48.10", "lon": "7.25"}], same, [], texts
+        )
+        self.assertEqual(digest, same_digest)
+        for other in (
+            marker_locations(2, [{"lat": "48.1", "lon": "7.25"}], elems, [], texts),
+            marker_locations(1, [{"lat": "48.1", "lon": "7.26"}], elems, [], texts),
+            marker_locations(1, [{"lat": "48.1", "lon": "7.25"}], elems, [], b"{}"),
+        ):
+            self.assertNotEqual(digest, other[0][2])
+
+        # As from the whole content
+        content = json_encode([1, [json.loads(elems[0])], None, {"en": "t"}])
+        self.assertEqual(
+            hashlib.sha256(content + b"/48.1000000/7.2500000").digest()[0:16], digest
+        )
+
     async def test_duplicate_update(self):
         await self.check_num_marker(0)
         await update(
@@ -896,6 +2171,126 @@ class Test(unittest.IsolatedAsyncioTestCase):
             )
         await self.check_num_marker(50)
 
+    async def test_staging(self):
+        await update(
+            self.db,
+            1,
+            "tests/Analyser_Osmosis_Soundex-france_alsace-2014-05-20.xml.bz2",
+            staging=True,
+        )
+        await self.check_num_marker(48)
+
+        stats = await update(
+            self.db,
+            1,
+            "tests/Analyser_Osmosis_Soundex-france_alsace-2014-06-17.xml.bz2",
+            staging=True,
+        )
+        await self.check_num_marker(50)
+        self.assertEqual([], await markers_counts_drift(self.db))
+        self.assertEqual(
+            dict(inserted=4, updated=0, unchanged=46, deleted=2), stats.rows
+        )
+        self.assertIn("apply", stats.timings)
+
+        with self.assertRaises(OsmoseUpdateAlreadyDone):
+            await update(
+                self.db,
+                1,
+                "tests/Analyser_Osmosis_Soundex-france_alsace-2014-06-17.xml.bz2",
+                staging=True,
+            )
+
+        # Nothing is applied from a failed upload
+        with tempfile.NamedTemporaryFile(suffix=".bz2") as f:
+            with open(
+                "tests/Analyser_Osmosis_Soundex-france_alsace-2014-06-17.xml.bz2", "rb"
+            ) as content:
+                f.write(content.read(2000))
+            f.flush()
+
+            with self.assertRaises(EOFError):
+                await update(self.db, 2, f.name, staging=True)
+        self.assertEqual(
+            0,
+            await self.db.fetchval("SELECT count(*) FROM updates WHERE source_id = 2"),
+        )
+        self.assertIsNone(await self.db.fetchval("SELECT to_regclass('markers_tmp_1')"))
+
+    async def test_parse_error(self):
+        with tempfile.NamedTemporaryFile(suffix=".xml") as f:
+            with bz2.open(
+                "tests/Analyser_Osmosis_Soundex-france_alsace-2014-06-17.xml.bz2"
+            ) as content:
+                f.write(content.read(20000))
+            f.flush()
+
+            with self.assertRaises(xml.parsers.expat.ExpatError):
+                await update(self.db, 1, f.name)
+
+    async def test_truncated_file(self):
+        with tempfile.NamedTemporaryFile(suffix=".bz2") as f:
+            with open(
+                "tests/Analyser_Osmosis_Soundex-france_alsace-2014-06-17.xml.bz2", "rb"
+            ) as content:
+                f.write(content.read(2000))
+            f.flush()
+
+            with self.assertRaises(EOFError):
+                await update(self.db, 1, f.name)
+        await self.check_num_marker(0)
+
+    async def test_fileobj(self):
+        await self.check_num_marker(0)
+        with open(
+            "tests/Analyser_Osmosis_Soundex-france_alsace-2014-06-17.xml.bz2", "rb"
+        ) as f:
+            await update(self.db, 1, "upload.xml.bz2", fileobj=f)
+        await self.check_num_marker(50)
+
+    async def test_gzip_concatenated(self):
+        await self.check_num_marker(0)
+        with tempfile.NamedTemporaryFile(suffix=".gz") as f:
+            with bz2.open(
+                "tests/Analyser_Osmosis_Soundex-france_alsace-2014-06-17.xml.bz2"
+            ) as content:
+                data = content.read()
+            f.write(gzip.compress(data[:1000]))
+            f.write(gzip.compress(data[1000:]))
+            f.flush()
+
+            await update(self.db, 1, f.name)
+        await self.check_num_marker(50)
+
+    async def test_compression(self):
+        with bz2.open(
+            "tests/Analyser_Osmosis_Soundex-france_alsace-2014-06-17.xml.bz2"
+        ) as content:
+            data = content.read()
+
+        with tempfile.TemporaryDirectory() as path:
+            for format, (ext, magic) in compression.FORMATS.items():
+                with self.subTest(format=format):
+                    fname = os.path.join(path, "upload.xml" + ext)
+                    with compression.open_file(fname, "wb") as f:
+                        f.write(data)
+                    await update(self.db, 1, fname)
+                    await self.check_num_marker(50)
+
+                    # Detected from the first bytes
+                    with open(fname, "rb") as f:
+                        await update(self.db, 2, "upload.xml", fileobj=f)
+                    await self.check_num_marker(100)
+
+                    await self.db.execute(
+                        """
+DELETE FROM markers;
+DELETE FROM markers_counts;
+DELETE FROM updates_last;
+DELETE FROM updates;
+"""
+                    )
+
     async def test_two_sources(self):
         await self.check_num_marker(0)
         await update(
@@ -913,19 +2308,225 @@ class Test(unittest.IsolatedAsyncioTestCase):
         # Including 12 duplicates
         await self.check_num_marker(50 + 99 - 12)
 
+    async def test_update_many(self):
+        with tempfile.TemporaryDirectory() as path:
+            manifest = os.path.join(path, "manifest")
+            with open(manifest, "w") as f:
+                f.write(
+                    f"""# Replay
+1 {os.path.abspath("tests/Analyser_Osmosis_Soundex-france_alsace-2014-05-20.xml.bz2")}
+2 {os.path.abspath("tests/Analyser_Osmosis_Broken_Highway_Level_Continuity-france_reunion-2014-06-11.xml.bz2")}
+1 {os.path.abspath("tests/Analyser_Osmosis_Soundex-france_alsace-2014-06-17.xml.bz2")}
+2 {os.path.abspath("tests/Analyser_Osmosis_Broken_Highway_Level_Continuity-france_reunion-2014-06-11.xml.bz2")}
+1 missing.xml.bz2
+"""
+                )
+            files = read_manifest(manifest)
+            self.assertEqual([1, 2, 1, 2, 1], [source_id for source_id, _ in files])
+            self.assertEqual(os.path.join(path, "missing.xml.bz2"), files[-1][1])
+
+            for name in ("2-b.xml.zst", "1-a.xml.lz4", "3.xml", "4-c.txt", "x-d.xml"):
+                open(os.path.join(path, name), "w").close()
+            self.assertEqual(
+                [(1, "1-a.xml.lz4"), (2, "2-b.xml.zst"), (3, "3.xml")],
+                [(s, os.path.basename(f)) for s, f in read_directory(path)],
+            )
 
-async def main():
-    if sys.argv[1] == "--help":
-        show("usage: update.py <source number> <url>")
-    else:
-        db = database.get_dbconn()
-        sources = await query_meta._sources(db)
-        if len(sys.argv) == 1:
-            for k in sorted([int(x) for x in sources.keys()]):
-                source = sources[str(k)]
-                print_source(source)
-        else:
-            await update(db, sources[sys.argv[1]], sys.argv[2])
+            pool = await create_pool(
+                dsn=utils.db_dsn,
+                init=database.add_json_support,
+                min_size=0,
+                max_size=2,
+            )
+            try:
+                summary = await update_many(pool, files, 2)
+            finally:
+                await pool.close()
+
+        self.assertEqual(3, summary["files"])
+        self.assertEqual(1, summary["already_done"])
+        self.assertEqual(1, summary["failed"])
+        self.assertEqual(
+            ["done", "done", "done", "already_done", "failed"],
+            [result["status"] for result in summary["results"]],
+        )
+        self.assertEqual(48, summary["results"][0]["stats"]["rows"]["inserted"])
+        self.assertIn("FileNotFoundError", summary["results"][-1]["error"])
+        self.assertEqual(48 + 87 + 50, summary["issues"])
+        await self.check_num_marker(50 + 87)
+        self.assertEqual([], await markers_counts_drift(self.db))
+
+    async def test_partition(self):
+        fname = "tests/Analyser_Osmosis_Soundex-france_alsace-2014-05-20.xml.bz2"
+        await update(self.db, 1, fname)
+        await update(
+            self.db,
+            2,
+            "tests/Analyser_Osmosis_Broken_Highway_Level_Continuity-france_reunion-2014-06-11.xml.bz2",
+        )
+        await self.set_status(
+            1,
+            await self.db.fetchval(
+                "SELECT uuid FROM markers WHERE source_id = 1 ORDER BY uuid LIMIT 1"
+            ),
+        )
+        markers = await self.db.fetchval("SELECT count(*) FROM markers")
+
+        self.assertFalse(await table_create_partition(self.db, 1))
+        self.assertTrue(await table_create_partition(self.db, 1, min_markers=0))
+        self.assertFalse(await table_create_partition(self.db, 1, min_markers=0))
+        self.assertEqual([], await table_create_partitions(self.db))
+        self.assertEqual([2], await table_create_partitions(self.db, min_markers=0))
+        self.assertEqual(
+            markers, await self.db.fetchval("SELECT count(*) FROM markers")
+        )
+        self.assertEqual(
+            0,
+            await self.db.fetchval(
+                "SELECT count(*) FROM markers_default WHERE source_id = 1"
+            ),
+        )
+        self.assertEqual(
+            await self.db.fetchval("SELECT count(*) FROM markers WHERE source_id = 1"),
+            await self.db.fetchval("SELECT count(*) FROM markers_source_1"),
+        )
+        self.assertEqual(
+            1, await self.db.fetchval("SELECT count(*) FROM markers_status_source_1")
+        )
+
+        # Upsert and purge in the own partition
+        stats = await update(
+            self.db,
+            1,
+            "tests/Analyser_Osmosis_Soundex-france_alsace-2014-06-17.xml.bz2",
+        )
+        # Including the marker with a status, as unchanged
+        self.assertEqual(
+            dict(inserted=4, updated=0, unchanged=46, deleted=2), stats.rows
+        )
+        self.assertEqual([], await markers_counts_drift(self.db))
+
+        await self.db.execute("SELECT source_partition_drop(1)")
+        await self.db.execute("SELECT source_partition_drop(2)")
+        self.assertEqual(0, await self.db.fetchval("SELECT count(*) FROM markers"))
+        self.assertIsNone(
+            await self.db.fetchval("SELECT to_regclass('markers_source_1')")
+        )
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Load analyser results, list the sources without argument"
+    )
+    parser.add_argument("source", type=int, nargs="?")
+    parser.add_argument("file", nargs="?")
+    parser.add_argument("--manifest", help='file of "<source> <file>" lines')
+    parser.add_argument(
+        "--dir",
+        help='directory of "<source>-*.xml" files, optionally compressed, like '
+        + "|".join(f"*.xml{ext}" for ext in compression.EXTENSIONS),
+    )
+    parser.add_argument(
+        "--jobs", type=int, default=4, help="number of concurrent connections"
+    )
+    parser.add_argument(
+        "--no-staging",
+        dest="staging",
+        action="store_false",
+        default=utils.update_staging,
+        help="load each file in a single transaction",
+    )
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="only report the changes by class, without applying them",
+    )
+    parser.add_argument(
+        "--check-counts",
+        action="store_true",
+        help="compare markers_counts with the markers, of the source if given, "
+        "failing on drift",
+    )
+    parser.add_argument(
+        "--fix-counts",
+        action="store_true",
+        help="like --check-counts, but reset the drifting counts",
+    )
+    parser.add_argument(
+        "--partition",
+        action="store_true",
+        help=f"move the sources of at least {PARTITION_MIN_MARKERS} markers to "
+        "their own partitions, locking the markers, best run off-peak",
+    )
+    args = parser.parse_args()
+
+    if args.check_counts or args.fix_counts:
+        db = await database.get_dbconn()
+        try:
+            drift = await markers_counts_drift(db, args.source, fix=args.fix_counts)
+        finally:
+            await db.close()
+        for d in drift:
+            print(
+                f"source={d['source_id']} class={d['class']} "
+                f"count={d['count']} actual={d['actual']}"
+            )
+        if drift and not args.fix_counts:
+            sys.exit(1)
+        return
+
+    if args.partition:
+        db = await database.get_dbconn()
+        try:
+            moved = await table_create_partitions(db)
+        finally:
+            await db.close()
+        for source_id in moved:
+            print(f"source={source_id} partitioned")
+        return
+
+    files = []
+    if args.source is not None:
+        if not args.file:
+            parser.error("a file is required with a source")
+        files.append((args.source, args.file))
+    if args.manifest:
+        files += read_manifest(args.manifest)
+    if args.dir:
+        files += read_directory(args.dir)
+
+    if not files:
+        db = await database.get_dbconn()
+        try:
+            sources = await query_meta._sources(db)
+        finally:
+            await db.close()
+        for k in sorted(sources.keys(), key=int):
+            print_source(sources[k])
+        return
+
+    pool = await create_pool(
+        dsn=utils.db_dsn,
+        init=database.add_json_support,
+        min_size=0,
+        max_size=args.jobs,
+    )
+    try:
+        summary = await update_many(
+            pool, files, args.jobs, staging=args.staging, dry_run=args.dry_run
+        )
+    finally:
+        await pool.close()
+
+    print(
+        f"{summary['files']} files, {summary['issues']} issues, "
+        f"{round(summary['bytes'] / 1024 / 1024, 1)} MB in {summary['seconds']}s: "
+        f"{summary['issues_per_second']} issues/s, {summary['mb_per_second']} MB/s"
+    )
+    print("rows: " + ", ".join(f"{k}={v}" for k, v in summary["rows"].items()))
+    print(f"{summary['already_done']} already up to date, {summary['failed']} failed")
+    if summary["failed"]:
+        sys.exit(1)
 
 
 if __name__ == "__main__":
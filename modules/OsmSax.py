@@ -1,12 +1,14 @@
-import bz2
-import gzip
 import io
+import os
 import re
+import tempfile
 import unittest
 from typing import Dict
 from xml.sax import handler, make_parser
 from xml.sax.saxutils import XMLGenerator, quoteattr
 
+from . import compression
+
 ###########################################################################
 
 
@@ -60,12 +62,7 @@ class OsmSaxReader(handler.ContentHandler):
 
     def _GetFile(self):
         if isinstance(self._filename, str):
-            if self._filename.endswith(".bz2"):
-                return bz2.BZ2File(self._filename)
-            elif self._filename.endswith(".gz"):
-                return gzip.open(self._filename)
-            else:
-                return open(self._filename)
+            return compression.open_file(self._filename)
         else:
             return self._filename
 
@@ -170,12 +167,8 @@ class OsmTextReader:
     def _GetFile(self):
         if isinstance(self._filename, io.TextIOBase):
             return self._filename
-        elif self._filename.endswith(".bz2"):
-            return bz2.BZ2File(self._filename)
-        elif self._filename.endswith(".gz"):
-            return gzip.open(self._filename)
         else:
-            return open(self._filename)
+            return compression.open_file(self._filename)
 
     def CopyTo(self, output):
         _re_eid = re.compile(" id=['\"](.+?)['\"]")
@@ -255,12 +248,8 @@ class OscSaxReader(handler.ContentHandler):
     def _GetFile(self):
         if isinstance(self._filename, io.TextIOBase):
             return self._filename
-        elif self._filename.endswith(".bz2"):
-            return bz2.BZ2File(self._filename)
-        elif self._filename.endswith(".gz"):
-            return gzip.open(self._filename)
         else:
-            return open(self._filename)
+            return compression.open_file(self._filename)
 
     def CopyTo(self, output):
         self._output = output
@@ -525,3 +514,19 @@ class Test(unittest.TestCase):
         self.assertEquals(o1.num_nodes, 8076)
         self.assertEquals(o1.num_ways, 625)
         self.assertEquals(o1.num_rels, 16)
+
+    def test_magic(self):
+        with tempfile.TemporaryDirectory() as path:
+            # xz content, detected without extension
+            fname = os.path.join(path, "saint_barthelemy.osm")
+            with compression.open_file("tests/saint_barthelemy.osm.bz2", "rb") as f:
+                with compression.open_file(fname + ".xz", "wb") as out:
+                    out.write(f.read())
+            os.rename(fname + ".xz", fname)
+
+            i1 = OsmSaxReader(fname)
+            o1 = TestCountObjects()
+            i1.CopyTo(o1)
+        self.assertEqual(o1.num_nodes, 8076)
+        self.assertEqual(o1.num_ways, 625)
+        self.assertEqual(o1.num_rels, 16)
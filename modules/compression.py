@@ -0,0 +1,81 @@
+import bz2
+import gzip
+import lzma
+import zlib
+from typing import IO, Any, Optional, cast
+
+# Extension and first bytes of the files of each compression format
+FORMATS = {
+    "bz2": (".bz2", b"BZh"),
+    "gz": (".gz", b"\x1f\x8b"),
+    "xz": (".xz", b"\xfd7zXZ\x00"),
+    "zst": (".zst", b"\x28\xb5\x2f\xfd"),
+    "lz4": (".lz4", b"\x04\x22\x4d\x18"),
+}
+EXTENSIONS = tuple(ext for ext, magic in FORMATS.values())
+MAGIC_SIZE = max(len(magic) for ext, magic in FORMATS.values())
+
+
+def guess_format(fname: str, head: bytes = b"") -> Optional[str]:
+    """Compression format from the fname extension, else from the first bytes.
+
+    Return None on uncompressed content.
+    """
+    for format, (ext, magic) in FORMATS.items():
+        if fname.endswith(ext):
+            return format
+    for format, (ext, magic) in FORMATS.items():
+        if head.startswith(magic):
+            return format
+    return None
+
+
+def decompressobj(format: str) -> Any:
+    """New incremental decompressor of one stream, like bz2.BZ2Decompressor.
+
+    zstandard and lz4 are only required to read their formats.
+    """
+    if format == "bz2":
+        return bz2.BZ2Decompressor()
+    elif format == "gz":
+        return zlib.decompressobj(16 + zlib.MAX_WBITS)
+    elif format == "xz":
+        return lzma.LZMADecompressor()
+    elif format == "zst":
+        import zstandard
+
+        return zstandard.ZstdDecompressor().decompressobj()
+    elif format == "lz4":
+        import lz4.frame  # type: ignore
+
+        return lz4.frame.LZ4FrameDecompressor()
+    raise ValueError(f"Unknown compression format {format}")
+
+
+def open_file(filename: str, mode: str = "rt", encoding: Optional[str] = None) -> IO:
+    """Open a file, compressed according to its extension or its first bytes.
+
+    Only the extension is used when writing.
+    """
+    head = b""
+    if "r" in mode:
+        with open(filename, "rb") as f:
+            head = f.read(MAGIC_SIZE)
+
+    format = guess_format(filename, head)
+    if format == "bz2":
+        return bz2.open(filename, mode, encoding=encoding)
+    elif format == "gz":
+        return cast(IO, gzip.open(filename, mode, encoding=encoding))
+    elif format == "xz":
+        return lzma.open(filename, mode, encoding=encoding)
+    elif format == "zst":
+        import zstandard
+
+        return zstandard.open(filename, mode, encoding=encoding)
+    elif format == "lz4":
+        import lz4.frame  # type: ignore
+
+        return lz4.frame.open(filename, mode, encoding=encoding)
+    else:
+        return open(filename, mode, encoding=encoding)
@@ -1,9 +1,12 @@
+import base64
+import binascii
 import re
 from dataclasses import dataclass, field
 from datetime import datetime
 from typing import List, Literal, Optional, Union
+from uuid import UUID
 
-from fastapi import Query
+from fastapi import HTTPException, Query
 from fastapi.params import Query as QueryObject
 
 from .. import utils
@@ -13,6 +16,18 @@ Fixable = Optional[Literal["online", "josm"]]
 UseDevItem = Literal["false", "true", "all"]
 
 
+def encode_cursor(uuid: UUID) -> str:
+    """Opaque pagination cursor, resuming after the issue uuid."""
+    return base64.urlsafe_b64encode(uuid.bytes).rstrip(b"=").decode("ascii")
+
+
+def decode_cursor(cursor: str) -> Optional[UUID]:
+    try:
+        return UUID(bytes=base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+    except (binascii.Error, ValueError):
+        return None
+
+
 @dataclass
 class Params:
     bbox: Optional[List[float]] = None
@@ -35,6 +50,7 @@ class Params:
     osm_id: Optional[int] = None
     tilex: Optional[int] = None
     tiley: Optional[int] = None
+    cursor: Optional[str] = None
 
     def __init__(
         self,
@@ -58,6 +74,7 @@ class Params:
         osm_id: Optional[int],
         tilex: Optional[int],
         tiley: Optional[int],
+        cursor: Optional[str] = None,
     ):
         bbox = bbox
         self.item = item
@@ -79,6 +96,7 @@ class Params:
         self.osm_id = osm_id
         self.tilex = tilex
         self.tiley = tiley
+        self.cursor = cursor
 
         if level:
             levels = level.split(",")
@@ -149,10 +167,13 @@ async def params(
     osm_id: Optional[int] = None,
     tilex: Optional[int] = None,
     tiley: Optional[int] = None,
+    cursor: Optional[str] = None,
 ) -> Params:
     # Workaround on Query default value, we should not get a Query object here
     if isinstance(classs, QueryObject):
         classs = classs.default
+    if cursor and not decode_cursor(cursor):
+        raise HTTPException(status_code=400, detail="Invalid cursor.")
 
     return Params(
         bbox,
@@ -175,4 +196,5 @@ async def params(
         osm_id,
         tilex,
         tiley,
+        cursor,
     )
@@ -1,11 +1,17 @@
 import json
-from typing import AsyncGenerator, Dict, List, Union
+import weakref
+from contextlib import asynccontextmanager
+from typing import Any, AsyncGenerator, AsyncIterator, Dict, List, Union
 
-from asyncpg import Connection, Pool, connect, create_pool
+from asyncpg import Connection, Pool, Record, connect, create_pool
+from asyncpg.cursor import CursorFactory
 from asyncpg.pool import PoolConnectionProxy
 
 from .. import utils
 
+# Number of prepared statements kept by each connection
+STATEMENT_CACHE_SIZE = 256
+
 
 class Database:
     pool: Pool
@@ -14,6 +20,7 @@ class Database:
         pool = await create_pool(
             dsn=utils.db_dsn,
             init=add_json_support,
+            statement_cache_size=STATEMENT_CACHE_SIZE,
         )
         if pool:
             self.pool = pool
@@ -24,11 +31,86 @@ class Database:
 database = Database()
 
 
+class statement_cache:
+    """Hits and misses of the prepared statements cache of asyncpg.
+
+    asyncpg keeps the prepared statements of each connection, beyond the pool
+    acquisitions, in a cache by query text of STATEMENT_CACHE_SIZE. The query
+    texts only depend on the shape of the queries, not on the values, so that
+    the statements of the frequent queries are parsed and planned once by
+    connection. The queries run through here are looked up in that cache,
+    also filled and evicted by the other queries of the connections.
+
+    The cache is private to asyncpg, when not found as expected the stats are
+    reported "unknown".
+    """
+
+    def __init__(self) -> None:
+        self.hits = 0
+        self.misses = 0
+        self.supported = True
+        self._connections: weakref.WeakSet = weakref.WeakSet()
+
+    def _track(self, db: Union[Connection, PoolConnectionProxy], query: str) -> None:
+        if not self.supported:
+            return
+        try:
+            # The connection behind a pool proxy, that keeps the statements
+            connection: Any = getattr(db, "_con", db)
+            # Key of the statements run by fetch and cursor, by asyncpg
+            key = (query, connection._protocol.get_record_class(), False)
+            hit = connection._stmt_cache.has(key)
+        except AttributeError:
+            self.supported = False
+            return
+        self._connections.add(connection)
+        if hit:
+            self.hits += 1
+        else:
+            self.misses += 1
+
+    async def fetch(
+        self, db: Union[Connection, PoolConnectionProxy], query: str, *args: Any
+    ) -> List[Record]:
+        self._track(db, query)
+        return await db.fetch(query, *args)
+
+    def cursor(
+        self,
+        db: Union[Connection, PoolConnectionProxy],
+        query: str,
+        *args: Any,
+        prefetch: int,
+    ) -> CursorFactory:
+        self._track(db, query)
+        return db.cursor(query, *args, prefetch=prefetch)
+
+    def stats(self) -> Dict[str, Union[int, str]]:
+        if self.supported:
+            try:
+                return dict(
+                    hits=self.hits,
+                    misses=self.misses,
+                    statements=sum(
+                        len(connection._stmt_cache) for connection in self._connections
+                    ),
+                )
+            except (AttributeError, TypeError):
+                self.supported = False
+        return dict(hits="unknown", misses="unknown", statements="unknown")
+
+
+statements = statement_cache()
+
+
 async def startup() -> None:
     await database.create_pool()
 
 
-def _encoder(value: Union[str, List, Dict]) -> bytes:
+def _encoder(value: Union[bytes, str, List, Dict]) -> bytes:
+    # bytes are already encoded JSON
+    if isinstance(value, bytes):
+        return b"\x01" + value
     return b"\x01" + json.dumps(value).encode("utf-8")
 
 
@@ -56,12 +138,20 @@ async def get_dbconn() -> Connection:
     return connection
 
 
-async def db() -> AsyncGenerator[PoolConnectionProxy, None]:
+@asynccontextmanager
+async def readonly() -> AsyncIterator[PoolConnectionProxy]:
+    """Read only connection, also for the streamed responses that outlive the
+    request dependencies."""
     async with database.pool.acquire() as connection:
         async with connection.transaction(readonly=True):
             yield connection
 
 
+async def db() -> AsyncGenerator[PoolConnectionProxy, None]:
+    async with readonly() as connection:
+        yield connection
+
+
 async def db_rw() -> AsyncGenerator[PoolConnectionProxy, None]:
     async with database.pool.acquire() as connection:
         async with connection.transaction():
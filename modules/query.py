@@ -1,13 +1,44 @@
+import asyncio
+import copy
+import csv
+import io
+import sys
+import time
+import unittest
+from collections import OrderedDict
 from datetime import datetime
-from typing import Any, Dict, Iterable, List, Optional, Tuple
+from typing import Any, AsyncIterator, Dict, Iterable, List, Optional, Tuple, Union
+from uuid import UUID
 
 from asyncpg import Connection
+from asyncpg.pool import PoolConnectionProxy
 
-from . import tiles
-from .dependencies.commons_params import Params, UseDevItem
+from . import tiles, utils
+from .dependencies import database
+from .dependencies.commons_params import (
+    Params,
+    UseDevItem,
+    decode_cursor,
+    encode_cursor,
+)
 
+# Issues fetched by round trip when iterating on them
+GETS_PREFETCH = 1000
 
-def _build_where_item(table: str, item: str) -> str:
+# Results of _count kept
+COUNT_CACHE_SIZE = 1024
+# Seconds the results of _count are kept, unless invalidated before
+COUNT_CACHE_TTL = 60
+# Seconds a version of updates_last is used before being checked again
+COUNT_CACHE_VERSION_TTL = 5
+
+
+def _build_where_item(table: str, item: Optional[str], params: List[Any]) -> str:
+    """Filter on the items, appending the values to params.
+
+    The SQL only depends on the number of "nxxx" item ranges, not on the
+    items, so that it can be prepared once.
+    """
     if item == "":
         where = "1=2"
     elif item is None or item == "xxxx":
@@ -19,16 +50,17 @@ def _build_where_item(table: str, item: str) -> str:
             try:
                 if "xxx" in i:
                     n = int(i[0])
+                    params += [n * 1000, (n + 1) * 1000]
                     where_list.append(
-                        "(%s.item >= %s000 AND %s.item < %s000)"
-                        % (table, n, table, n + 1)
+                        f"({table}.item >= ${len(params) - 1} AND {table}.item < ${len(params)})"
                     )
                 else:
-                    items.append(str(int(i)))
+                    items.append(int(i))
             except Exception:
                 pass
         if items != []:
-            where_list.append("%s.item IN (%s)" % (table, ",".join(items)))
+            params.append(items)
+            where_list.append(f"{table}.item = ANY (${len(params)}::integer[])")
         if where_list != []:
             where = "(%s)" % " OR ".join(where_list)
         else:
@@ -36,8 +68,33 @@ def _build_where_item(table: str, item: str) -> str:
     return where
 
 
-def _build_where_class(table: str, classs: List[int]) -> str:
-    return "{0}.class IN ({1})".format(table, ",".join(map(str, classs)))
+def _build_where_class(table: str, classs: List[int], params: List[Any]) -> str:
+    params.append(classs)
+    return f"{table}.class = ANY (${len(params)}::integer[])"
+
+
+def _build_where_source(table: str, sources: List[List[int]], params: List[Any]) -> str:
+    """Filter on the sources, or the classes of sources, appending the values
+    to params."""
+    where_list = []
+    source_ids = [source[0] for source in sources if len(source) == 1]
+    if source_ids:
+        params.append(source_ids)
+        where_list.append(f"{table}.source_id = ANY (${len(params)}::integer[])")
+    source_classes = [source for source in sources if len(source) > 1]
+    if source_classes:
+        params += [
+            [source[0] for source in source_classes],
+            [source[1] for source in source_classes],
+        ]
+        # The first condition also helps the partition pruning
+        where_list.append(
+            f"""({table}.source_id = ANY (${len(params) - 1}::integer[]) AND
+            ({table}.source_id, {table}.class) IN (
+                SELECT * FROM unnest(${len(params) - 1}::integer[], ${len(params)}::integer[])
+            ))"""
+        )
+    return "(" + " OR ".join(where_list) + ")"
 
 
 def _build_param(
@@ -94,17 +151,7 @@ def _build_param(
         join += "markers"
 
     if sources:
-        source2 = []
-        for source in sources:
-            if len(source) == 1:
-                params.append(source[0])
-                source2.append(f"(markers.source_id=${len(params)})")
-            else:
-                params += [source[0], source[1]]
-                source2.append(
-                    f"(markers.source_id=${len(params) - 1} AND markers.class=${len(params)})"
-                )
-        where.append("(" + " OR ".join(source2) + ")")
+        where.append(_build_where_source("markers", sources, params))
 
     tables = list(forceTable)
     tablesLeft = []
@@ -150,15 +197,14 @@ def _build_param(
             updates_last.source_id = markers.source_id"""
 
     if item is not None:
-        where.append(_build_where_item("markers", item))
+        where.append(_build_where_item("markers", item, params))
 
     if level and level != [1, 2, 3]:
         params.append(level)
         where.append(f"class.level = ANY (${len(params)})")
 
     if classs:
-        params.append(classs)
-        where.append(f"markers.class = ANY (${len(params)})")
+        where.append(_build_where_class("markers", classs, params))
 
     if bbox:
         params += [bbox[1], bbox[3], bbox[0], bbox[2]]
@@ -274,7 +320,7 @@ def fixes_default(fixes: List[List[Dict[str, Any]]]) -> List[List[Dict[str, Any]
     )
 
 
-async def _gets(db: Connection, params: Params) -> List[Dict[str, Any]]:
+def _gets_sql(params: Params) -> Tuple[str, List[Any]]:
     sqlbase = """
     SELECT
         uuid_to_bigint(uuid) as id,
@@ -342,41 +388,323 @@ async def _gets(db: Connection, params: Params) -> List[Dict[str, Any]]:
         osm_id=params.osm_id,
     )
 
+    if params.cursor is not None:
+        # Keyset pagination, in the order of the issue id index, ties broken
+        # by the uuid
+        if params.cursor:
+            sql_params.append(decode_cursor(params.cursor))
+            n = len(sql_params)
+            where += f""" AND
+        uuid_to_bigint(markers.uuid) >= uuid_to_bigint(${n}::uuid) AND
+        (uuid_to_bigint(markers.uuid), markers.uuid) > (uuid_to_bigint(${n}::uuid), ${n}::uuid)"""
+        sqlbase += """
+    ORDER BY
+        uuid_to_bigint(markers.uuid),
+        markers.uuid"""
+
     if params.limit:
         sql_params.append(params.limit)
         sqlbase += f"""
     LIMIT
         ${len(sql_params)}"""
 
-    sql = sqlbase % (join, where)
-    results = list(await db.fetch(sql, *sql_params))
-    return list(
-        map(
-            lambda res: {
-                **res,
-                **(
-                    {
-                        "elems": list(
-                            map(
-                                lambda elem: dict(
-                                    elem,
-                                    type_long={
-                                        "N": "node",
-                                        "W": "way",
-                                        "R": "relation",
-                                    }[elem["type"]],
-                                ),
-                                res["elems"],
-                            )
-                        )
-                    }
-                    if "elems" in res and res["elems"]
-                    else {}
-                ),
-            },
-            results,
+    return (sqlbase % (join, where), sql_params)
+
+
+def _gets_row(res) -> Dict[str, Any]:
+    return {
+        **res,
+        **(
+            {
+                "elems": list(
+                    map(
+                        lambda elem: dict(
+                            elem,
+                            type_long={
+                                "N": "node",
+                                "W": "way",
+                                "R": "relation",
+                            }[elem["type"]],
+                        ),
+                        res["elems"],
+                    )
+                )
+            }
+            if "elems" in res and res["elems"]
+            else {}
+        ),
+    }
+
+
+async def _gets(db: Connection, params: Params) -> List[Dict[str, Any]]:
+    sql, sql_params = _gets_sql(params)
+    results = await database.statements.fetch(db, sql, *sql_params)
+    return list(map(_gets_row, results))
+
+
+async def _gets_cursor(
+    db: Union[Connection, PoolConnectionProxy],
+    params: Params,
+    prefetch: int = GETS_PREFETCH,
+) -> AsyncIterator[Dict[str, Any]]:
+    """Issues of _gets, fetched by chunks from a server side cursor.
+
+    Must be iterated inside a transaction.
+    """
+    sql, sql_params = _gets_sql(params)
+    async for res in database.statements.cursor(
+        db, sql, *sql_params, prefetch=prefetch
+    ):
+        yield _gets_row(res)
+
+
+def _i10n_select_sql(column: str, langs: int) -> str:
+    """SQL of utils.i10n_select_auto, with the languages and en as parameter
+    langs."""
+    return f"""coalesce(
+        (
+            SELECT {column} ->> lang
+            FROM unnest(${langs}::text[]) WITH ORDINALITY AS t(lang, i)
+            WHERE {column} ? lang
+            ORDER BY i
+            LIMIT 1
+        ),
+        (SELECT value FROM jsonb_each_text({column}) LIMIT 1)
+    )"""
+
+
+def _csv_sql(sql: str, langs: int) -> str:
+    """Columns of the CSV export of the issues of the query sql, with the
+    languages and en as parameter langs.
+
+    The values are formatted as by Python, as they were once written from
+    the issues of _gets by csv.writer.
+    """
+    return f"""
+SELECT
+    uuid,
+    source_id AS source,
+    item,
+    class,
+    level,
+    NULLIF({_i10n_select_sql("title", langs)}, '') AS title,
+    NULLIF({_i10n_select_sql("subtitle", langs)}, '') AS subtitle,
+    NULLIF(country, '') AS country,
+    NULLIF(analyser, '') AS analyser,
+    to_char(
+        "timestamp" AT TIME ZONE 'UTC',
+        CASE
+            WHEN date_part('microseconds', "timestamp")::integer % 1000000 = 0 THEN 'YYYY-MM-DD HH24:MI:SS'
+            ELSE 'YYYY-MM-DD HH24:MI:SS.US'
+        END
+    ) || '+00:00' AS "timestamp",
+    -- Python list of str
+    '[' || coalesce((
+        SELECT
+            string_agg(
+                CASE
+                    WHEN strpos(username, '''') > 0 AND strpos(username, '"') = 0 THEN
+                        '"' || replace(username, '\\', '\\\\') || '"'
+                    ELSE '''' || replace(replace(username, '\\', '\\\\'), '''', '\\''') || ''''
+                END,
+                ', ' ORDER BY i
+            )
+        FROM
+            unnest(elems) WITH ORDINALITY AS t(elem, i),
+            coalesce(elem->>'username', '') AS username
+    ), '') || ']' AS username,
+    -- Python float
+    regexp_replace(lat::text, '^(-?[0-9]+)$', '\\1.0') AS lat,
+    regexp_replace(lon::text, '^(-?[0-9]+)$', '\\1.0') AS lon,
+    (
+        SELECT
+            string_agg(
+                CASE elem->>'type'
+                    WHEN 'N' THEN 'node'
+                    WHEN 'W' THEN 'way'
+                    WHEN 'R' THEN 'relation'
+                END || (elem->>'id'),
+                '_' ORDER BY i
+            )
+        FROM
+            unnest(elems) WITH ORDINALITY AS t(elem, i)
+    ) AS elems
+FROM ({sql}) AS issues
+"""
+
+
+def _gets_csv_sql(params: Params, langs: List[str]) -> Tuple[str, List[Any]]:
+    """Query of the CSV export of the issues of _gets."""
+    params = copy.copy(params)
+    params.full = True
+    sql, sql_params = _gets_sql(params)
+    sql_params.append(langs + ["en"])
+    return (_csv_sql(sql, len(sql_params)), sql_params)
+
+
+async def _gets_csv(
+    db: Union[Connection, PoolConnectionProxy], params: Params, langs: List[str]
+) -> AsyncIterator[bytes]:
+    """CSV export of the issues of _gets, streamed by COPY.
+
+    Must be iterated inside a transaction.
+    """
+    sql, sql_params = _gets_csv_sql(params, langs)
+    # Only a few chunks ahead of the client
+    chunks: asyncio.Queue = asyncio.Queue(maxsize=4)
+
+    async def output(data: bytes) -> None:
+        await chunks.put(bytes(data))
+
+    async def copy_out() -> None:
+        try:
+            await db.copy_from_query(
+                sql, *sql_params, output=output, format="csv", header=True
+            )
+        except Exception as e:
+            await chunks.put(e)
+        else:
+            await chunks.put(None)
+
+    task = asyncio.create_task(copy_out())
+    try:
+        while (chunk := await chunks.get()) is not None:
+            if isinstance(chunk, Exception):
+                raise chunk
+            yield chunk
+    finally:
+        task.cancel()
+        await asyncio.gather(task, return_exceptions=True)
+
+
+def next_cursor(params: Params, results: List[Dict[str, Any]]) -> Optional[str]:
+    """Cursor of the page following the results of _gets, if they can go on."""
+    if params.cursor is None or not params.limit or len(results) < params.limit:
+        return None
+    return encode_cursor(results[-1]["uuid"])
+
+
+class count_cache:
+    """Results of _count, by query text and parameters.
+
+    The data only change on the updates of the sources. The entries are
+    checked against a digest of updates_last, of the sources of the query or
+    of all the sources, and dropped once one of them is updated. The digest
+    is itself kept version_ttl seconds, so the hits usually cost no round
+    trip, and the updates are counted up to version_ttl seconds late.
+
+    The issue status changes don't touch updates_last: they invalidate the
+    entries of their source in this process only. The other processes count
+    them up to ttl seconds late, when their entries expire.
+    """
+
+    def __init__(
+        self,
+        size: int = COUNT_CACHE_SIZE,
+        ttl: float = COUNT_CACHE_TTL,
+        version_ttl: float = COUNT_CACHE_VERSION_TTL,
+    ):
+        self.size = size
+        self.ttl = ttl
+        self.version_ttl = version_ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict = OrderedDict()
+        self._bytes = 0
+        # Time and version of updates_last, by sources
+        self._versions: Dict[Optional[Tuple[int, ...]], Tuple[float, Any]] = {}
+
+    async def _version(
+        self, db: Connection, source_ids: Optional[List[int]]
+    ) -> Tuple[Any, ...]:
+        sql = """
+SELECT
+    count(*),
+    max(timestamp),
+    sum(extract(epoch FROM timestamp))
+FROM
+    updates_last
+"""
+        if source_ids is None:
+            r = await database.statements.fetch(db, sql)
+        else:
+            sql += "WHERE source_id = ANY ($1::integer[])\n"
+            r = await database.statements.fetch(db, sql, source_ids)
+        return tuple(r[0])
+
+    async def _checked_version(
+        self, db: Connection, source_ids: Optional[List[int]]
+    ) -> Tuple[Any, ...]:
+        key = None if source_ids is None else tuple(source_ids)
+        checked = self._versions.pop(key, None)
+        if checked and time.monotonic() - checked[0] < self.version_ttl:
+            version = checked[1]
+        else:
+            version = await self._version(db, source_ids)
+            checked = (time.monotonic(), version)
+        # Most recently checked last
+        self._versions[key] = checked
+        if len(self._versions) > self.size:
+            del self._versions[next(iter(self._versions))]
+        return version
+
+    async def fetch(
+        self,
+        db: Connection,
+        source_ids: Optional[List[int]],
+        sql: str,
+        *args: Any,
+    ) -> List[Dict[str, Any]]:
+        key = (sql, repr(args))
+        version = await self._checked_version(db, source_ids)
+        entry = self._entries.get(key)
+        if entry and entry[0] == version and time.monotonic() - entry[1] < self.ttl:
+            self.hits += 1
+            self._entries.move_to_end(key)
+            results = entry[3]
+        else:
+            self.misses += 1
+            results = list(map(dict, await database.statements.fetch(db, sql, *args)))
+            self._drop(key)
+            size = (
+                sys.getsizeof(sql)
+                + sys.getsizeof(key[1])
+                + sum(
+                    sys.getsizeof(res) + sum(map(sys.getsizeof, res.values()))
+                    for res in results
+                )
+            )
+            self._entries[key] = (version, time.monotonic(), source_ids, results, size)
+            self._bytes += size
+            while len(self._entries) > self.size:
+                self._drop(next(iter(self._entries)))
+        # The callers update the results
+        return list(map(dict, results))
+
+    def _drop(self, key: Tuple[str, str]) -> None:
+        entry = self._entries.pop(key, None)
+        if entry:
+            self._bytes -= entry[4]
+
+    def invalidate(self, source_id: int) -> None:
+        """Drop the entries that may count issues of source_id."""
+        for key, entry in list(self._entries.items()):
+            if entry[2] is None or source_id in entry[2]:
+                self._drop(key)
+
+    def stats(self) -> Dict[str, Any]:
+        return dict(
+            hits=self.hits,
+            misses=self.misses,
+            hit_ratio=self.hits / (self.hits + self.misses)
+            if self.hits + self.misses
+            else None,
+            entries=len(self._entries),
+            bytes=self._bytes,
         )
-    )
+
+
+counts = count_cache()
 
 
 async def _count(
@@ -450,4 +778,211 @@ async def _count(
 
     sql = sqlbase % (select, join, where, groupBy, order)
 
-    return list(map(dict, await db.fetch(sql, *sql_params)))
+    source_ids = None
+    if params.source:
+        source_ids = sorted(set(source[0] for source in params.source))
+    return await counts.fetch(db, source_ids, sql, *sql_params)
+
+
+class Test(unittest.IsolatedAsyncioTestCase):
+    def build(self, **kwargs):
+        return _build_param(
+            **{
+                **dict(
+                    bbox=None,
+                    sources=None,
+                    item=None,
+                    level=None,
+                    users=None,
+                    classs=None,
+                    country=None,
+                    useDevItem="false",
+                    status=None,
+                    tags=None,
+                    fixable=None,
+                ),
+                **kwargs,
+            }
+        )
+
+    def test_shape(self):
+        join, where, params = self.build(
+            item="1010,2xxx", sources=[[1], [2, 3]], classs=[1], level=[1]
+        )
+        self.assertEqual(
+            [[1], [2], [3], 2000, 3000, [1010], [1], [1]],
+            params,
+        )
+        # Only depends on the filters, not their values
+        self.assertEqual(
+            (join, where),
+            self.build(
+                item="3xxx,1020,1030",
+                sources=[[4], [5], [6, 7], [8, 9]],
+                classs=[2, 3],
+                level=[2, 3],
+            )[0:2],
+        )
+        self.assertNotEqual(where, self.build(item="1010", sources=[[1]])[1])
+
+    def test_cursor(self):
+        uuid = UUID("a973c54e-649d-4dfa-aced-79936c57a8af")
+        self.assertEqual(uuid, decode_cursor(encode_cursor(uuid)))
+        self.assertIsNone(decode_cursor("!!"))
+        self.assertIsNone(decode_cursor("qXPFTg"))
+
+        params = Params(*[None] * 20)
+        params.limit = 2
+        rows = [{"uuid": uuid}, {"uuid": uuid}]
+        self.assertIsNone(next_cursor(params, rows))
+        params.cursor = ""
+        self.assertEqual(encode_cursor(uuid), next_cursor(params, rows))
+        self.assertIsNone(next_cursor(params, rows[0:1]))
+
+    async def test_csv(self):
+        issues = """
+SELECT
+    *
+FROM (VALUES
+    (
+        'a973c54e-649d-4dfa-aced-79936c57a8af'::uuid, 1, 1040, 2, 3,
+        '{"fr": "Titre", "en": "Title"}'::jsonb, '{"de": "Untertitel"}'::jsonb,
+        'france', 'osmose', '2024-03-01 12:34:56.5+05:30'::timestamptz,
+        48::float, -7.25::float,
+        ARRAY[
+            '{"type": "N", "id": 1, "username": "a''b"}',
+            '{"type": "W", "id": 2, "username": "c\\"d"}',
+            '{"type": "R", "id": 3, "username": "e''f\\"g\\\\h, i"}',
+            '{"type": "N", "id": 4}'
+        ]::jsonb[]
+    ),
+    (
+        '0a6a5d0e-0b0e-4d0b-9b0e-0e0e0e0e0e0e'::uuid, 2, 8010, 1, 1,
+        '{}'::jsonb, NULL::jsonb,
+        '', '', '2024-07-01 00:00:00-07'::timestamptz,
+        0.0001::float, -0::float, NULL::jsonb[]
+    )
+) AS t(
+    uuid, source_id, item, class, level, title, subtitle, country, analyser,
+    "timestamp", lat, lon, elems
+)
+"""
+        langs = ["fr"]
+        db = await database.get_dbconn()
+        try:
+            await db.execute("SET TIME ZONE 'America/New_York'")
+
+            # As formerly written from the issues by csv.writer
+            output = io.StringIO()
+            writer = csv.writer(output, lineterminator="\n")
+            writer.writerow(
+                "uuid source item class level title subtitle country analyser "
+                "timestamp username lat lon elems".split()
+            )
+            for res in await db.fetch(issues):
+                elems = res["elems"] or []
+                writer.writerow(
+                    [
+                        res["uuid"],
+                        res["source_id"],
+                        res["item"],
+                        res["class"],
+                        res["level"],
+                        utils.i10n_select_auto(res["title"], langs),
+                        utils.i10n_select_auto(res["subtitle"], langs),
+                        res["country"],
+                        res["analyser"],
+                        res["timestamp"],
+                        [elem.get("username", "") for elem in elems],
+                        res["lat"],
+                        res["lon"],
+                        "_".join(
+                            {"N": "node", "W": "way", "R": "relation"}[elem["type"]]
+                            + str(elem["id"])
+                            for elem in elems
+                        ),
+                    ]
+                )
+
+            chunks: List[bytes] = []
+
+            async def write(data):
+                chunks.append(bytes(data))
+
+            await db.copy_from_query(
+                _csv_sql(issues, 1),
+                langs + ["en"],
+                output=write,
+                format="csv",
+                header=True,
+            )
+            self.assertEqual(output.getvalue(), b"".join(chunks).decode("utf-8"))
+        finally:
+            await db.close()
+
+    async def test_statement_cache(self):
+        cache = database.statement_cache()
+        db1 = await database.connect(dsn=utils.db_dsn, statement_cache_size=1)
+        db2 = await database.connect(dsn=utils.db_dsn, statement_cache_size=1)
+        try:
+            self.assertEqual(2, (await cache.fetch(db1, "SELECT $1::int", 2))[0][0])
+            await cache.fetch(db1, "SELECT $1::int", 3)
+            await cache.fetch(db2, "SELECT $1::int", 4)
+            self.assertEqual(dict(hits=1, misses=2, statements=2), cache.stats())
+            # Evicted by another query of the connection
+            await db1.fetch("SELECT $1::text", "a")
+            await cache.fetch(db1, "SELECT $1::int", 5)
+            self.assertEqual(dict(hits=1, misses=3, statements=2), cache.stats())
+            # Not the internals of this asyncpg version
+            cache._track(object(), "SELECT $1::int")
+            self.assertEqual(
+                dict(hits="unknown", misses="unknown", statements="unknown"),
+                cache.stats(),
+            )
+        finally:
+            await db1.close()
+            await db2.close()
+
+    async def test_count_cache(self):
+        cache = count_cache(size=2)
+        db = await database.get_dbconn()
+        try:
+            rows = await cache.fetch(db, [1], "SELECT $1::int AS n", 1)
+            rows[0]["n"] = 0
+            self.assertEqual(
+                [dict(n=1)], await cache.fetch(db, [1], "SELECT $1::int AS n", 1)
+            )
+            await cache.fetch(db, [2], "SELECT $1::int AS n", 2)
+            self.assertEqual(
+                dict(hits=1, misses=2, hit_ratio=1 / 3, entries=2),
+                {k: v for k, v in cache.stats().items() if k != "bytes"},
+            )
+            cache.invalidate(1)
+            self.assertEqual(1, cache.stats()["entries"])
+            # Evicted
+            await cache.fetch(db, None, "SELECT $1::int AS n", 3)
+            await cache.fetch(db, None, "SELECT $1::int AS n", 4)
+            await cache.fetch(db, [2], "SELECT $1::int AS n", 2)
+            self.assertEqual(5, cache.stats()["misses"])
+            cache.invalidate(2)
+            self.assertEqual(0, cache.stats()["bytes"])
+
+            # The version of updates_last is checked again after version_ttl
+            cache = count_cache(version_ttl=60)
+            checks = []
+            version = cache._version
+
+            async def _version(db, source_ids):
+                checks.append(source_ids)
+                return await version(db, source_ids)
+
+            cache._version = _version
+            await cache.fetch(db, [1], "SELECT $1::int AS n", 1)
+            await cache.fetch(db, [1], "SELECT $1::int AS n", 2)
+            self.assertEqual([[1]], checks)
+            cache.version_ttl = 0
+            await cache.fetch(db, [1], "SELECT $1::int AS n", 1)
+            self.assertEqual([[1], [1]], checks)
+            self.assertEqual(1, cache.stats()["hits"])
+        finally:
+            await db.close()
@@ -63,6 +63,11 @@ else:
     db_dsn = f"postgres://{pg_user}:{pg_pass}@/{pg_base}"
 website = os.environ.get("URL_FRONTEND") or "https://osmose.openstreetmap.fr"
 
+update_jobs_dir = os.environ.get("UPDATE_JOBS_DIR", "/tmp/osmose-update-jobs")
+update_jobs_workers = int(os.environ.get("UPDATE_JOBS_WORKERS", "2"))
+# Prepare the updates out of transaction, then apply them in a short one
+update_staging = os.environ.get("UPDATE_STAGING", "1") != "0"
+
 main_project = "OpenStreetMap"
 main_website = "https://www.openstreetmap.org/"
 remote_url = "https://www.openstreetmap.org/"
@@ -16,6 +16,12 @@ app = FastAPI()
 async def startup():
     # Manual Event propagation
     await api.startup()
+    await control.update_jobs.startup()
+
+
+@app.on_event("shutdown")
+async def shutdown():
+    await control.update_jobs.shutdown()
 
 
 #
@@ -7,14 +7,12 @@ for i in $*; do
   echo "confirm?"
   read ln
 
-  psql -d osmose_frontend -c  "DELETE FROM markers
-                      WHERE source_id IN (SELECT id FROM sources WHERE analyser = '$i');"
+  psql -d osmose_frontend -c  "SELECT source_partition_drop(id)
+                      FROM sources WHERE analyser = '$i';"
   psql -d osmose_frontend -c  "DELETE FROM updates_last
                       WHERE source_id IN (SELECT id FROM sources WHERE analyser = '$i');"
   psql -d osmose_frontend -c  "DELETE FROM markers_counts
                       WHERE source_id IN (SELECT id FROM sources WHERE analyser = '$i');"
-  psql -d osmose_frontend -c  "DELETE FROM markers_status
-                      WHERE source_id IN (SELECT id FROM sources WHERE analyser = '$i');"
   psql -d osmose_frontend -c  "DELETE FROM sources_password
                       WHERE source_id IN (SELECT id FROM sources WHERE analyser = '$i');"
 done
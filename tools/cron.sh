@@ -8,6 +8,12 @@ DIR_DUMP="/data/work/$(whoami)/"
 
 # Update various tables in database
 
+# Reset the markers_counts drifting from the markers, before the stats
+(cd "$(dirname "$0")/.." && DB_NAME=$DATABASE python3 -m control.update_utils --fix-counts)
+
+# Move the sources grown large to their own partitions, locking the markers
+(cd "$(dirname "$0")/.." && DB_NAME=$DATABASE python3 -m control.update_utils --partition)
+
 psql -d $DATABASE -c "
 DELETE FROM markers_status
 WHERE date < now()-interval '7 day' AND status = 'done';
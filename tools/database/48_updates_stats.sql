@@ -0,0 +1 @@
+ALTER TABLE updates ADD COLUMN stats jsonb DEFAULT NULL;
@@ -0,0 +1,2 @@
+-- Digest of the marker content, NULL until the next update of the marker
+ALTER TABLE markers ADD COLUMN digest bytea DEFAULT NULL;
@@ -0,0 +1,2 @@
+-- Digest of the class metadata, NULL until the next update of the class
+ALTER TABLE class ADD COLUMN fingerprint bytea DEFAULT NULL;
@@ -0,0 +1,88 @@
+-- List partition markers and markers_status by source_id. The sources stay in
+-- the default partitions until they get their own, see source_partition_create.
+-- Load the functions source_partition_create and source_partition_drop from
+-- schema.sql first. The sources grown large later are moved by the maintenance
+-- step `python3 -m control.update_utils --partition`, run by tools/cron.sh.
+
+ALTER TABLE markers RENAME TO markers_old;
+ALTER TABLE markers_old RENAME CONSTRAINT markers_pkey TO markers_old_pkey;
+ALTER TABLE markers_old RENAME CONSTRAINT markers_item_class_fkey TO markers_old_item_class_fkey;
+ALTER TABLE markers_old RENAME CONSTRAINT markers_sources_fkey TO markers_old_sources_fkey;
+ALTER TABLE markers_status RENAME TO markers_status_old;
+ALTER TABLE markers_status_old RENAME CONSTRAINT markers_status_pkey TO markers_status_old_pkey;
+ALTER TABLE markers_status_old RENAME CONSTRAINT dynpoi_status_source_fkey TO markers_status_old_source_fkey;
+ALTER TABLE markers_status_old RENAME CONSTRAINT markers_status_item_class_fkey TO markers_status_old_item_class_fkey;
+
+CREATE TABLE markers (
+    source_id integer NOT NULL,
+    class integer,
+    lat numeric(9,7),
+    lon numeric(10,7),
+    item integer,
+    subtitle jsonb,
+    uuid uuid NOT NULL,
+    elems jsonb[],
+    fixes jsonb[],
+    digest bytea
+)
+PARTITION BY LIST (source_id);
+CREATE TABLE markers_default PARTITION OF markers DEFAULT;
+
+CREATE TABLE markers_status (
+    source_id integer NOT NULL,
+    class integer NOT NULL,
+    date timestamp with time zone,
+    status character varying(128),
+    lat numeric(9,7) NOT NULL,
+    lon numeric(10,7) NOT NULL,
+    subtitle jsonb,
+    uuid uuid NOT NULL,
+    elems jsonb[],
+    item integer NOT NULL
+)
+PARTITION BY LIST (source_id);
+CREATE TABLE markers_status_default PARTITION OF markers_status DEFAULT;
+
+INSERT INTO markers (source_id, class, lat, lon, item, subtitle, uuid, elems, fixes, digest)
+SELECT source_id, class, lat, lon, item, subtitle, uuid, elems, fixes, digest FROM markers_old;
+INSERT INTO markers_status (source_id, class, date, status, lat, lon, subtitle, uuid, elems, item)
+SELECT source_id, class, date, status, lat, lon, subtitle, uuid, elems, item FROM markers_status_old;
+
+DROP TABLE markers_old;
+DROP TABLE markers_status_old;
+
+-- Own partitions for the large sources, while the tables have no index yet
+SELECT
+    source_partition_create(source_id)
+FROM
+    markers_counts
+GROUP BY
+    source_id
+HAVING
+    sum(count) >= 10000
+;
+
+ALTER TABLE markers ADD CONSTRAINT markers_pkey PRIMARY KEY (source_id, uuid);
+ALTER TABLE markers ADD CONSTRAINT markers_item_class_fkey FOREIGN KEY (item, class) REFERENCES class (item, class);
+ALTER TABLE markers ADD CONSTRAINT markers_sources_fkey FOREIGN KEY (source_id) REFERENCES sources (id);
+CREATE INDEX idx_marker_elem_ids ON markers USING gin (marker_elem_ids(elems));
+CREATE INDEX idx_marker_id ON markers USING btree (uuid_to_bigint(uuid));
+CREATE INDEX idx_marker_item ON markers USING btree (item);
+CREATE INDEX idx_marker_item_lat_lon ON markers USING btree (item, lat, lon);
+CREATE INDEX idx_marker_source_class ON markers USING btree (source_id, class);
+CREATE INDEX idx_marker_source_class_z_order_curve ON markers USING btree (source_id, class, lonlat2z_order_curve((lon)::double precision, (lat)::double precision)) WHERE (lat > ('-90'::integer)::numeric);
+CREATE INDEX idx_marker_usernames ON markers USING gin (marker_usernames(elems));
+-- The primary key starts with source_id, for the lookups on uuid alone
+CREATE INDEX idx_marker_uuid ON markers USING btree (uuid);
+CREATE INDEX idx_marker_z_order_curve_item ON markers USING btree (lonlat2z_order_curve((lon)::double precision, (lat)::double precision), item) WHERE (lat > ('-90'::integer)::numeric);
+
+ALTER TABLE markers_status ADD CONSTRAINT markers_status_pkey PRIMARY KEY (source_id, uuid);
+ALTER TABLE markers_status ADD CONSTRAINT dynpoi_status_source_fkey FOREIGN KEY (source_id) REFERENCES sources (id);
+ALTER TABLE markers_status ADD CONSTRAINT markers_status_item_class_fkey FOREIGN KEY (item, class) REFERENCES class (item, class);
+CREATE INDEX idx_markers_status_id ON markers_status USING btree (uuid_to_bigint(uuid));
+CREATE INDEX idx_markers_status_item_class ON markers_status USING btree (item, class);
+CREATE INDEX idx_markers_status_source_id_class ON markers_status USING btree (source_id, class);
+CREATE INDEX idx_markers_status_uuid ON markers_status USING btree (uuid);
+
+ANALYZE markers;
+ANALYZE markers_status;
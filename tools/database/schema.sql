@@ -91,6 +91,38 @@ AS $function$
   ) AS t(elem)
 $function$;
 
+CREATE OR REPLACE FUNCTION public.source_partition_create(source_id integer)
+ RETURNS void
+ LANGUAGE plpgsql
+AS $function$
+DECLARE
+  t text;
+BEGIN
+  FOREACH t IN ARRAY ARRAY['markers', 'markers_status'] LOOP
+    IF to_regclass(format('public.%I', t || '_source_' || source_id)) IS NULL THEN
+      -- Move the rows of the source out of the default partition first
+      EXECUTE format('CREATE TABLE public.%I (LIKE public.%I INCLUDING DEFAULTS)', t || '_source_' || source_id, t);
+      EXECUTE format('WITH moved AS (DELETE FROM public.%I WHERE source_id = %s RETURNING *) INSERT INTO public.%I SELECT * FROM moved', t || '_default', source_id, t || '_source_' || source_id);
+      EXECUTE format('ALTER TABLE public.%I ATTACH PARTITION public.%I FOR VALUES IN (%s)', t, t || '_source_' || source_id, source_id);
+    END IF;
+  END LOOP;
+END;
+$function$;
+
+CREATE OR REPLACE FUNCTION public.source_partition_drop(source_id integer)
+ RETURNS void
+ LANGUAGE plpgsql
+AS $function$
+DECLARE
+  t text;
+BEGIN
+  FOREACH t IN ARRAY ARRAY['markers', 'markers_status'] LOOP
+    EXECUTE format('DROP TABLE IF EXISTS public.%I', t || '_source_' || source_id);
+    EXECUTE format('DELETE FROM public.%I WHERE source_id = %s', t || '_default', source_id);
+  END LOOP;
+END;
+$function$;
+
 CREATE OR REPLACE FUNCTION public.uuid_to_bigint(uuid uuid)
  RETURNS bigint
  LANGUAGE sql
@@ -155,7 +187,8 @@ CREATE TABLE public.class (
     trap jsonb,
     example jsonb,
     source text,
-    resource text
+    resource text,
+    fingerprint bytea
 );
 
 
@@ -180,7 +213,7 @@ CREATE TABLE public.items (
 --
 
 CREATE TABLE public.markers (
-    source_id integer,
+    source_id integer NOT NULL,
     class integer,
     lat numeric(9,7),
     lon numeric(10,7),
@@ -188,9 +221,17 @@ CREATE TABLE public.markers (
     subtitle jsonb,
     uuid uuid NOT NULL,
     elems jsonb[],
-    fixes jsonb[]
+    fixes jsonb[],
+    digest bytea
 )
-WITH (autovacuum_enabled='true', toast.autovacuum_enabled='true');
+PARTITION BY LIST (source_id);
+
+
+--
+-- Name: markers_default; Type: TABLE; Schema: public; Owner: -
+--
+
+CREATE TABLE public.markers_default PARTITION OF public.markers DEFAULT;
 
 
 --
@@ -220,7 +261,15 @@ CREATE TABLE public.markers_status (
     uuid uuid NOT NULL,
     elems jsonb[],
     item integer NOT NULL
-);
+)
+PARTITION BY LIST (source_id);
+
+
+--
+-- Name: markers_status_default; Type: TABLE; Schema: public; Owner: -
+--
+
+CREATE TABLE public.markers_status_default PARTITION OF public.markers_status DEFAULT;
 
 
 --
@@ -285,7 +334,8 @@ CREATE TABLE public.updates (
     remote_url character varying(2048),
     remote_ip character varying(128),
     version text,
-    analyser_version text
+    analyser_version text,
+    stats jsonb
 );
 
 
@@ -365,16 +415,16 @@ ALTER TABLE ONLY public.markers_counts
 -- Name: markers markers_pkey; Type: CONSTRAINT; Schema: public; Owner: -
 --
 
-ALTER TABLE ONLY public.markers
-    ADD CONSTRAINT markers_pkey PRIMARY KEY (uuid);
+ALTER TABLE public.markers
+    ADD CONSTRAINT markers_pkey PRIMARY KEY (source_id, uuid);
 
 
 --
 -- Name: markers_status markers_status_pkey; Type: CONSTRAINT; Schema: public; Owner: -
 --
 
-ALTER TABLE ONLY public.markers_status
-    ADD CONSTRAINT markers_status_pkey PRIMARY KEY (uuid);
+ALTER TABLE public.markers_status
+    ADD CONSTRAINT markers_status_pkey PRIMARY KEY (source_id, uuid);
 
 
 --
@@ -492,6 +542,13 @@ CREATE INDEX idx_marker_source_class_z_order_curve ON public.markers USING btree
 CREATE INDEX idx_marker_usernames ON public.markers USING gin (public.marker_usernames(elems));
 
 
+--
+-- Name: idx_marker_uuid; Type: INDEX; Schema: public; Owner: -
+--
+
+CREATE INDEX idx_marker_uuid ON public.markers USING btree (uuid);
+
+
 --
 -- Name: idx_marker_z_order_curve_item; Type: INDEX; Schema: public; Owner: -
 --
@@ -527,6 +584,13 @@ CREATE INDEX idx_markers_status_item_class ON public.markers_status USING btree
 CREATE INDEX idx_markers_status_source_id_class ON public.markers_status USING btree (source_id, class);
 
 
+--
+-- Name: idx_markers_status_uuid; Type: INDEX; Schema: public; Owner: -
+--
+
+CREATE INDEX idx_markers_status_uuid ON public.markers_status USING btree (uuid);
+
+
 --
 -- Name: idx_stats; Type: INDEX; Schema: public; Owner: -
 --
@@ -545,7 +609,7 @@ CREATE INDEX sources_country_analyser ON public.sources USING btree (country, an
 -- Name: markers_status dynpoi_status_source_fkey; Type: FK CONSTRAINT; Schema: public; Owner: -
 --
 
-ALTER TABLE ONLY public.markers_status
+ALTER TABLE public.markers_status
     ADD CONSTRAINT dynpoi_status_source_fkey FOREIGN KEY (source_id) REFERENCES public.sources(id);
 
 
@@ -577,7 +641,7 @@ ALTER TABLE ONLY public.markers_counts
 -- Name: markers markers_item_class_fkey; Type: FK CONSTRAINT; Schema: public; Owner: -
 --
 
-ALTER TABLE ONLY public.markers
+ALTER TABLE public.markers
     ADD CONSTRAINT markers_item_class_fkey FOREIGN KEY (item, class) REFERENCES public.class(item, class);
 
 
@@ -585,7 +649,7 @@ ALTER TABLE ONLY public.markers
 -- Name: markers markers_sources_fkey; Type: FK CONSTRAINT; Schema: public; Owner: -
 --
 
-ALTER TABLE ONLY public.markers
+ALTER TABLE public.markers
     ADD CONSTRAINT markers_sources_fkey FOREIGN KEY (source_id) REFERENCES public.sources(id);
 
 
@@ -593,7 +657,7 @@ ALTER TABLE ONLY public.markers
 -- Name: markers_status markers_status_item_class_fkey; Type: FK CONSTRAINT; Schema: public; Owner: -
 --
 
-ALTER TABLE ONLY public.markers_status
+ALTER TABLE public.markers_status
     ADD CONSTRAINT markers_status_item_class_fkey FOREIGN KEY (item, class) REFERENCES public.class(item, class);
 
 
@@ -15,7 +15,10 @@ async def main():
     for t in tables:
         for res in await db.fetch(f"SELECT source_id FROM {t} GROUP BY source_id"):
             if res["source_id"] not in sources:
-                print(f"DELETE FROM {t} WHERE source_id = {res['source_id']};")
+                if t in ("markers", "markers_status"):
+                    print(f"SELECT source_partition_drop({res['source_id']});")
+                else:
+                    print(f"DELETE FROM {t} WHERE source_id = {res['source_id']};")
 
 
 if __name__ == "__main__":
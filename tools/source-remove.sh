@@ -7,9 +7,9 @@ for i in $*; do
   echo "confirm?"
   read ln
 
-  psql -d osmose_frontend -c  "DELETE FROM markers WHERE source_id = $i;"
+  # Drop the partitions of markers and markers_status
+  psql -d osmose_frontend -c  "SELECT source_partition_drop($i);"
   psql -d osmose_frontend -c  "DELETE FROM markers_counts WHERE source_id = $i;"
-  psql -d osmose_frontend -c  "DELETE FROM markers_status WHERE source_id = $i;"
   psql -d osmose_frontend -c  "DELETE FROM sources_password WHERE source_id = $i;"
   psql -d osmose_frontend -c  "DELETE FROM updates_last WHERE source_id = $i;"
 done
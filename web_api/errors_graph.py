@@ -2,7 +2,7 @@ import csv
 import io
 import json
 from datetime import datetime
-from typing import List, Tuple, Union
+from typing import Any, List, Tuple, Union
 
 import matplotlib  # type: ignore
 import matplotlib.dates  # type: ignore
@@ -150,20 +150,24 @@ LIMIT 1
 async def get_src(db: Connection, params: Params) -> str:
     ret = []
     if params.item:
+        sql_params: List[Any] = []
         r = await db.fetchval(
             "SELECT menu->'en' FROM items WHERE {0}".format(
-                query._build_where_item("items", params.item)
-            )
+                query._build_where_item("items", params.item, sql_params)
+            ),
+            *sql_params,
         )
         if r:
             ret.append(r)
 
     if params.item and params.classs:
+        sql_params = []
         r = await db.fetchval(
             "SELECT title->'en' FROM class WHERE {0} AND {1};".format(
-                query._build_where_item("class", params.item),
-                query._build_where_class("class", params.classs),
-            )
+                query._build_where_item("class", params.item, sql_params),
+                query._build_where_class("class", params.classs, sql_params),
+            ),
+            *sql_params,
         )
         if r:
             ret.append(r)